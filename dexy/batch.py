@@ -1,8 +1,23 @@
-import uuid
-import os
+from collections import OrderedDict
+from collections import namedtuple
+from operator import attrgetter
 import dexy.data
+import threading
+import uuid
+
+class DocSummary(namedtuple('DocSummary',
+        ['doc_key', 'key', 'output_name', 'ext', 'canonical', 'title'])):
+    """
+    Information about a doc's output which is available from batch info
+    without constructing data objects or storage.
+    """
+    def is_index_page(self):
+        return bool(self.output_name) and self.output_name.endswith("index.html")
 
 class Batch(object):
+    # Maximum number of data objects kept by data().
+    data_cache_size = 256
+
     def __init__(self, wrapper):
         self.wrapper = wrapper
         self.docs = {}
@@ -11,6 +26,8 @@ class Batch(object):
         self.uuid = str(uuid.uuid4())
         self.start_time = None
         self.end_time = None
+        self.data_cache = OrderedDict()
+        self.data_cache_lock = threading.Lock()
 
     def __repr__(self):
         return "Batch(%s)" % self.uuid
@@ -33,7 +50,41 @@ class Batch(object):
             self.filters_used.extend(doc.filter_aliases)
 
     def update_doc_info(self, doc):
-        self.docs[doc.key_with_class()] = doc.batch_info()
+        doc_key = doc.key_with_class()
+        self.docs[doc_key] = doc.batch_info()
+        self.forget_data(doc_key)
+
+    def summaries(self):
+        """
+        Yields a DocSummary for each doc that __iter__ would yield data for,
+        without constructing any data objects.
+        """
+        for doc_key in self.docs:
+            if self.docs[doc_key]['state'] in ('uncached',):
+                continue
+            yield self.summary(doc_key)
+
+    def matching_output_data(self, match_fn):
+        """
+        Returns output data of the docs whose summaries match_fn returns True
+        for, sorted by key. Data objects are only constructed for matches.
+        """
+        summaries = sorted([s for s in self.summaries() if match_fn(s)],
+                key=attrgetter('key'))
+        return [self.output_data(s.doc_key) for s in summaries]
+
+    def summary(self, doc_key):
+        doc_info = self.doc_info(doc_key)
+        alias, key, ext, storage_key, settings = doc_info['output-data']
+
+        if 'output-name' in doc_info:
+            output_name = doc_info['output-name']
+        else:
+            # batch info saved by an earlier version
+            output_name = self.output_data(doc_key).output_name()
+
+        return DocSummary(doc_key, key, output_name, ext,
+                settings.get('canonical-output'), doc_info['title'])
 
     def output_data(self, doc_key):
         return self.data(doc_key, 'output')
@@ -48,8 +99,36 @@ class Batch(object):
         return self.doc_keys[storage_key]
 
     def data(self, doc_key, input_or_output='output'):
+        """
+        Returns a data object for the doc's input or output. The most
+        recently used data objects are kept, so their storage is only set up
+        once and any loaded contents can be reused.
+        """
+        cache_key = (doc_key, input_or_output)
+
+        with self.data_cache_lock:
+            data = self.data_cache.pop(cache_key, None)
+            if data is not None:
+                self.data_cache[cache_key] = data
+                return data
+
         doc_info = self.doc_info(doc_key)["%s-data" % input_or_output]
-        return self._data_for_doc_info(doc_info)
+        data = self._data_for_doc_info(doc_info)
+
+        with self.data_cache_lock:
+            self.data_cache[cache_key] = data
+            while len(self.data_cache) > self.data_cache_size:
+                self.data_cache.popitem(last=False)
+
+        return data
+
+    def forget_data(self, doc_key):
+        """
+        Removes the doc's data objects from the cache used by data().
+        """
+        with self.data_cache_lock:
+            for input_or_output in ('input', 'output'):
+                self.data_cache.pop((doc_key, input_or_output), None)
 
     def data_for_storage_key(self, storage_key, input_or_output='output'):
         doc_key = self.doc_key(storage_key)
@@ -71,55 +150,33 @@ class Batch(object):
         else:
             return 0
 
-    def filename(self):
-        return "%s.pickle" % self.uuid
-
-    def filepath(self):
-        return os.path.join(self.batch_dir(), self.filename())
-
-    def most_recent_filename(self):
-        return os.path.join(self.batch_dir(), 'most-recent-batch.txt')
-
-    def batch_dir(self):
-        return os.path.join(self.wrapper.artifacts_dir, 'batches')
-
     def to_dict(self):
         attr_names = ['docs', 'doc_keys', 'filters_used', 'uuid']
         return dict((k, getattr(self, k),) for k in attr_names)
 
     def save_to_file(self):
-        try:
-            os.makedirs(self.batch_dir())
-        except OSError:
-            pass
-
-        with open(self.filepath(), 'w') as f:
-            pickle = dexy.utils.pickle_lib(self.wrapper)
-            pickle.dump(self.to_dict(), f)
-
-        with open(self.most_recent_filename(), 'w') as f:
-            f.write(self.uuid)
+        """
+        Records this batch's info in the wrapper's metadata store. The store
+        is written to disk by the wrapper.
+        """
+        self.wrapper.metadata.save_batch(self.uuid, self.to_dict())
 
     def load_from_file(self):
-        pickle = dexy.utils.pickle_lib(self.wrapper)
-        with open(self.filepath(), 'r') as f:
-            d = pickle.load(f)
-            for k, v in d.iteritems():
-                setattr(self, k, v)
+        d = self.wrapper.metadata.batch_info(self.uuid)
+        for k, v in d.iteritems():
+            setattr(self, k, v)
+        self.data_cache.clear()
 
     @classmethod
     def load_most_recent(klass, wrapper):
         """
-        Retuns a batch instance representing the most recent batch as indicated
-        by the UUID stored in most-recent-batch.txt.
+        Retuns a batch instance representing the most recent batch recorded
+        in the metadata store.
         """
-        batch = Batch(wrapper)
-        try:
-            with open(batch.most_recent_filename(), 'r') as f:
-                most_recent_uuid = f.read()
-
+        wrapper.metadata.load()
+        most_recent_uuid = wrapper.metadata.most_recent_batch
+        if most_recent_uuid:
+            batch = Batch(wrapper)
             batch.uuid = most_recent_uuid
             batch.load_from_file()
             return batch
-        except IOError:
-            pass
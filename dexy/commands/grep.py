@@ -4,7 +4,6 @@ from dexy.data import Generic
 from dexy.data import KeyValue
 from dexy.data import Sectioned
 from dexy.utils import defaults
-from operator import attrgetter
 import dexy.exceptions
 import json
 import sys
@@ -33,11 +32,9 @@ def grep_command(
         sys.exit(1)
     else:
         if expr:
-            matches = sorted([data for data in batch if expr in data.key],
-                    key=attrgetter('key'))
+            matches = batch.matching_output_data(lambda s: expr in s.key)
         elif key:
-            matches = sorted([data for data in batch if key == data.key],
-                    key=attrgetter('key'))
+            matches = batch.matching_output_data(lambda s: key == s.key)
         else:
             raise dexy.exceptions.UserFeedback("Must specify either expr or key")
 
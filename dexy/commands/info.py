@@ -1,7 +1,6 @@
 from dexy.batch import Batch
 from dexy.commands.utils import init_wrapper
 from dexy.utils import defaults
-from operator import attrgetter
 import dexy.exceptions
 
 INFO_ATTRS = [
@@ -31,10 +30,10 @@ def info_command(
     batch = Batch.load_most_recent(wrapper)
 
     if expr:
-        matches = sorted([data for data in batch if expr in data.key], key=attrgetter('key'))
+        matches = batch.matching_output_data(lambda s: expr in s.key)
         print "search expr:", expr
     elif key:
-        matches = sorted([data for data in batch if key == data.key], key=attrgetter('key'))
+        matches = batch.matching_output_data(lambda s: key == s.key)
     else:
         raise dexy.exceptions.UserFeedback("Must specify either expr or key")
 
@@ -98,12 +98,14 @@ def dexy_command(
         globals=defaults['globals'], # global values to make available within dexy documents, should be KEY=VALUE pairs separated by spaces
         help=False, #nodoc
         h=False, #nodoc
-        hashfunction=defaults['hashfunction'], # What hash function to use, set to crc32 or adler32 for more speed but less reliability
+        hashfunction=defaults['hashfunction'], # What hash function to use: md5, sha1, blake2 or xxhash (if installed), or crc32 or adler32 for more speed but less reliability
         include=defaults['include'], # Locations to include which would normally be excluded.
+        jobs=defaults['jobs'], # Number of documents to run at the same time, documents only wait for the documents they depend on. The pytest filter's chdir setting can only be used with 1 job.
         logdir=defaults['log_dir'], # location of directory in which to store logs
         logfile=defaults['log_file'], # name of log file
         logformat=defaults['log_format'], # format of log entries
         loglevel=defaults['log_level'], # log level, valid options are DEBUG, INFO, WARN
+        maxprocesses=defaults['max_processes'], # Most external processes filters may run at the same time, or 0 for one per CPU.
         nocache=defaults['dont_use_cache'], # whether to force dexy not to use files from the cache
         noreports=False, # if true, don't run any reports
         outputroot=defaults['output_root'], # Subdirectory to use as root for output
@@ -114,7 +116,9 @@ def dexy_command(
         recurse=defaults['recurse'], # whether to include doc config files in subdirectories
         reports=defaults['reports'], # reports to be run after dexy runs, enclose in quotes and separate with spaces
         reset=False, # whether to clear cache before running dexy
+        scandir=defaults['scandir'], # Whether to use scandir (if available) to list and stat project files in one pass.
         silent=defaults['silent'], # Whether to not print any output when running dexy
+        storage=defaults['storage'], # Storage type to use for generic data, 'cas' stores identical content only once, 'compressed' compresses large text files.
         strace=defaults['strace'], # Run dexy using strace (VERY slow)
         uselocals=defaults['uselocals'], # use cached local copies of remote URLs, faster but might not be up to date, 304 from server will override this setting
         target=defaults['target'], # Which target to run. By default all targets are run, this allows you to run only 1 bundle (and its dependencies).
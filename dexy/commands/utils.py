@@ -19,6 +19,7 @@ RENAME_PARAMS = {
         'logformat' : 'log_format',
         'loglevel' : 'log_level',
         'logdir' : 'log_dir',
+        'maxprocesses' : 'max_processes',
         'nocache' : 'dont_use_cache',
         'outputroot' : 'output_root'
         }
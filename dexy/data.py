@@ -1,13 +1,14 @@
 from dexy.exceptions import InternalDexyProblem
+from contextlib import contextmanager
 import chardet
 import dexy.plugin
 import dexy.storage
 import dexy.utils
 import dexy.wrapper
 import inflection
+import mmap
 import os
 import posixpath
-import shutil
 import urllib
 
 class Data(dexy.plugin.Plugin):
@@ -41,6 +42,8 @@ class Data(dexy.plugin.Plugin):
         self.update_settings(settings)
 
         self._data = None
+        self._text = None
+        self._text_source = None
         self.state = None
         self.name = self.setting('canonical-name')
         if not self.name:
@@ -101,19 +104,43 @@ class Data(dexy.plugin.Plugin):
         return self.setting('storage-type')
 
     def __unicode__(self):
-        if isinstance(self.data(), unicode):
-            return self.data()
-        elif not self.data():
+        data = self.data()
+        if self._text is None or not self._text_source is data:
+            self._text = self.decode(data)
+            self._text_source = data
+        return self._text
+
+    def decode(self, data):
+        """
+        Returns data decoded to unicode using the wrapper's encoding setting.
+        """
+        if isinstance(data, unicode):
+            return data
+        elif not data:
             return unicode(None)
         else:
             if self.wrapper.encoding == 'chardet':
-                encoding = chardet.detect(self.data())['encoding']
+                encoding = self.detect_encoding(data)
                 if not encoding:
-                    return self.data().decode("utf-8")
+                    return data.decode("utf-8")
                 else:
-                    return self.data().decode(encoding)
+                    return data.decode(encoding)
             else:
-                return self.data().decode(self.wrapper.encoding)
+                return data.decode(self.wrapper.encoding)
+
+    def detect_encoding(self, data):
+        """
+        Runs chardet on data. The result is stored in the cache manifest, so
+        it isn't detected again while the data file is unchanged.
+        """
+        def detect():
+            return chardet.detect(data)['encoding']
+
+        if self.is_cached():
+            filepath = self.storage.data_file()
+            return self.wrapper.cache_manifest.file_encoding(filepath, detect)
+        else:
+            return detect()
 
     def __str__(self):
         return str(unicode(self))
@@ -202,6 +229,14 @@ class Generic(Data):
     """
     aliases = ['generic']
 
+    def storage_class_alias(self, file_ext):
+        storage_type = self.setting('storage-type')
+        if storage_type == 'generic':
+            # allow project-wide alternative storage for generic data
+            return self.wrapper.storage
+        else:
+            return storage_type
+
     def save(self):
         if isinstance(self._data, unicode):
             self.storage.write_data(self._data.encode("utf-8"))
@@ -216,6 +251,7 @@ class Generic(Data):
         Set data to the passed argument and persist data to disk.
         """
         self._data = data
+        self._text = None
         self.save()
 
     def load_data(self, this=None):
@@ -294,10 +330,11 @@ class Generic(Data):
         return self.key
 
     def copy_from_file(self, filename):
-        shutil.copyfile(filename, self.storage.data_file())
+        self.storage.copy_from_file(filename)
 
     def clear_data(self):
         self._data = None
+        self._text = None
 
     def clear_cache(self):
         self._size = None
@@ -310,16 +347,65 @@ class Generic(Data):
         """
         Write canonical output to a file. Parent directory must exist already.
         """
-        if not self.storage.copy_file(filepath):
+        if self.storage.copy_file(filepath):
+            return
+        elif self._data is None and self.is_cached():
+            with open(filepath, "wb") as f:
+                for chunk in self.iter_chunks():
+                    f.write(chunk)
+        else:
             self.storage.write_data(self.data(), filepath)
 
+    def open(self):
+        """
+        Returns a file-like object for reading the stored data, so data can
+        be read without loading all of it into memory.
+        """
+        return self.storage.open_data()
+
+    def iter_chunks(self, chunk_size=65536):
+        """
+        Yields the stored data in chunks of at most chunk_size bytes.
+        """
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                yield chunk
+
+    @contextmanager
+    def mmap(self):
+        """
+        Context manager returning a read-only memory-mapped view of the stored
+        data, which supports slicing, find() and len() without reading the
+        whole file into memory.
+        """
+        with self.open() as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files can't be mapped
+                yield ''
+            else:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    yield view
+                finally:
+                    view.close()
+
 class SectionValue(object):
+    """
+    A single section of Sectioned data. If data is None, the section is
+    read from the parent when it is first needed.
+    """
     def __init__(self, data, parent, parentindex):
-        assert isinstance(data, dict)
-        self.data = data
+        assert data is None or isinstance(data, dict)
+        self._section = data
         self.parent = parent
         self.parentindex = parentindex
 
+    @property
+    def data(self):
+        if self._section is None:
+            self._section = self.parent.section(self.parentindex)
+        return self._section
+
     def __unicode__(self):
         return unicode(self.data['contents'])
 
@@ -330,7 +416,7 @@ class SectionValue(object):
         return self.data[key]
 
     def __setitem__(self, key, value):
-        self.parent.data()[self.parentindex+1][key] = value
+        self.data[key] = value
 
     def splitlines(self):
         return unicode(self).splitlines()
@@ -338,6 +424,9 @@ class SectionValue(object):
 class Sectioned(Generic):
     """
     Data in sections which must be kept in order.
+
+    Data which has been saved is read lazily, a section is only decoded
+    when it is accessed.
     """
     aliases = ['sectioned']
 
@@ -345,6 +434,12 @@ class Sectioned(Generic):
             'storage-type' : 'jsonsectioned'
             }
 
+    def __init__(self, key, ext, storage_key, settings, wrapper):
+        self._sections = {}
+        self._keyindex = None
+        self._keyindex_size = None
+        Generic.__init__(self, key, ext, storage_key, settings, wrapper)
+
     def __unicode__(self):
         return u"\n".join(unicode(v) for v in self.values() if v.data['contents'])
 
@@ -352,63 +447,133 @@ class Sectioned(Generic):
         return "\n".join(str(v) for v in self.values() if v.data['contents'])
 
     def __len__(self):
-        return len(self.data())-1
+        if self.in_memory():
+            return len(self._data)-1
+        else:
+            return len(self.storage_index('section_names'))
 
     def setup(self):
         self.setup_storage()
         self._data = [{}]
         self.transition('ready')
 
+    def in_memory(self):
+        """
+        Returns True if sections are being built in memory rather than read
+        from storage.
+        """
+        return self._data and self._data != [{}]
+
+    def storage_index(self, method_name):
+        try:
+            return getattr(self.storage, method_name)()
+        except IOError:
+            msg = "no data in file '%s' for %s (wrapper state '%s')"
+            msgargs = (self.storage.data_file(), self.key, self.wrapper.state)
+            raise dexy.exceptions.InternalDexyProblem(msg % msgargs)
+
+    def metadata(self):
+        if self.in_memory():
+            return self._data[0]
+        else:
+            return self.storage_index('metadata')
+
+    def section(self, index):
+        """
+        Returns the dict for section number index.
+        """
+        if self.in_memory():
+            return self._data[index+1]
+        elif not index in self._sections:
+            self._sections[index] = self.storage.read_section(index)
+        return self._sections[index]
+
+    def data(self):
+        if not self.in_memory():
+            metadata = self.metadata()
+            self._data = [metadata] + [self.section(i) for i in range(len(self))]
+            self._sections = {}
+        return self._data
+
+    def clear_data(self):
+        self._data = None
+        self._text = None
+        self._sections = {}
+        self._keyindex = None
+
+    def load_data(self, this=None):
+        self._sections = {}
+        self._keyindex = None
+        Generic.load_data(self, this)
+
     def __setitem__(self, key, value):
         section_dict = {"name" : key, "contents" : value}
+        if not self._data:
+            # load any saved sections before adding to them
+            self.data()
         self._data.append(section_dict)
 
     def __delitem__(self, key):
         index = self.keyindex(key)
         self.data().pop(index+1)
+        self._keyindex = None
 
     def keys(self):
-        return [a['name'] for a in self.data()[1:]]
+        if self.in_memory():
+            return [a['name'] for a in self._data[1:]]
+        else:
+            return list(self.storage_index('section_names'))
 
     def values(self):
-        return [SectionValue(a, self, i) for i, a in enumerate(self.data()[1:])]
+        return [SectionValue(None, self, i) for i in range(len(self))]
 
     def output_to_file(self, filepath):
         """
         Write canonical (not structured) output to a file.
         """
         with open(filepath, "wb") as f:
-            f.write(unicode(self).encode("utf-8"))
+            separator = ""
+            for v in self.values():
+                if v.data['contents']:
+                    f.write(separator)
+                    f.write(unicode(v).encode("utf-8"))
+                    separator = "\n"
 
     def keyindex(self, key):
-        try:
-            return self.keys().index(key)
-        except ValueError:
-            return -1
+        # Sections can be appended to _data directly, so the dict is rebuilt
+        # if the number of sections has changed.
+        size = len(self)
+        if self._keyindex is None or self._keyindex_size != size:
+            self._keyindex = {}
+            for i, name in enumerate(self.keys()):
+                self._keyindex.setdefault(name, i)
+            self._keyindex_size = size
+        return self._keyindex.get(key, -1)
 
     def value(self, key):
         index = self.keyindex(key)
         if index > -1:
-            return self.values()[index]
+            return SectionValue(None, self, index)
         else:
             try:
-                return self.data()[0][key]
+                return self.metadata()[key]
             except KeyError:
                 msg = "No value for %s available in sections or metadata."
                 msgargs = (key)
                 raise dexy.exceptions.UserFeedback(msg % msgargs)
 
     def __getitem__(self, key):
-        try:
-            return self.data()[key+1]
-        except TypeError:
+        if isinstance(key, (int, long)):
+            if key < 0 or self.in_memory():
+                return self.data()[key+1]
+            else:
+                return self.section(key)
+        else:
             return self.value(key)
 
     def iteritems(self):
-        keys = self.keys()
-        values = self.values()
-        for i in range(len(self)):
-            yield (keys[i], values[i])
+        for i, name in enumerate(self.keys()):
+            yield (name, SectionValue(None, self, i))
 
     def items(self):
         return [(key, value) for (key, value) in self.iteritems()]
@@ -451,9 +616,28 @@ class KeyValue(Generic):
     def append(self, key, value):
         self.storage.append(key, value)
 
+    def append_many(self, items):
+        """
+        Appends an iterable of (key, value) pairs.
+        """
+        self.storage.append_many(items)
+
     def query(self, query):
         return self.storage.query(query)
 
+    def prefix(self, prefix):
+        """
+        Returns (key, value) pairs whose key starts with prefix, sorted by key.
+        """
+        return self.storage.prefix(prefix)
+
+    def glob(self, pattern):
+        """
+        Returns (key, value) pairs whose key matches a glob pattern like
+        'foo:*', sorted by key.
+        """
+        return self.storage.glob(pattern)
+
     def keys(self):
         return self.storage.keys()
 
@@ -2,8 +2,6 @@ import dexy.exceptions
 import dexy.filter
 import dexy.node
 import os
-import shutil
-import stat
 import time
 
 class Doc(dexy.node.Node):
@@ -102,17 +100,7 @@ class Doc(dexy.node.Node):
             node.consolidate_cache_files()
 
         if self.state == 'cached':
-            self.setup_datas()
-
-            # move cache files to new cache
-            for d in self.datas():
-                if os.path.exists(d.storage.last_data_file()):
-                    shutil.move(d.storage.last_data_file(), d.storage.this_data_file())
-                    self.log_debug("Moving %s from %s to %s" % (d.key, d.storage.last_data_file(), d.storage.this_data_file()))
-
-            if os.path.exists(self.runtime_info_filename(False)):
-                shutil.move(self.runtime_info_filename(False), self.runtime_info_filename(True))
-
+            self.claim_cache_files()
             self.apply_runtime_info()
 
             for d in self.datas():
@@ -120,6 +108,17 @@ class Doc(dexy.node.Node):
                     d.storage.connect()
             self.transition('consolidated')
 
+    def claim_cache_files(self, remove_stale=False):
+        """
+        Claims this doc's cache files for the current cache generation. If
+        remove_stale is True, files left over from previous runs are removed
+        first, so the doc starts with an empty cache.
+        """
+        self.setup_datas()
+        for d in self.datas():
+            d.storage.claim_cache_files(remove_stale)
+        self.wrapper.metadata.claim_runtime_info(self.key_with_class(), remove_stale)
+
     def apply_runtime_info(self):
             runtime_info = self.load_runtime_info()
             if runtime_info:
@@ -154,33 +153,28 @@ class Doc(dexy.node.Node):
                 d.setup()
 
         return all(
-                os.path.exists(d.storage.last_data_file()) or
-                os.path.exists(d.storage.this_data_file())
+                d.storage.data_file_exists(False) or
+                d.storage.data_file_exists(True)
                 for d in self.datas())
 
     def check_doc_changed(self):
         if self.name in self.wrapper.filemap:
-            live_stat = self.wrapper.filemap[self.name]['stat']
+            fileinfo = self.wrapper.filemap[self.name]
 
             self.initial_data.setup()
 
-            in_this_cache = os.path.exists(self.initial_data.storage.this_data_file())
-            in_last_cache = os.path.exists(self.initial_data.storage.last_data_file())
+            cache_digest = self.initial_data.storage.cached_data_digest()
 
-            if in_this_cache or in_last_cache:
+            if cache_digest:
                 # we have a file in the cache from a previous run, compare its
-                # mtime to filemap to determine whether it has changed
-                if in_this_cache:
-                    cache_stat = os.stat(self.initial_data.storage.this_data_file())
-                else:
-                    cache_stat = os.stat(self.initial_data.storage.last_data_file())
-
-                cache_mtime = cache_stat[stat.ST_MTIME]
-                live_mtime = live_stat[stat.ST_MTIME]
-                msg = "    cache mtime %s live mtime %s now %s changed (live gt cache) %s"
-                msgargs = (cache_mtime, live_mtime, time.time(), live_mtime > cache_mtime)
+                # contents to the live file to determine whether it has changed
+                fingerprints = self.wrapper.fingerprints
+                live_digest = fingerprints.digest(self.name, fileinfo['ospath'], fileinfo['stat'])
+
+                msg = "    cache digest %s live digest %s changed %s"
+                msgargs = (cache_digest, live_digest, live_digest != cache_digest)
                 self.log_debug(msg % msgargs)
-                return live_mtime > cache_mtime
+                return live_digest != cache_digest
             else:
                 # there is no file in the cache, therefore it has 'changed'
                 return True
@@ -206,9 +200,12 @@ class Doc(dexy.node.Node):
         return contents
 
     # Runtime Info
-    def runtime_info_filename(self, this=True):
+    def legacy_runtime_info_filename(self):
+        """
+        Per-doc file in which runtime info was saved by earlier versions.
+        """
         name = "%s.runtimeargs.pickle" % self.hashid
-        return os.path.join(self.initial_data.storage.storage_dir(this), name)
+        return os.path.join(self.initial_data.storage.storage_dir(True), name)
 
     def save_runtime_info(self):
         """
@@ -221,27 +218,18 @@ class Doc(dexy.node.Node):
             'additional-docs' : self.additional_doc_info()
             }
 
-        with open(self.runtime_info_filename(), 'wb') as f:
-            pickle = self.wrapper.pickle_lib()
-            pickle.dump(info, f)
+        self.wrapper.metadata.save_runtime_info(self.key_with_class(), self.hashid, info)
 
     def load_runtime_info(self):
-        info = None
-
-        # Load from 'this' first
-        try:
-            with open(self.runtime_info_filename(), 'rb') as f:
-                pickle = self.wrapper.pickle_lib()
-                info = pickle.load(f)
-        except IOError:
-            pass
-
-        # Load from 'last' if there's nothing in 'this'
-        if not info:
+        doc_key = self.key_with_class()
+        info = self.wrapper.metadata.runtime_info(doc_key, self.hashid)
+
+        if info is None:
             try:
-                with open(self.runtime_info_filename(False), 'rb') as f:
+                with open(self.legacy_runtime_info_filename(), 'rb') as f:
                     pickle = self.wrapper.pickle_lib()
                     info = pickle.load(f)
+                self.wrapper.metadata.save_runtime_info(doc_key, self.hashid, info)
             except IOError:
                 pass
 
@@ -255,6 +243,8 @@ class Doc(dexy.node.Node):
 
         self.start_time = time.time()
 
+        self.claim_cache_files(True)
+
         if self.name in self.wrapper.filemap:
             # This is a real file on the file system.
             if self.doc_changed or not self.initial_data.is_cached():
@@ -273,6 +263,7 @@ class Doc(dexy.node.Node):
             if hasattr(f.output_data.storage, 'connect'):
                 f.output_data.storage.connect()
             f.process()
+            f.output_data.storage.finish()
             f.finish_time = time.time()
             f.elapsed = f.finish_time - f.start_time
 
@@ -313,6 +304,7 @@ class Doc(dexy.node.Node):
                 'filters-data' : [f.output_data.args_to_data_init() for f in self.filters],
                 # below are convenience attributes, not strictly necessary for dexy to run
                 'title' : self.output_data().title(),
+                'output-name' : self.output_data().output_name(),
                 'start_time' : self.start_time,
                 'finish_time' : self.finish_time,
                 'elapsed' : self.elapsed_time,
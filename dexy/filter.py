@@ -1,10 +1,11 @@
-from dexy.utils import copy_or_link
 from dexy.utils import os_to_posix
 from operator import attrgetter
 import dexy.doc
 import dexy.exceptions
 import dexy.plugin
 import dexy.utils
+import dexy.workspace
+import fnmatch
 import os
 import posixpath
 
@@ -82,6 +83,9 @@ class Filter(dexy.plugin.Plugin):
             'require-output' : (
                 "Should dexy raise an exception if no output is produced by this filter?",
                 True),
+            'shared-workspace' : (
+                "Whether to use one workspace for all filters of a doc which set this. The workspace is populated by the first of these filters, later ones only add their work input file.",
+                False),
             'tags' : (
                 "Tags which describe the filter.",
                 []),
@@ -93,7 +97,10 @@ class Filter(dexy.plugin.Plugin):
                 {}),
             'workspace-exclude-filters' : (
                 "Filters whose output should be excluded from workspace.",
-                ['pyg'])
+                ['pyg']),
+            'workspace-inputs' : (
+                "List of names or glob patterns of the inputs this filter needs in its workspace. If set, other inputs are not added to the workspace.",
+                None)
             }
 
     def __init__(self, doc=None):
@@ -328,7 +335,7 @@ class Filter(dexy.plugin.Plugin):
                     **args
                     )
 
-            doc.output_data().setup()
+            doc.claim_cache_files(True)
             doc.output_data().storage.connect()
 
             self.doc.add_additional_doc(doc)
@@ -367,8 +374,26 @@ class Filter(dexy.plugin.Plugin):
         The `populate_workspace` method will populate this directory with
         inputs to this filter.
         """
-        ws = self.doc.wrapper.work_cache_dir()
-        return os.path.join(ws, self.storage_key[0:2], self.storage_key)
+        ws = self.doc.wrapper.workspaces_dir()
+        if self.setting('shared-workspace'):
+            name = "%s-shared" % self.doc.hashid
+        else:
+            name = self.storage_key
+        return os.path.join(ws, name[0:2], name)
+
+    def shared_workspace_filter(self):
+        """
+        Returns the previous filter of this doc which has populated the
+        shared workspace this filter uses, or None.
+        """
+        if not self.setting('shared-workspace'):
+            return None
+
+        f = self.prev_filter
+        while f:
+            if f.setting('shared-workspace') and f.workspace_is_populated():
+                return f
+            f = f.prev_filter
 
     def parent_work_dir(self):
         """
@@ -410,6 +435,11 @@ class Filter(dexy.plugin.Plugin):
         Whether to include the contents of the input file inpt in the workspace
         for this filter.
         """
+        needed = self.setting('workspace-inputs')
+        if needed is not None:
+            name = inpt.output_data().name
+            return any(fnmatch.fnmatch(name, pattern) for pattern in needed)
+
         if inpt.filters and inpt.filters[-1].setting('include-in-workspaces'):
             return True
 
@@ -422,8 +452,11 @@ class Filter(dexy.plugin.Plugin):
         # include anything left over
         return True
 
-    def makedirs(self):
-        mkdirs = self.setting('mkdirs')
+    def workspace_mkdirs(self):
+        """
+        Directories to create in the workspace.
+        """
+        mkdirs = list(self.setting('mkdirs'))
 
         # mkdir should be a string, but handle either string or list
         mkdir = self.setting('mkdir')
@@ -433,32 +466,14 @@ class Filter(dexy.plugin.Plugin):
             else:
                 mkdirs.extend(mkdir)
 
-        for d in mkdirs:
-            dirpath = os.path.join(self.workspace(), d)
-            self.log_debug("Creating directory %s" % dirpath)
-            os.makedirs(dirpath)
+        return mkdirs
 
-    def populate_workspace(self):
+    def workspace_files(self):
         """
-        Populates the workspace directory with inputs to the filter, under
-        their canonical names.
+        Returns a dict of paths relative to the workspace and the data to
+        populate them with.
         """
-        already_created_dirs = set()
-        wd = self.parent_work_dir()
-
-        self._files_workspace_populated_with = set()
-
-        self.doc.wrapper.trash(wd)
-
-        try:
-            os.makedirs(wd)
-            already_created_dirs.add(wd)
-        except OSError:
-            msg = "workspace '%s' for filter '%s' already exists"
-            msgargs = (os.path.abspath(wd), self.key,)
-            raise dexy.exceptions.InternalDexyProblem(msg % msgargs)
-
-        self.makedirs()
+        files = {}
 
         for inpt in self.doc.walk_input_docs():
             if not self.include_input_in_workspace(inpt):
@@ -466,37 +481,59 @@ class Filter(dexy.plugin.Plugin):
                 continue
 
             data = inpt.output_data()
+            files[os.path.normpath(data.name)] = data
 
-            filepath = data.name
-
-            # Ensure parent dir exists.
-            parent_dir = os.path.join(self.workspace(), os.path.dirname(filepath))
-            if not parent_dir in already_created_dirs:
-                try:
-                    os.makedirs(parent_dir)
-                    already_created_dirs.add(parent_dir)
-                except OSError:
-                    pass
-
-            # Save contents of file to workspace
-            self.log_debug("populating workspace with %s for %s" % (filepath, inpt.key))
-            file_dest = os.path.join(self.workspace(), filepath)
-
-            try:
-                copy_or_link(data, file_dest)
-
-            except Exception as e:
-                self.log_debug("problem populating working dir with input %s" % data.key)
-                self.log_debug(e)
+        # The work input file is added last, so it replaces any input with
+        # the same name.
+        work_input = os.path.relpath(self.work_input_filepath(), self.workspace())
+        files[work_input] = self.input_data
 
-            self._files_workspace_populated_with.add(filepath)
+        return files
 
-        self.input_data.output_to_file(self.work_input_filepath())
+    def populate_workspace(self):
+        """
+        Populates the workspace directory with inputs to the filter, under
+        their canonical names. Files left from an earlier run are reused if
+        their contents haven't changed.
+        """
+        workspace = dexy.workspace.Workspace(self.doc.wrapper, self.workspace())
+
+        work_input = os.path.relpath(self.work_input_filepath(), self.workspace())
+
+        if self.shared_workspace_filter():
+            # Keep the tree an earlier filter of this doc set up, including
+            # any files it created.
+            workspace.makedirs(self.workspace_mkdirs())
+            self._files_workspace_populated_with = workspace.relpaths()
+            method = workspace.add(work_input, self.input_data, False)
+            self.log_debug("added %s to shared workspace (%s)" % (work_input, method))
+            self._files_workspace_populated_with.add(work_input)
+            self.custom_populate_workspace()
+            return
+
+        wanted = {}
+        for relpath, data in self.workspace_files().iteritems():
+            # Processes may change the work input file, so it is never linked.
+            allow_links = (relpath != work_input)
+            wanted[relpath] = (data, workspace.fingerprint(data), allow_links)
+
+        methods = workspace.populate(wanted, self.workspace_mkdirs())
+        self.log_debug("populated workspace for %s: %s" % (self.key, methods))
+
+        self._files_workspace_populated_with = set(wanted)
         rel_path_to_work_file = os.path.join(os.path.dirname(self.key), self.work_input_filename())
         self._files_workspace_populated_with.add(rel_path_to_work_file)
 
         self.custom_populate_workspace()
 
+    def workspace_is_populated(self):
+        """
+        Whether populate_workspace has been called for this filter in this
+        run. Workspaces are kept between runs, so the workspace dir may exist
+        without being populated yet.
+        """
+        return hasattr(self, '_files_workspace_populated_with')
+
     def custom_populate_workspace(self):
         """
         Allow filters to run the standard populate_workspace, and also do extra
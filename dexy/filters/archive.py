@@ -43,8 +43,10 @@ class ArchiveFilter(DexyFilter):
     def open_archive(self):
         self.archive = tarfile.open(self.output_filepath(), mode="w:gz")
 
-    def add_to_archive(self, filepath, archivename):
-        self.archive.add(filepath, arcname=archivename)
+    def add_to_archive(self, data, archivename):
+        with data.open() as f:
+            info = self.archive.gettarinfo(arcname=archivename, fileobj=f)
+            self.archive.addfile(info, f)
 
     def process(self):
         self.open_archive()
@@ -68,7 +70,7 @@ class ArchiveFilter(DexyFilter):
             arcname = os.path.join(dirname, arcname)
 
             # Add file to archive
-            self.add_to_archive(doc.output_data().storage.data_file(), arcname)
+            self.add_to_archive(doc.output_data(), arcname)
 
         # Save the archive
         self.archive.close()
@@ -88,5 +90,6 @@ class ZipArchiveFilter(ArchiveFilter):
     def open_archive(self):
         self.archive = zipfile.ZipFile(self.output_filepath(), mode="w")
 
-    def add_to_archive(self, filepath, archivename):
-        self.archive.write(filepath, arcname=archivename)
+    def add_to_archive(self, data, archivename):
+        # zipfile can only stream from a file on disk
+        self.archive.write(data.storage.data_file(), arcname=archivename)
@@ -159,7 +159,7 @@ class IPythonCasper(SubprocessFilter):
             output['cellmetas'].append(cell['metadata'])
 
         ws = self.workspace()
-        if os.path.exists(ws):
+        if self.workspace_is_populated():
             self.log_debug("already have workspace '%s'" % os.path.abspath(ws))
         else:
             self.populate_workspace()
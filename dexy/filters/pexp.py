@@ -2,8 +2,11 @@ from dexy.exceptions import InternalDexyProblem
 from dexy.exceptions import UserFeedback
 from dexy.exceptions import InactivePlugin
 from dexy.filters.process import SubprocessFilter
+import atexit
 import re
 import os
+import threading
+import uuid
 
 try:
     import pexpect
@@ -14,10 +17,95 @@ except ImportError:
 class DexyEOFException(UserFeedback):
     pass
 
+class ReplSession(object):
+    """
+    A running REPL process, with the text it printed up to its first prompt.
+    """
+    def __init__(self, key, proc, start):
+        self.key = key
+        self.proc = proc
+        self.start = start
+        self.uses = 0
+
+    def close(self):
+        try:
+            self.proc.close(force=True)
+        except pexpect.ExceptionPexpect:
+            pass
+
+class ReplPool(object):
+    """
+    REPL sessions kept running between docs, so a doc can reuse a warm
+    interpreter instead of starting a new one. At most max_sessions pooled
+    sessions exist at a time, idle sessions are closed to make room for new
+    ones and callers wait if all sessions are in use.
+    """
+    max_sessions = 4
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.idle = []
+        self.in_use = 0
+
+    def checkout(self, key):
+        """
+        Returns an idle session for key. If there is none, reserves room for
+        a new session and returns None.
+        """
+        with self.condition:
+            while True:
+                for session in self.idle:
+                    if session.key == key:
+                        self.idle.remove(session)
+                        self.in_use += 1
+                        return session
+
+                if self.in_use + len(self.idle) < self.max_sessions:
+                    self.in_use += 1
+                    return None
+                elif self.idle:
+                    # close the least recently used idle session
+                    self.idle.pop(0).close()
+                else:
+                    self.condition.wait()
+
+    def checkin(self, session):
+        """
+        Returns a session to the pool once a doc is done with it.
+        """
+        with self.condition:
+            self.in_use -= 1
+            self.idle.append(session)
+            self.condition.notify()
+
+    def discard(self, session):
+        """
+        Gives up the room taken by checkout, closing the session if there
+        is one.
+        """
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+        if session:
+            session.close()
+
+    def close_all(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for session in idle:
+            session.close()
+
+repl_pool = ReplPool()
+atexit.register(repl_pool.close_all)
+
 class PexpectReplFilter(SubprocessFilter):
     """
     Base class for filters which use pexpect to retrieve output line-by-line based on detecting prompts.
     """
+    # Most bytes written at once in batched mode, well below the size of a
+    # terminal's input buffer.
+    max_chunk_size = 1024
+
     _settings = {
             'trim-prompt' : ("The closing prompt to be trimmed off.", '>>>'),
             'send-line-ending' : ("Line ending to transmit at the end of each input line.", "\n"),
@@ -35,6 +123,9 @@ class PexpectReplFilter(SubprocessFilter):
             'strip-regex' : ("Regex to strip", None),
             'output-data-type' : 'sectioned',
             'allow-match-prompt-without-newline' : ("Whether to require a newline before prompt.", False),
+            'reset-command' : ("Command which gives a running REPL a fresh state, with %(wd)s or %(wd)r standing for the working directory to change to. If set, REPL sessions are kept running and reused by later docs, so only set this if the command also undoes anything a doc may change which would affect later docs, such as imported modules.", None),
+            'sentinel-command' : ("Command which prints the strings given as %(head)s and %(tail)s joined together. If set, all lines of a section are sent at once followed by this command, and output is read until the joined string appears, instead of waiting for a prompt after each line.", None),
+            'session-max-uses' : ("Number of docs a pooled REPL session is used for before it is closed and a new one started.", 20),
             }
 
     def is_active(klass):
@@ -124,7 +215,6 @@ class PexpectReplFilter(SubprocessFilter):
         env['TERM'] = self.setting('term')
 
         timeout = self.setup_timeout()
-        initial_timeout = self.setup_initial_timeout()
 
         self.log_debug("timeout set to '%s'" % timeout)
 
@@ -133,6 +223,104 @@ class PexpectReplFilter(SubprocessFilter):
         else:
             wd = os.getcwd()
 
+        session = self.repl_session(wd, env, search_terms)
+        try:
+            for section_key, section_transcript in self.run_sections(session, input_sections, search_terms):
+                yield section_key, section_transcript
+        except BaseException:
+            if session.key:
+                repl_pool.discard(session)
+            else:
+                session.close()
+            raise
+
+        if self.setting('add-new-files'):
+            self.add_new_files()
+
+        if session.key:
+            session.uses += 1
+            if session.uses < self.setting('session-max-uses'):
+                repl_pool.checkin(session)
+            else:
+                repl_pool.discard(session)
+            return
+
+        proc = session.proc
+        try:
+            proc.close()
+        except pexpect.ExceptionPexpect:
+            msg = "process %s may not have closed for %s"
+            msgargs = (proc.pid, self.key)
+            raise UserFeedback(msg % msgargs)
+
+        if proc.exitstatus and self.setting('check-return-code'):
+            self.handle_subprocess_proc_return(self.setting('executable'), proc.exitstatus, session.transcript)
+
+    def session_key(self, wd, env):
+        """
+        Key of pooled REPL sessions this filter can use, or None if sessions
+        of this filter can't be reused.
+        """
+        reset_command = self.setting('reset-command')
+        if not reset_command:
+            return None
+
+        if "%(wd)" in reset_command:
+            # the reset command changes to the working directory
+            wd = None
+
+        return (self.setting('executable'), wd, tuple(sorted(env.items())))
+
+    def repl_session(self, wd, env, search_terms):
+        """
+        Returns a REPL session to run this doc's sections in, reusing an idle
+        pooled session if possible.
+        """
+        key = self.session_key(wd, env)
+        if not key:
+            return self.spawn_session(None, wd, env, search_terms)
+
+        session = repl_pool.checkout(key)
+        if session:
+            if self.reset_session(session, wd, search_terms):
+                self.log_debug("reusing REPL session %s" % session.proc.pid)
+                return session
+            session.close()
+
+        try:
+            return self.spawn_session(key, wd, env, search_terms)
+        except BaseException:
+            repl_pool.discard(None)
+            raise
+
+    def reset_session(self, session, wd, search_terms):
+        """
+        Sends the reset command to a pooled session. Returns False if the
+        session didn't respond with a prompt, or printed anything in response.
+        """
+        reset_command = self.setting('reset-command') % { 'wd' : os.path.abspath(wd) }
+        self.log_debug("resetting REPL session %s" % session.proc.pid)
+        proc = session.proc
+        try:
+            proc.send(reset_command + self.setting('send-line-ending'))
+            self.expect_prompt(proc, search_terms, self.setup_timeout())
+        except pexpect.ExceptionPexpect as e:
+            self.log_debug("could not reset REPL session: %s" % e)
+            return False
+
+        # anything after the line echoing the command means the reset failed
+        response = "\n".join(self.strip_newlines(proc.before).splitlines()[1:])
+        if response.strip():
+            self.log_debug("could not reset REPL session: %s" % response)
+            return False
+
+        return True
+
+    def spawn_session(self, key, wd, env, search_terms):
+        """
+        Starts a new REPL process and waits for its first prompt.
+        """
+        initial_timeout = self.setup_initial_timeout()
         executable = self.setting('executable')
         self.log_debug("about to spawn new process '%s' in '%s'" % (executable, wd))
 
@@ -177,58 +365,145 @@ class PexpectReplFilter(SubprocessFilter):
         self.log_debug(u"Initial prompt captured!")
         self.log_debug(unicode(start))
 
-        for section_key, section_text in input_sections:
-            section_transcript = start
-            start = ""
+        return ReplSession(key, proc, start)
+
+    def expect_prompt(self, proc, search_terms, timeout):
+        if self.setting('prompt-regex'):
+            proc.expect(search_terms, timeout=timeout)
+        else:
+            proc.expect_exact(search_terms, timeout=timeout)
 
+    def run_sections(self, session, input_sections, search_terms):
+        """
+        Sends each section's lines to the REPL session, yielding the section
+        key and transcript of each section.
+        """
+        proc = session.proc
+        start = session.start
+        timeout = self.setup_timeout()
+        session.transcript = ""
+
+        for section_key, section_text in input_sections:
             lines = self.lines_for_section(section_text)
-            for l in lines:
-                self.log_debug(u"Sending '%s'" % l)
-                section_transcript += start
-                proc.send(l.rstrip() + self.setting('send-line-ending'))
-                try:
-                    if self.setting('prompt-regex'):
-                        proc.expect(search_terms, timeout=timeout)
-                    else:
-                        proc.expect_exact(search_terms, timeout=timeout)
-
-                    self.log_debug(u"Received '%s'" % unicode(proc.before, errors='replace'))
-
-                    section_transcript += self.strip_newlines(proc.before)
-                    start = proc.after
-                except pexpect.EOF:
-                    self.log_debug("EOF occurred!")
-                    raise DexyEOFException()
-                except pexpect.TIMEOUT as e:
-                    for c in proc.before:
-                        print ord(c), ":", c
-                    msg = "pexpect timeout error. failed at matching prompt within %s seconds. " % timeout
-                    msg += "received '%s', tried to match with '%s'" % (proc.before, search_terms)
-                    msg += "something may have gone wrong, or you may need to set a longer timeout"
-                    self.log_warn(msg)
-                    raise UserFeedback(msg)
-                except pexpect.ExceptionPexpect as e:
-                    raise UserFeedback(str(e))
-                except pexpect.EOF as e:
-                    raise UserFeedback(str(e))
+            try:
+                if self.setting('sentinel-command'):
+                    transcript, prompt = self.send_batch(proc, lines, search_terms, timeout)
+                else:
+                    transcript, prompt = self.send_lines(proc, lines, search_terms, timeout)
+            except pexpect.EOF:
+                self.log_debug("EOF occurred!")
+                raise DexyEOFException()
+            except pexpect.TIMEOUT as e:
+                self.log_debug("characters received: %s" % ", ".join(str(ord(c)) for c in proc.before))
+                msg = "pexpect timeout error. failed at matching prompt within %s seconds. " % timeout
+                msg += "received '%s', tried to match with '%s'" % (proc.before, search_terms)
+                msg += "something may have gone wrong, or you may need to set a longer timeout"
+                self.log_warn(msg)
+                raise UserFeedback(msg)
+            except pexpect.ExceptionPexpect as e:
+                raise UserFeedback(str(e))
+
+            section_transcript = start + transcript
+            start = prompt
 
             if self.setting('strip-regex'):
                 section_transcript = re.sub(self.setting('strip-regex'), "", section_transcript)
 
+            session.transcript = section_transcript
             yield section_key, section_transcript
 
-        if self.setting('add-new-files'):
-            self.add_new_files()
+    def send_lines(self, proc, lines, search_terms, timeout):
+        """
+        Sends lines one at a time, waiting for a prompt after each. Returns
+        the transcript and the prompt following the last line.
+        """
+        transcript = ""
+        prompt = ""
+        for l in lines:
+            self.log_debug(u"Sending '%s'" % l)
+            transcript += prompt
+            proc.send(l.rstrip() + self.setting('send-line-ending'))
+            self.expect_prompt(proc, search_terms, timeout)
+            self.log_debug(u"Received '%s'" % unicode(proc.before, errors='replace'))
+            transcript += self.strip_newlines(proc.before)
+            prompt = proc.after
+        return transcript, prompt
+
+    def send_batch(self, proc, lines, search_terms, timeout):
+        """
+        Sends lines in as few writes as possible, followed by the sentinel
+        command, and reads until the sentinel is printed. The transcript is
+        everything received before the prompt at which the sentinel command
+        was entered, which is what send_lines would have returned. Returns
+        the transcript and that prompt.
+
+        Each write must reach the REPL while it is waiting at a prompt, since
+        the terminal would echo input arriving while a line runs, so lines
+        are written in chunks which fit in the terminal's input buffer and
+        the prompt after each line of a chunk is read before the next chunk
+        is written.
+        """
+        head = "dexy-sentinel-"
+        tail = uuid.uuid4().hex
+        sentinel_command = self.setting('sentinel-command') % { 'head' : head, 'tail' : tail }
+
+        line_ending = self.setting('send-line-ending')
+        inputs = [l.rstrip() + line_ending for l in lines]
+        inputs.append(sentinel_command + line_ending)
+
+        chunks = [[]]
+        chunk_size = 0
+        for text in inputs:
+            if chunks[-1] and chunk_size + len(text) > self.max_chunk_size:
+                chunks.append([])
+                chunk_size = 0
+            chunks[-1].append(text)
+            chunk_size += len(text)
+
+        self.log_debug(u"Sending %s lines in %s chunks" % (len(lines), len(chunks)))
+
+        received = ""
+        for chunk in chunks[0:-1]:
+            proc.send("".join(chunk))
+            for text in chunk:
+                self.expect_prompt(proc, search_terms, timeout)
+                received += proc.before + proc.after
+
+        last_chunk = chunks[-1]
+        proc.send("".join(last_chunk))
+        proc.expect_exact(head + tail, timeout=timeout * len(last_chunk))
+        received += proc.before
+        self.log_debug(u"Received '%s'" % unicode(received, errors='replace'))
+
+        # consume the prompt following the sentinel
+        self.expect_prompt(proc, search_terms, timeout)
+
+        position, prompt = self.find_last_prompt(received, search_terms)
+        if position is None:
+            raise UserFeedback("no prompt found before sentinel in '%s'" % received)
+
+        return self.strip_newlines(received[0:position]), prompt
+
+    def find_last_prompt(self, text, search_terms):
+        """
+        Returns the position and text of the last prompt in text, or
+        (None, None) if there is none.
+        """
+        position, prompt = None, None
+        for term in search_terms:
+            if self.setting('prompt-regex'):
+                matches = list(re.finditer(term, text))
+                if matches:
+                    start, found = matches[-1].start(), matches[-1].group()
+                else:
+                    start = -1
+            else:
+                start, found = text.rfind(term), term
 
-        try:
-            proc.close()
-        except pexpect.ExceptionPexpect:
-            msg = "process %s may not have closed for %s"
-            msgargs = (proc.pid, self.key)
-            raise UserFeedback(msg % msgargs)
+            if start > -1 and (position is None or start > position):
+                position, prompt = start, found
 
-        if proc.exitstatus and self.setting('check-return-code'):
-            self.handle_subprocess_proc_return(self.setting('executable'), proc.exitstatus, section_transcript)
+        return position, prompt
 
     def process(self):
         self.log_debug("about to populate_workspace")
@@ -308,6 +583,7 @@ class PythonConsole(PexpectReplFilter):
             'input-extensions' : [".txt", ".py"],
             'output-extensions' : ['.pycon'],
             'version-command' : 'python --version',
+            'sentinel-command' : "print('%(head)s' '%(tail)s')",
             'save-vars-to-json-cmd' : """import json
 with open("%s-vars.json", "w") as dexy__vars_file:
     dexy__x = {}
@@ -1,12 +1,31 @@
 from dexy.filter import Filter
+from multiprocessing.pool import ThreadPool
 import dexy.exceptions
+import errno
 import fnmatch
 import json
 import os
 import platform
+import shlex
+import signal
 import subprocess
+import threading
 from dexy.utils import file_exists
 
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+# Characters which mean a command string may use shell features, such as
+# pipes, redirection, variables, globs or escapes, so it is run by a shell.
+SHELL_CHARACTERS = frozenset("|&;<>()$`\\*?[]{}~#!\n")
+
+# Errors from starting a command directly which running it in a shell deals
+# with, e.g. shell builtins, or scripts without a #! line.
+SHELL_FALLBACK_ERRNOS = frozenset((errno.ENOENT, errno.EACCES, errno.ENOEXEC))
+
 class SubprocessFilter(Filter):
     """
     Parent class for all filters which use the subprocess module to run external programs.
@@ -17,9 +36,13 @@ class SubprocessFilter(Filter):
             'check-return-code' : ("Whether to look for nonzero return code.", True),
             'clargs' : ("Arguments to be passed to the executable (same as 'args').", ''),
             'command-string' : ("The full command string.", """%(prog)s %(args)s "%(script_file)s" %(scriptargs)s "%(output_file)s" """),
+            'command-timeout' : ("Seconds after which a command run by this filter is killed. None for no limit.", None),
+            'concurrent' : ("Whether filters which run a process for each section or input may run these processes at the same time. The number of processes running at once is limited by the max-processes option.", True),
+            'cpu-limit' : ("Most CPU seconds a command may use (RLIMIT_CPU), if resource limits are supported. None for no limit.", None),
             'env' : ("Dictionary of key-value pairs to be added to environment for runs.", {}),
             'executable' : ('The executable to be run', None),
             'initial-timeout' : ('', 10),
+            'memory-limit' : ("Most bytes of address space a command may use (RLIMIT_AS), if resource limits are supported. None for no limit.", None),
             'path-extensions' : ("strings to extend path with", []),
             'record-vars' : ("Whether to add code that will automatically record values of variables.", False),
             'scriptargs' : ("Arguments to be passed to the executable.", ''),
@@ -111,7 +134,17 @@ class SubprocessFilter(Filter):
         return self.setting('initial-timeout')
 
     def setup_env(self):
-        env = os.environ
+        """
+        Returns the environment to run commands in. This is a copy of
+        os.environ with this filter's additions, which are worked out once
+        for each filter instance.
+        """
+        if not hasattr(self, '_env'):
+            self._env = self.build_env()
+        return dict(self._env)
+
+    def build_env(self):
+        env = dict(os.environ)
 
         env.update(self.setting('env'))
 
@@ -225,14 +258,46 @@ class SubprocessFilter(Filter):
 
         return doc
 
-    def run_command(self, command, env, input_text=None):
+    def ensure_workspace(self):
         if self.setting('use-wd'):
             ws = self.workspace()
-            if os.path.exists(ws):
+            if self.workspace_is_populated():
                 self.log_debug("already have workspace '%s'" % os.path.abspath(ws))
             else:
                 self.populate_workspace()
 
+    def map_commands(self, fn, items):
+        """
+        Calls fn, which runs a command, for each item and returns the results
+        in the same order as items. If the 'concurrent' setting is True the
+        calls are made from a pool of threads, how many processes actually
+        run at the same time is limited by the wrapper's process semaphore.
+        """
+        items = list(items)
+        workers = min(len(items), self.doc.wrapper.process_limit())
+
+        if not self.setting('concurrent') or workers < 2:
+            return [fn(item) for item in items]
+
+        # populate the workspace once before any of the commands run
+        self.ensure_workspace()
+
+        self.log_debug("running %s commands in %s threads" % (len(items), workers))
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(fn, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def run_command(self, command, env, input_text=None, stdout_file=None):
+        """
+        Runs command and returns the process and its stdout. If stdout_file is
+        given, stdout is written to that file as it is read and None is
+        returned in its place.
+        """
+        self.ensure_workspace()
+
         stdout = subprocess.PIPE
 
         if input_text:
@@ -250,25 +315,193 @@ class SubprocessFilter(Filter):
         else:
             wd = os.getcwd()
 
-        self.log_debug("about to run '%s' in '%s'" % (command, os.path.abspath(wd)))
-        proc = subprocess.Popen(command, shell=True,
-                                    cwd=wd,
-                                    stdin=stdin,
-                                    stdout=stdout,
-                                    stderr=stderr,
-                                    env=env)
+        popen_kwargs = {
+                'cwd' : wd,
+                'stdin' : stdin,
+                'stdout' : stdout,
+                'stderr' : stderr,
+                'env' : env,
+                'preexec_fn' : self.preexec_fn()
+                }
 
-        if input_text:
-            self.log_debug("about to send input_text '%s'" % input_text)
+        with self.doc.wrapper.process_semaphore:
+            self.log_debug("about to run '%s' in '%s'" % (command, os.path.abspath(wd)))
+            args = self.command_args(command)
+            try:
+                if args:
+                    proc = subprocess.Popen(args, **popen_kwargs)
+                else:
+                    proc = subprocess.Popen(command, shell=True, **popen_kwargs)
+            except OSError as e:
+                if not args or not e.errno in SHELL_FALLBACK_ERRNOS:
+                    raise
+                # let the shell run it, or fail with its usual exit status
+                self.log_debug("running '%s' in a shell: %s" % (command, e))
+                proc = subprocess.Popen(command, shell=True, **popen_kwargs)
+
+            if input_text:
+                self.log_debug("about to send input_text '%s'" % input_text)
 
-        stdout, stderr = proc.communicate(input_text)
-        self.log_debug(u"stdout is '%s'" % stdout.decode('utf-8'))
+            stdout, stderr = self.communicate(command, proc, input_text, stdout_file)
+
+        if stdout_file:
+            self.log_debug(u"stdout written to '%s'" % stdout_file)
+        else:
+            self.log_debug(u"stdout is '%s'" % self.log_excerpt(stdout))
 
         if stderr:
-            self.log_debug(u"stderr is '%s'" % stderr.decode('utf-8'))
+            self.log_debug(u"stderr is '%s'" % self.log_excerpt(stderr))
 
         return (proc, stdout)
 
+    def command_args(self, command):
+        """
+        Returns command split into a list of arguments, so it can be run
+        without starting a shell, or None if command may use shell features.
+        """
+        if platform.system() == 'Windows' or SHELL_CHARACTERS.intersection(command):
+            return None
+
+        if isinstance(command, unicode):
+            command = command.encode('utf-8')
+
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            return None
+
+        if not args or "=" in args[0]:
+            # empty, or starts by setting a variable
+            return None
+
+        return args
+
+    def log_excerpt(self, output, max_length=4096):
+        if len(output) > max_length:
+            output = "%s... (%s bytes)" % (output[0:max_length], len(output))
+        return output.decode('utf-8', 'replace')
+
+    def preexec_fn(self):
+        """
+        Returns a function to run in the child process before the command
+        starts, or None if nothing needs to be done. If there's a timeout the
+        command gets its own process group, so anything it starts can be
+        killed along with it.
+        """
+        if platform.system() == 'Windows':
+            return None
+
+        timeout = self.setting('command-timeout')
+        limits = []
+        if RESOURCE_AVAILABLE:
+            if self.setting('cpu-limit'):
+                limits.append((resource.RLIMIT_CPU, int(self.setting('cpu-limit'))))
+            if self.setting('memory-limit'):
+                limits.append((resource.RLIMIT_AS, int(self.setting('memory-limit'))))
+
+        if not timeout and not limits:
+            return None
+
+        def preexec():
+            if timeout:
+                os.setsid()
+            for limit, value in limits:
+                resource.setrlimit(limit, (value, value))
+
+        return preexec
+
+    def kill(self, proc):
+        try:
+            if self.setting('command-timeout') and platform.system() != 'Windows':
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except OSError:
+            # process already finished
+            pass
+
+    def communicate(self, command, proc, input_text, stdout_file):
+        """
+        Like proc.communicate, but kills the process if it runs longer than
+        the 'command-timeout' setting and can write stdout to a file in
+        chunks instead of keeping it in memory. Input is written and stderr
+        read in separate threads while stdout is read. Returns stdout (or None
+        if it was written to stdout_file) and stderr.
+        """
+        threads = []
+        stderr_chunks = []
+
+        if input_text:
+            def write_input():
+                try:
+                    proc.stdin.write(input_text)
+                except IOError as e:
+                    # the process may exit without reading all of its input
+                    if e.errno != errno.EPIPE:
+                        raise
+                finally:
+                    proc.stdin.close()
+            threads.append(threading.Thread(target=write_input))
+
+        if proc.stderr:
+            def read_stderr():
+                stderr_chunks.append(proc.stderr.read())
+            threads.append(threading.Thread(target=read_stderr))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        timed_out = []
+        timeout = self.setting('command-timeout')
+        if timeout:
+            def on_timeout():
+                timed_out.append(True)
+                self.kill(proc)
+            timer = threading.Timer(timeout, on_timeout)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            if stdout_file:
+                stdout = None
+                with open(stdout_file, "wb") as f:
+                    for chunk in iter(lambda: proc.stdout.read(65536), ''):
+                        f.write(chunk)
+            else:
+                stdout = proc.stdout.read()
+
+            for thread in threads:
+                thread.join()
+            proc.wait()
+        finally:
+            if timeout:
+                timer.cancel()
+
+        proc.stdout.close()
+        if proc.stderr:
+            proc.stderr.close()
+
+        if timed_out:
+            msg = "The command '%s' for %s was killed after running for %s seconds, the limit set by command-timeout."
+            raise dexy.exceptions.UserFeedback(msg % (command, self.key, timeout))
+
+        return stdout, "".join(stderr_chunks) or None
+
+    def stdout_file(self):
+        """
+        Location in the work dir to write stdout to before it is stored as
+        this filter's output.
+        """
+        stdout_dir = os.path.join(self.doc.wrapper.work_cache_dir(), "stdout")
+        if not os.path.exists(stdout_dir):
+            try:
+                os.makedirs(stdout_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return os.path.join(stdout_dir, "%s%s" % (self.output_data.storage_key, self.output_data.ext))
+
     def copy_canonical_file(self):
         canonical_file = os.path.join(self.workspace(), self.output_data.name)
         if not self.output_data.is_cached() and file_exists(canonical_file):
@@ -286,9 +519,16 @@ class SubprocessStdoutFilter(SubprocessFilter):
 
     def process(self):
         command = self.command_string()
-        proc, stdout = self.run_command(command, self.setup_env())
+        stdout_file = self.stdout_file()
+        proc, stdout = self.run_command(command, self.setup_env(), stdout_file=stdout_file)
+
+        if proc.returncode:
+            with open(stdout_file, "rb") as f:
+                stdout = f.read()
         self.handle_subprocess_proc_return(command, proc.returncode, stdout)
-        self.output_data.set_data(stdout)
+
+        self.output_data.copy_from_file(stdout_file)
+        os.remove(stdout_file)
 
         if self.setting('walk-working-dir'):
             self.walk_working_directory()
@@ -364,19 +604,31 @@ class SubprocessInputFilter(SubprocessFilter):
 
     def process(self):
         command = self.command_string()
+        env = self.setup_env()
 
         inputs = list(self.doc.walk_input_docs())
 
         if len(inputs) == 1:
             doc = inputs[0]
-            for section_name, section_input in doc.output_data().iteritems():
-                proc, stdout = self.run_command(command, self.setup_env(), unicode(section_input))
+            sections = [(section_name, unicode(section_input))
+                    for section_name, section_input in doc.output_data().iteritems()]
+
+            def run_section(section):
+                proc, stdout = self.run_command(command, env, section[1])
+                return stdout
+
+            for (section_name, _), stdout in zip(sections, self.map_commands(run_section, sections)):
                 self.output_data[section_name] = stdout
         else:
-            for doc in inputs:
-                proc, stdout = self.run_command(command, self.setup_env(), unicode(doc.output_data()))
+            doc_inputs = [(doc.key, unicode(doc.output_data())) for doc in inputs]
+
+            def run_doc(doc_input):
+                proc, stdout = self.run_command(command, env, doc_input[1])
                 self.handle_subprocess_proc_return(command, proc.returncode, stdout)
-                self.output_data[doc.key] = stdout
+                return stdout
+
+            for (doc_key, _), stdout in zip(doc_inputs, self.map_commands(run_doc, doc_inputs)):
+                self.output_data[doc_key] = stdout
 
         self.output_data.save()
 
@@ -401,12 +653,19 @@ class SubprocessInputFileFilter(SubprocessFilter):
 
     def process(self):
         self.populate_workspace()
+        env = self.setup_env()
+
+        commands = [(doc.key, self.command_string_for_input(doc))
+                for doc in self.doc.walk_input_docs()]
 
-        for doc in self.doc.walk_input_docs():
-            command = self.command_string_for_input(doc)
-            proc, stdout = self.run_command(command, self.setup_env())
+        def run_doc(doc_command):
+            command = doc_command[1]
+            proc, stdout = self.run_command(command, env)
             self.handle_subprocess_proc_return(command, proc.returncode, stdout)
-            self.output_data[doc.key] = stdout
+            return stdout
+
+        for (doc_key, _), stdout in zip(commands, self.map_commands(run_doc, commands)):
+            self.output_data[doc_key] = stdout
 
         self.output_data.save()
 
@@ -427,20 +686,24 @@ class SubprocessCompileInputFilter(SubprocessCompileFilter):
         self.handle_subprocess_proc_return(command, proc.returncode, stdout)
 
         command = self.run_command_string()
+        env = self.setup_env()
 
         inputs = list(self.doc.walk_input_docs())
 
         if len(inputs) == 1:
             doc = inputs[0]
-            for section_name, section_input in doc.output_data().iteritems():
-                proc, stdout = self.run_command(command, self.setup_env(), section_input)
-                self.handle_subprocess_proc_return(command, proc.returncode, stdout)
-                self.output_data[section_name] = stdout
+            runs = [(section_name, unicode(section_input))
+                    for section_name, section_input in doc.output_data().iteritems()]
         else:
-            for doc in inputs:
-                proc, stdout = self.run_command(command, self.setup_env(), unicode(doc.output_data()))
-                self.handle_subprocess_proc_return(command, proc.returncode, stdout)
-                self.output_data[doc.key] = stdout
+            runs = [(doc.key, unicode(doc.output_data())) for doc in inputs]
+
+        def run_input(run):
+            proc, stdout = self.run_command(command, env, run[1])
+            self.handle_subprocess_proc_return(command, proc.returncode, stdout)
+            return stdout
+
+        for (key, _), stdout in zip(runs, self.map_commands(run_input, runs)):
+            self.output_data[key] = stdout
 
         self.output_data.save()
 
@@ -40,7 +40,7 @@ class PythonTest(PythonIntrospection):
                 "Path from package dir to tests dir.",
                 "../tests"),
             'chdir' : (
-                "Path from package dir to chdir to.",
+                "Path from package dir to chdir to. Changes the working dir of the whole dexy process, so can't be used when running more than one job.",
                 None),
             'nose-argv' : (
                 "Need to fake out argv since sys.argv will be args for dexy, not nose.",
@@ -121,6 +121,10 @@ class PythonTest(PythonIntrospection):
         orig_wd = os.path.abspath(".")
         chdir = self.setting('chdir')
 
+        if chdir and self.doc.wrapper.jobs > 1:
+            msg = "The 'chdir' setting of the %s filter changes dir for all jobs, run with -jobs 1 to use it."
+            raise dexy.exceptions.UserFeedback(msg % self.alias)
+
         for module_name in module_names:
             tests = self.load_tests(module_name)
 
@@ -119,6 +119,7 @@ class RIntBatchSectionsFilter(SubprocessFilter):
 
     _settings = {
             'add-new-files' : True,
+            'concurrent' : ("Whether sections may run at the same time. R CMD BATCH saves and restores the R workspace in .RData, so only set this if sections don't depend on objects created by earlier sections.", False),
             'executable' : 'R CMD BATCH --quiet --no-timing',
             'tags' : ['rstats', 'repl', 'stats'],
             'input-extensions' : ['.txt', '.r', '.R'],
@@ -148,13 +149,22 @@ class RIntBatchSectionsFilter(SubprocessFilter):
         self.populate_workspace()
         wd = self.parent_work_dir()
 
-        for section_name, section_text in self.input_data.iteritems():
-            command, outfile = self.command_string(section_name, section_text, wd)
-            proc, stdout = self.run_command(command, self.setup_env())
+        env = self.setup_env()
+
+        # script files are written before any commands run
+        runs = [(section_name,) + self.command_string(section_name, section_text, wd)
+                for section_name, section_text in self.input_data.iteritems()]
+
+        def run_section(run):
+            section_name, command, outfile = run
+            proc, stdout = self.run_command(command, env)
             self.handle_subprocess_proc_return(command, proc.returncode, stdout)
 
             with open(os.path.join(wd, outfile), "rb") as f:
-                self.output_data[section_name] = f.read()
+                return f.read()
+
+        for (section_name, _, _), output in zip(runs, self.map_commands(run_section, runs)):
+            self.output_data[section_name] = output
 
         if self.setting('walk-working-dir'):
             self.walk_working_directory()
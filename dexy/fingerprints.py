@@ -0,0 +1,64 @@
+import os
+
+class Fingerprints(object):
+    """
+    Persistent index of file fingerprints (size, mtime, digest), so a file's
+    contents only need to be hashed again if its size or mtime has changed.
+    """
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.saved = {}
+        self.current = {}
+
+    def filepath(self):
+        return os.path.join(self.wrapper.artifacts_dir, 'fingerprints.pickle')
+
+    def load(self):
+        try:
+            with open(self.filepath(), 'rb') as f:
+                pickle = self.wrapper.pickle_lib()
+                info = pickle.load(f)
+        except IOError:
+            info = {}
+
+        # Digests made with a different hash function can't be compared.
+        if info.get('hashfunction') == self.wrapper.hashfunction:
+            self.saved = info['fingerprints']
+        else:
+            self.saved = {}
+
+    def save(self):
+        """
+        Only entries which were looked up during this run are saved, so
+        entries for deleted files don't accumulate.
+        """
+        with open(self.filepath(), 'wb') as f:
+            pickle = self.wrapper.pickle_lib()
+            info = {
+                    'hashfunction' : self.wrapper.hashfunction,
+                    'fingerprints' : self.current
+                    }
+            pickle.dump(info, f)
+
+    def digest(self, key, filepath, stat_info=None, hash_fn=None):
+        """
+        Returns the digest of the file at filepath, stored under key. Reuses
+        the digest from the index if size and mtime are unchanged. hash_fn,
+        if given, is called with filepath to work out the digest instead of
+        hashing the file's contents.
+        """
+        if stat_info is None:
+            stat_info = os.stat(filepath)
+
+        size = stat_info.st_size
+        mtime = stat_info.st_mtime
+
+        fingerprint = self.current.get(key) or self.saved.get(key)
+
+        if fingerprint and fingerprint[0] == size and fingerprint[1] == mtime:
+            digest = fingerprint[2]
+        else:
+            digest = (hash_fn or self.wrapper.hash_file)(filepath)
+
+        self.current[key] = (size, mtime, digest)
+        return digest
@@ -0,0 +1,266 @@
+import os
+import re
+import sqlite3
+import threading
+
+class KeyValueStore(object):
+    """
+    Project-wide sqlite3 database holding the data of all sqlite3 key value
+    storage, in one table keyed by storage key. The kvdocs table records
+    which storage keys hold complete data, and in which cache generation
+    they were last used.
+
+    Rows are inserted in batches and committed once at the end of a run.
+    """
+    batch_size = 1000
+    schema_version = 1
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.lock = threading.RLock()
+        self.pending = []
+        self._connection = None
+        # number of changes made in this process to each storage key, and
+        # the change count and file stat of each file exported
+        self.versions = {}
+        self.exported = {}
+
+    def filepath(self):
+        return os.path.join(self.wrapper.artifacts_dir, 'kvstore.sqlite3')
+
+    def generation(self):
+        return self.wrapper.cache_manifest.generation
+
+    def connection(self):
+        if not self._connection:
+            # Connection is shared between scheduler threads, access is
+            # serialized by self.lock.
+            conn = sqlite3.connect(self.filepath(), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < self.schema_version:
+                self.migrate(conn, version)
+            self._connection = conn
+        return self._connection
+
+    def migrate(self, conn, version):
+        """
+        Brings the database schema from version up to schema_version.
+        """
+        conn.execute("CREATE TABLE IF NOT EXISTS kvstore (storage_key TEXT, key TEXT, value TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS kvstore_storage_key_key ON kvstore (storage_key, key)")
+        conn.execute("CREATE TABLE IF NOT EXISTS kvdocs (storage_key TEXT PRIMARY KEY, generation INTEGER)")
+        conn.execute("PRAGMA user_version = %d" % self.schema_version)
+        conn.commit()
+
+    def flush(self):
+        """
+        Inserts any rows which have been appended but not yet inserted.
+        """
+        with self.lock:
+            if self.pending:
+                self.connection().executemany(
+                        "INSERT INTO kvstore VALUES (?, ?, ?)", self.pending)
+                self.pending = []
+
+    def execute(self, sql, args=()):
+        """
+        Runs a query against the store, after inserting pending rows, and
+        returns all resulting rows.
+        """
+        with self.lock:
+            self.flush()
+            return self.connection().execute(sql, args).fetchall()
+
+    def commit(self):
+        with self.lock:
+            self.flush()
+            if self._connection:
+                self._connection.commit()
+
+    def close(self):
+        with self.lock:
+            if self._connection:
+                self.commit()
+                self._connection.close()
+                self._connection = None
+
+    def changed(self, storage_key):
+        self.versions[storage_key] = self.versions.get(storage_key, 0) + 1
+
+    def check_value(self, value):
+        """
+        Raises the error sqlite3 would raise on insert for 8-bit strings, so
+        that a bad value is reported when it is appended instead of failing
+        the whole batch when it is inserted.
+        """
+        if isinstance(value, str):
+            try:
+                value.decode('ascii')
+            except UnicodeDecodeError:
+                msg = "You must not use 8-bit bytestrings, use unicode instead."
+                raise sqlite3.ProgrammingError(msg)
+
+    def append(self, storage_key, key, value):
+        self.check_value(key)
+        self.check_value(value)
+        with self.lock:
+            self.changed(storage_key)
+            self.pending.append((storage_key, key, value))
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def append_many(self, storage_key, items):
+        """
+        Appends an iterable of (key, value) pairs.
+        """
+        rows = []
+        for key, value in items:
+            self.check_value(key)
+            self.check_value(value)
+            rows.append((storage_key, key, value))
+
+        with self.lock:
+            self.changed(storage_key)
+            self.flush()
+            self.connection().executemany("INSERT INTO kvstore VALUES (?, ?, ?)", rows)
+
+    def has(self, storage_key):
+        """
+        Returns a boolean indicating whether complete data is stored for
+        storage_key.
+        """
+        rows = self.execute("SELECT 1 FROM kvdocs WHERE storage_key = ?", (storage_key,))
+        return len(rows) > 0
+
+    def finish(self, storage_key):
+        """
+        Marks the data for storage_key as complete.
+        """
+        self.execute("INSERT OR REPLACE INTO kvdocs VALUES (?, ?)",
+                (storage_key, self.generation()))
+
+    def delete(self, storage_key):
+        with self.lock:
+            self.changed(storage_key)
+            self.pending = [row for row in self.pending if row[0] != storage_key]
+            self.execute("DELETE FROM kvstore WHERE storage_key = ?", (storage_key,))
+            self.execute("DELETE FROM kvdocs WHERE storage_key = ?", (storage_key,))
+
+    def claim(self, storage_key, remove_stale=False):
+        """
+        Marks the data for storage_key as belonging to the current cache
+        generation. If remove_stale is True, complete data left over from a
+        previous generation is removed instead. Data which is still being
+        written is not affected.
+        """
+        with self.lock:
+            rows = self.execute("SELECT generation FROM kvdocs WHERE storage_key = ?", (storage_key,))
+            if not rows:
+                return
+            elif remove_stale and rows[0][0] != self.generation():
+                self.delete(storage_key)
+            else:
+                self.execute("UPDATE kvdocs SET generation = ? WHERE storage_key = ?",
+                        (self.generation(), storage_key))
+
+    def collect_garbage(self):
+        """
+        Removes data which was not used in the current cache generation.
+        Returns the number of storage keys removed.
+        """
+        if not os.path.exists(self.filepath()):
+            return 0
+
+        with self.lock:
+            generation = self.generation()
+            stale = self.execute("SELECT storage_key FROM kvdocs WHERE generation != ?", (generation,))
+            self.execute("DELETE FROM kvdocs WHERE generation != ?", (generation,))
+            self.execute("""DELETE FROM kvstore WHERE storage_key NOT IN
+                (SELECT storage_key FROM kvdocs)""")
+            return len(stale)
+
+    def rows(self, storage_key):
+        return self.execute("SELECT key, value FROM kvstore WHERE storage_key = ? ORDER BY rowid",
+                (storage_key,))
+
+    def glob_rows(self, storage_key, pattern):
+        """
+        Returns (key, value) rows whose key matches the glob pattern, in key
+        order. The part of the pattern before the first wildcard is used to
+        restrict the search to a range of the index.
+        """
+        pattern = unicode(pattern)
+        literal = re.split(r"[*?[]", pattern, 1)[0]
+
+        sql = "SELECT key, value FROM kvstore WHERE storage_key = ? AND key GLOB ?"
+        args = [storage_key, pattern]
+
+        if literal:
+            sql += " AND key >= ?"
+            args.append(literal)
+            try:
+                upper = literal[:-1] + unichr(ord(literal[-1]) + 1)
+                sql += " AND key < ?"
+                args.append(upper)
+            except ValueError:
+                # no upper bound for a prefix ending in the last code point
+                pass
+
+        return self.execute(sql + " ORDER BY key", args)
+
+    def prefix_rows(self, storage_key, prefix):
+        """
+        Returns (key, value) rows whose key starts with prefix, in key order.
+        """
+        escaped = re.sub(r"([*?[])", r"[\1]", unicode(prefix))
+        return self.glob_rows(storage_key, escaped + "*")
+
+    def export(self, storage_key, filepath):
+        """
+        Writes the data for storage_key to a standalone sqlite3 database file
+        at filepath, with a kvstore (key, value) table.
+        """
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+        conn = sqlite3.connect(filepath)
+        try:
+            conn.execute("CREATE TABLE kvstore (key TEXT, value TEXT)")
+            conn.executemany("INSERT INTO kvstore VALUES (?, ?)", self.rows(storage_key))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def export_if_stale(self, storage_key, filepath):
+        """
+        Exports the data for storage_key to filepath unless it was already
+        exported there, and neither the data nor the file have changed since.
+        """
+        with self.lock:
+            version = self.versions.get(storage_key, 0)
+            try:
+                stat_info = os.stat(filepath)
+                file_stat = (stat_info.st_size, stat_info.st_mtime)
+            except OSError:
+                file_stat = None
+
+            if file_stat is None or self.exported.get(filepath) != (storage_key, version, file_stat):
+                self.export(storage_key, filepath)
+                stat_info = os.stat(filepath)
+                file_stat = (stat_info.st_size, stat_info.st_mtime)
+                self.exported[filepath] = (storage_key, version, file_stat)
+
+    def import_file(self, storage_key, filepath):
+        """
+        Appends the rows of the kvstore table in the sqlite3 database file at
+        filepath to the data for storage_key.
+        """
+        conn = sqlite3.connect(filepath)
+        try:
+            rows = conn.execute("SELECT key, value FROM kvstore").fetchall()
+        finally:
+            conn.close()
+
+        for key, value in rows:
+            self.append(storage_key, key, value)
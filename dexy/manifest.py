@@ -0,0 +1,118 @@
+import os
+
+class CacheManifest(object):
+    """
+    Records which generation (run number) last used each file in the cache
+    dir, so cache files can stay in place between runs and only files which
+    weren't used in the current generation need to be removed.
+    """
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.generation = 1
+        self.files = {}
+        self.encodings = {}
+        self.full_scan = True
+
+    def filepath(self):
+        return os.path.join(self.wrapper.artifacts_dir, 'cache-manifest.pickle')
+
+    def load(self):
+        """
+        Loads the manifest from the previous run and starts a new generation.
+        If there is no manifest, the cache dir may contain files we don't know
+        about, so the whole cache dir will be scanned when collecting garbage.
+        """
+        try:
+            with open(self.filepath(), 'rb') as f:
+                pickle = self.wrapper.pickle_lib()
+                info = pickle.load(f)
+            self.generation = info['generation'] + 1
+            self.files = info['files']
+            self.encodings = info.get('encodings', {})
+            self.full_scan = info.get('full-scan', False)
+        except IOError:
+            self.generation = 1
+            self.files = {}
+            self.encodings = {}
+            self.full_scan = True
+
+    def save(self):
+        """
+        Saves the manifest. If garbage hasn't been collected yet, the next
+        run still scans the whole cache dir.
+        """
+        tmp = "%s.tmp" % self.filepath()
+        with open(tmp, 'wb') as f:
+            pickle = self.wrapper.pickle_lib()
+            info = {
+                    'generation' : self.generation,
+                    'files' : self.files,
+                    'encodings' : self.encodings,
+                    'full-scan' : self.full_scan
+                    }
+            pickle.dump(info, f)
+        os.rename(tmp, self.filepath())
+
+    def is_current(self, filepath):
+        return self.files.get(os.path.normpath(filepath)) == self.generation
+
+    def claim(self, filepath, remove_stale=False):
+        """
+        Marks filepath as belonging to the current generation. If
+        remove_stale is True, a file left over from a previous generation is
+        removed first.
+        """
+        if remove_stale and not self.is_current(filepath):
+            if os.path.exists(filepath):
+                self.wrapper.log.debug("Removing stale cache file %s" % filepath)
+                os.remove(filepath)
+        self.files[os.path.normpath(filepath)] = self.generation
+
+    def file_encoding(self, filepath, detect):
+        """
+        Returns the text encoding of the cache file at filepath. The encoding
+        is remembered along with the file's size and mtime, so detect() is
+        only called if the file has changed since its encoding was detected.
+        """
+        try:
+            stat_info = os.stat(filepath)
+        except OSError:
+            return detect()
+
+        key = os.path.normpath(filepath)
+        fingerprint = (stat_info.st_size, stat_info.st_mtime)
+
+        entry = self.encodings.get(key)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+
+        encoding = detect()
+        self.encodings[key] = (fingerprint, encoding)
+        return encoding
+
+    def collect_garbage(self):
+        """
+        Removes cache files which were not claimed in the current generation.
+        """
+        stale = [f for f, g in self.files.iteritems() if g != self.generation]
+
+        for filepath in stale:
+            del self.files[filepath]
+            self.encodings.pop(filepath, None)
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
+        if self.full_scan:
+            cache_dir = self.wrapper.cache_dir()
+            for dirpath, dirnames, filenames in os.walk(cache_dir):
+                for filename in filenames:
+                    filepath = os.path.normpath(os.path.join(dirpath, filename))
+                    if not filepath in self.files:
+                        os.remove(filepath)
+                        self.encodings.pop(filepath, None)
+                        stale.append(filepath)
+            self.full_scan = False
+
+        return len(stale)
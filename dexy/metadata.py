@@ -0,0 +1,220 @@
+import os
+import struct
+import threading
+
+class MetadataStore(object):
+    """
+    Append-only log of the metadata kept between runs: batch info, runtime
+    args of docs and arg strings of nodes.
+
+    Each record is a (kind, key, value) tuple, pickled and prefixed with its
+    length. The whole log is read in one go by load() and replayed into
+    dicts, later records replacing earlier ones. New records are buffered
+    and appended by save(), which rewrites the log without superseded
+    records once they make up most of the file.
+    """
+    header = struct.Struct(">I")
+    min_records_to_compact = 100
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.batches = {}
+        self.most_recent_batch = None
+        self.node_args = {}
+        self.runtime = {}
+        self.claimed = set()
+        self.pending = []
+        self.records = 0
+        self.valid_size = 0
+
+    def filepath(self):
+        return os.path.join(self.wrapper.artifacts_dir, 'metadata.log')
+
+    def load(self):
+        with self.lock:
+            self.reset()
+            records, self.valid_size, size = self.read_records()
+            for record in records:
+                self.apply(*record)
+            self.records = len(records)
+
+            if self.valid_size < size:
+                self.wrapper.log.warn("ignoring incomplete records at end of %s" % self.filepath())
+
+    def read_records(self):
+        """
+        Returns the complete records in the log, the size of the part of the
+        log holding them and the size of the whole log.
+        """
+        try:
+            with open(self.filepath(), 'rb') as f:
+                raw = f.read()
+        except IOError:
+            return [], 0, 0
+
+        pickle = self.wrapper.pickle_lib()
+        records = []
+        offset = 0
+        while offset + self.header.size <= len(raw):
+            size = self.header.unpack_from(raw, offset)[0]
+            start = offset + self.header.size
+            if start + size > len(raw):
+                # Record cut short by an interrupted write.
+                break
+            try:
+                record = pickle.loads(raw[start:start+size])
+            except Exception:
+                break
+            records.append(record)
+            offset = start + size
+
+        return records, offset, len(raw)
+
+    def apply(self, kind, key, value):
+        if kind == 'batch':
+            self.batches[key] = value
+            self.most_recent_batch = key
+        elif kind == 'node-args':
+            self.node_args = value
+        elif kind == 'runtime':
+            if value is None:
+                self.runtime.pop(key, None)
+            else:
+                self.runtime[key] = value
+
+    def append(self, kind, key, value):
+        with self.lock:
+            self.apply(kind, key, value)
+            self.pending.append((kind, key, value))
+
+    def live_records(self):
+        """
+        Returns the records needed to reproduce the current state. Only the
+        most recent batch is kept, and runtime info of docs which were not
+        claimed since the store was loaded is dropped.
+        """
+        records = []
+        if self.most_recent_batch:
+            batch_id = self.most_recent_batch
+            records.append(('batch', batch_id, self.batches[batch_id]))
+        if self.node_args:
+            records.append(('node-args', None, self.node_args))
+        for key in sorted(self.runtime):
+            if key in self.claimed:
+                records.append(('runtime', key, self.runtime[key]))
+        return records
+
+    def save(self):
+        """
+        Appends pending records to the log, or rewrites the log if it is
+        mostly made up of superseded records.
+
+        If the log has changed since it was loaded, because another process
+        has saved records too or a write was interrupted, the complete
+        records in it are kept and the pending records are added after them.
+        """
+        with self.lock:
+            if not self.pending:
+                return
+
+            pickle = self.wrapper.pickle_lib()
+
+            try:
+                size = os.path.getsize(self.filepath())
+            except OSError:
+                size = 0
+
+            total = self.records + len(self.pending)
+            live = self.live_records()
+
+            if size != self.valid_size:
+                self.rewrite(self.merge(), pickle)
+            elif total > self.min_records_to_compact and total > 2 * len(live):
+                self.rewrite(live, pickle)
+            else:
+                with open(self.filepath(), 'ab') as f:
+                    self.valid_size += self.write_records(f, self.pending, pickle)
+                self.records = total
+
+            self.pending = []
+
+    def merge(self):
+        """
+        Reads the log again and replays the pending records after the
+        records in it. Returns the combined records. Runtime info saved by
+        other processes since the log was loaded counts as claimed, so it
+        isn't dropped when the log is next compacted.
+        """
+        records = self.read_records()[0] + self.pending
+        runtime = self.runtime
+        claimed = self.claimed
+        self.reset()
+        for kind, key, value in records:
+            self.apply(kind, key, value)
+            if kind == 'runtime' and value is not None and runtime.get(key) != value:
+                claimed.add(key)
+        self.claimed = claimed
+        return records
+
+    def rewrite(self, records, pickle):
+        tmp = "%s.tmp" % self.filepath()
+        with open(tmp, 'wb') as f:
+            size = self.write_records(f, records, pickle)
+        os.rename(tmp, self.filepath())
+        self.records = len(records)
+        self.valid_size = size
+
+    def write_records(self, f, records, pickle):
+        chunks = []
+        for record in records:
+            payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            chunks.append(self.header.pack(len(payload)))
+            chunks.append(payload)
+        data = "".join(chunks)
+        f.write(data)
+        return len(data)
+
+    # Batches
+    def save_batch(self, batch_id, info):
+        self.append('batch', batch_id, info)
+
+    def batch_info(self, batch_id=None):
+        """
+        Returns the info saved for batch_id, or for the most recent batch if
+        batch_id is None.
+        """
+        return self.batches.get(batch_id or self.most_recent_batch)
+
+    # Node args
+    def save_node_args(self, node_args):
+        if node_args != self.node_args:
+            self.append('node-args', None, node_args)
+
+    # Runtime info
+    def claim_runtime_info(self, doc_key, remove_stale=False):
+        """
+        Marks the runtime info of doc_key as still in use. If remove_stale is
+        True, info saved before this run is removed instead.
+        """
+        with self.lock:
+            if remove_stale and not doc_key in self.claimed and doc_key in self.runtime:
+                self.append('runtime', doc_key, None)
+            self.claimed.add(doc_key)
+
+    def save_runtime_info(self, doc_key, hashid, info):
+        with self.lock:
+            self.claimed.add(doc_key)
+            self.append('runtime', doc_key, (hashid, info))
+
+    def runtime_info(self, doc_key, hashid):
+        """
+        Returns the runtime info saved for doc_key, or None if there is none
+        or it was saved for different doc args.
+        """
+        entry = self.runtime.get(doc_key)
+        if entry and entry[0] == hashid:
+            return entry[1]
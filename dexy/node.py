@@ -1,4 +1,3 @@
-from dexy.utils import md5_hash
 from dexy.utils import os_to_posix
 import dexy.doc
 import dexy.plugin
@@ -39,8 +38,9 @@ class Node(dexy.plugin.Plugin):
         self.runtime_args = {}
         self.children = []
         self.additional_docs = []
+        self._walked_inputs = None
 
-        self.hashid = md5_hash(self.key)
+        self.hashid = self.wrapper.hash_text(self.key)
 
         self.state = 'new'
 
@@ -72,20 +72,32 @@ class Node(dexy.plugin.Plugin):
 
     def walk_inputs(self):
         """
-        Yield all direct inputs and their inputs.
+        Returns all direct inputs and their inputs, each node appearing once,
+        in the order in which they are first reached. The result is cached
+        until the graph changes via add_additional_doc.
         """
-        children = []
-        def walk(inputs):
-            for inpt in inputs:
-                children.append(inpt)
-                walk(inpt.inputs + inpt.children)
+        graph_version = self.wrapper.graph_version
+        if self._walked_inputs and self._walked_inputs[0] == graph_version:
+            return list(self._walked_inputs[1])
 
         if self.inputs:
-            walk(self.inputs)
+            children = []
+            seen = set()
+            stack = list(reversed(self.inputs))
+            while stack:
+                inpt = stack.pop()
+                if id(inpt) in seen:
+                    continue
+                seen.add(id(inpt))
+                children.append(inpt)
+                stack.extend(reversed(inpt.inputs + inpt.children))
         elif hasattr(self, 'parent'):
             children = self.parent.walk_inputs()
+        else:
+            children = []
 
-        return children
+        self._walked_inputs = (graph_version, children)
+        return list(children)
 
     def walk_input_docs(self):
         """
@@ -171,6 +183,7 @@ class Node(dexy.plugin.Plugin):
         self.log_debug("adding additional doc '%s'" % doc.key)
         doc.created_by_doc = self
         self.children.append(doc)
+        self.wrapper.graph_version += 1
         self.wrapper.add_node(doc)
         self.wrapper.batch.add_doc(doc)
         self.additional_docs.append(doc)
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import copy
 import dexy.doc
 import dexy.exceptions
@@ -11,12 +12,33 @@ class AbstractSyntaxTree():
         self.root_nodes_ordered = False
 
         self.lookup_table = {}
-        self.tree = []
+
+        # Keys which are not inputs of any other node, in the order in which
+        # they were first added. Values are unused, this is an ordered set.
+        self.root_keys = OrderedDict()
+        # All keys identified as inputs of some other node.
+        self.input_keys = set()
 
         # Lists of (directory, settings) tuples
         self.default_args_for_directory = []
         self.environment_for_directory = []
 
+    def __getstate__(self):
+        """
+        The wrapper is not pickled with a cached AST, it is set again when the
+        AST is loaded.
+        """
+        state = self.__dict__.copy()
+        del state['wrapper']
+        return state
+
+    @property
+    def tree(self):
+        """
+        List of root node keys (nodes which are not inputs of another node).
+        """
+        return list(self.root_keys)
+
     def all_inputs(self):
         """
         Returns a set of all node keys identified as inputs of some other
@@ -30,14 +52,13 @@ class AbstractSyntaxTree():
 
     def clean_tree(self):
         """
-        Removes tasks which are already represented as inputs (tree should
-        only contain root nodes).
+        Recalculates input_keys from the lookup table and removes any keys
+        which are inputs from the root keys. Only needed if inputs have been
+        set directly rather than via add_dependency.
         """
-        treecopy = copy.deepcopy(self.tree)
-        all_inputs = self.all_inputs()
-        for task in treecopy:
-            if task in all_inputs:
-                self.tree.remove(task)
+        self.input_keys = self.all_inputs()
+        for key in self.input_keys:
+            self.root_keys.pop(key, None)
 
     def add_node(self, node_key, **kwargs):
         """
@@ -45,18 +66,18 @@ class AbstractSyntaxTree():
         """
         node_key = self.wrapper.standardize_key(node_key)
 
-        if not node_key in self.tree:
-            self.tree.append(node_key)
-
-        if not self.lookup_table.has_key(node_key):
+        if not node_key in self.lookup_table:
             self.lookup_table[node_key] = {}
+            if not node_key in self.input_keys:
+                self.root_keys[node_key] = None
 
         self.lookup_table[node_key].update(kwargs)
 
-        if not self.lookup_table[node_key].has_key('inputs'):
+        if not 'inputs' in self.lookup_table[node_key]:
             self.lookup_table[node_key]['inputs'] = []
+        elif 'inputs' in kwargs:
+            self.clean_tree()
 
-        self.clean_tree()
         return node_key
 
     def add_dependency(self, node_key, input_node_key):
@@ -69,8 +90,8 @@ class AbstractSyntaxTree():
 
         if not node_key == input_node_key:
             self.lookup_table[node_key]['inputs'].append(input_node_key)
-
-        self.clean_tree()
+            self.input_keys.add(input_node_key)
+            self.root_keys.pop(input_node_key, None)
 
     def args_for_node(self, node_key):
         """
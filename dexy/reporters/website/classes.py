@@ -22,18 +22,21 @@ class Navigation(object):
         self.root = None
 
     def populate_lookup_table(self, batch):
-        for data in batch:
-            if not data.output_name():
+        # Only construct data objects for docs which end up in the table.
+        for summary in batch.summaries():
+            if not summary.output_name:
                 continue
 
-            parent_dir = "/" + os.path.dirname(data.output_name())
+            parent_dir = "/" + os.path.dirname(summary.output_name)
             if not self.lookup_table.has_key(parent_dir):
                 self.lookup_table[parent_dir] = {'docs' : []}
 
-            if data.is_canonical_output():
+            if summary.canonical:
+                data = batch.output_data(summary.doc_key)
                 self.lookup_table[parent_dir]['docs'].append(data)
 
-            if data.is_index_page():
+            if summary.is_index_page():
+                data = batch.output_data(summary.doc_key)
                 self.lookup_table[parent_dir]['index-page'] = data
 
     def walk(self):
@@ -361,7 +364,8 @@ class WebsiteReporter(OutputReporter):
             if canonical:
                 if output_ext == ".html":
                     fragments = ('<html', '<body', '<head')
-                    has_html_header = any(html_fragment in unicode(doc.output_data()) for html_fragment in fragments)
+                    with doc.output_data().mmap() as data:
+                        has_html_header = any(data.find(html_fragment) > -1 for html_fragment in fragments)
 
                     if doc.setting('ws-template') == False:
                         self.log_debug("  ws-template is False for %s" % doc.key)
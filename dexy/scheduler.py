@@ -0,0 +1,151 @@
+from multiprocessing.pool import ThreadPool
+import Queue
+import dexy.exceptions
+import sys
+
+class Scheduler(object):
+    """
+    Runs nodes on a pool of worker threads, starting each node as soon as all
+    of the nodes it depends on have finished.
+
+    If a node fails, no more nodes are started and the error is raised once
+    running nodes have finished. The node which failed is kept in
+    failed_node, since wrapper.current_task is written by every worker.
+    """
+    poll_interval = 0.5
+
+    def __init__(self, wrapper, jobs):
+        self.wrapper = wrapper
+        self.jobs = jobs
+        self.failed_node = None
+
+    def dependencies(self, node):
+        """
+        Nodes which must have finished before this node can run. This is the
+        same set of nodes that check_is_cached walks, so script siblings and
+        pattern parents' inputs are respected.
+        """
+        return node.input_nodes(True)
+
+    def collect_nodes(self, roots):
+        """
+        Returns all nodes reachable from roots, in the order they were found.
+        """
+        nodes = []
+        seen = set()
+        stack = list(reversed(roots))
+
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            nodes.append(node)
+            stack.extend(reversed(self.dependencies(node)))
+
+        return nodes
+
+    def build_graph(self, nodes):
+        """
+        Returns dicts of how many unfinished dependencies each node has, and
+        which nodes are waiting on each node. Raises CircularDependency if the
+        nodes can't be ordered.
+        """
+        waiting_on = dict((id(node), 0) for node in nodes)
+        dependents = dict((id(node), []) for node in nodes)
+
+        for node in nodes:
+            for dep in self.dependencies(node):
+                waiting_on[id(node)] += 1
+                dependents[id(dep)].append(node)
+
+        # Kahn's algorithm, just to check that every node can be reached.
+        remaining = dict(waiting_on)
+        ready = [node for node in nodes if remaining[id(node)] == 0]
+        ordered = 0
+        while ready:
+            node = ready.pop()
+            ordered += 1
+            for dependent in dependents[id(node)]:
+                remaining[id(dependent)] -= 1
+                if remaining[id(dependent)] == 0:
+                    ready.append(dependent)
+
+        if ordered < len(nodes):
+            stuck = [node for node in nodes if remaining[id(node)] > 0]
+            raise dexy.exceptions.CircularDependency(stuck[0].key)
+
+        return waiting_on, dependents
+
+    def run_node(self, node):
+        for task in node:
+            task()
+
+    def run(self, roots):
+        nodes = self.collect_nodes(roots)
+        waiting_on, dependents = self.build_graph(nodes)
+
+        self.wrapper.log.debug("running %s nodes with %s jobs" % (len(nodes), self.jobs))
+
+        results = Queue.Queue()
+        pool = ThreadPool(self.jobs)
+
+        def work(node):
+            try:
+                self.run_node(node)
+                results.put((node, None))
+            except BaseException:
+                # Anything not reported here would leave results.get()
+                # waiting forever.
+                results.put((node, sys.exc_info()))
+
+        def submit(node):
+            pool.apply_async(work, (node,))
+
+        in_flight = 0
+        failure = None
+        interrupted = False
+
+        try:
+            for node in nodes:
+                if waiting_on[id(node)] == 0:
+                    submit(node)
+                    in_flight += 1
+
+            while in_flight:
+                try:
+                    # A get() without timeout can't be interrupted by Ctrl-C.
+                    node, exc_info = results.get(timeout=self.poll_interval)
+                except Queue.Empty:
+                    continue
+                in_flight -= 1
+
+                if exc_info:
+                    if not failure:
+                        failure = (node, exc_info)
+                    continue
+
+                if failure:
+                    # Let running tasks finish but don't start new ones.
+                    continue
+
+                for dependent in dependents[id(node)]:
+                    waiting_on[id(dependent)] -= 1
+                    if waiting_on[id(dependent)] == 0:
+                        submit(dependent)
+                        in_flight += 1
+        except KeyboardInterrupt:
+            interrupted = True
+            raise
+        finally:
+            if interrupted:
+                # Stop straight away like a serial run does, rather than
+                # waiting for running nodes to finish.
+                pool.terminate()
+            else:
+                pool.close()
+                pool.join()
+
+        if failure:
+            self.failed_node, exc_info = failure
+            raise exc_info[0], exc_info[1], exc_info[2]
@@ -1,11 +1,32 @@
+from StringIO import StringIO
 from dexy.exceptions import UserFeedback
 from dexy.exceptions import InternalDexyProblem
-from dexy.utils import file_exists
+from dexy.utils import hash_lib
+from dexy.utils import hash_text
+from dexy.utils import is_windows
 import dexy.exceptions
 import dexy.plugin
+import fnmatch
+import gzip
 import os
 import shutil
-import sqlite3
+import struct
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class HashWriter(object):
+    """
+    File-like object which updates a hash object with what is written to it.
+    """
+    def __init__(self, h):
+        self.h = h
+
+    def write(self, data):
+        self.h.update(data)
 
 class Storage(dexy.plugin.Plugin):
     """
@@ -32,6 +53,19 @@ class Storage(dexy.plugin.Plugin):
     def connect(self):
         pass
 
+    def finish(self):
+        """
+        Called when a filter has finished writing this storage's data.
+        """
+        pass
+
+    def cached_data_digest(self):
+        """
+        Returns the digest of the data stored in the cache by a previous run,
+        or None if there is none.
+        """
+        return None
+
 class GenericStorage(Storage):
     """
     Default type of storage where content is stored in files.
@@ -70,6 +104,13 @@ class GenericStorage(Storage):
         else:
             return os.path.exists(self.last_data_file())
 
+    def cached_data_digest(self):
+        for filepath in (self.this_data_file(), self.last_data_file()):
+            if os.path.exists(filepath):
+                fingerprints = self.wrapper.fingerprints
+                return fingerprints.digest(os.path.basename(filepath), filepath)
+        return None
+
     def data_file_size(self, this):
         if this:
             return os.path.getsize(self.this_data_file())
@@ -106,6 +147,24 @@ class GenericStorage(Storage):
         with open(self.data_file(read=True), "rb") as f:
             return f.read()
 
+    def open_data(self):
+        """
+        Returns a file object for reading the data file.
+        """
+        return open(self.data_file(read=True), "rb")
+
+    def claim_cache_files(self, remove_stale=False):
+        """
+        Claims the data file for the current cache generation.
+        """
+        self.wrapper.cache_manifest.claim(self.this_data_file(), remove_stale)
+
+    def copy_from_file(self, filename):
+        """
+        Store the contents of the file at filename as this storage's data.
+        """
+        shutil.copyfile(filename, self.data_file())
+
     def copy_file(self, filepath):
         """
         If data file exists, copy file and return true. Otherwise return false.
@@ -118,27 +177,487 @@ class GenericStorage(Storage):
         except:
             return False
 
+class ContentAddressedStorage(GenericStorage):
+    """
+    Storage where content is stored once per unique digest in a shared blobs/
+    directory and hard linked into place as the data file, so identical
+    outputs of different documents and runs share one copy on disk. Data
+    files which filters write directly are moved into the blobs directory
+    when the filter finishes.
+    """
+    aliases = ['cas']
+
+    # zlib checksums are too weak to identify content by
+    weak_hashfunctions = ('crc32', 'adler32',)
+
+    @classmethod
+    def blobs_dir(klass, wrapper):
+        return os.path.join(wrapper.artifacts_dir, "blobs")
+
+    @classmethod
+    def collect_garbage(klass, wrapper):
+        """
+        Remove blobs which are not linked from any data file. Returns the
+        number of blobs removed.
+
+        Blobs which were created or linked since this run started are kept,
+        as they may be in use by another dexy run in the same project. The
+        inode change time is used for this since linking a file updates it.
+        """
+        removed = 0
+        blobs_dir = klass.blobs_dir(wrapper)
+        start_time = wrapper.batch.start_time
+        if not start_time or not os.path.exists(blobs_dir):
+            return removed
+
+        for dirpath, dirnames, filenames in os.walk(blobs_dir):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    stat_info = os.stat(filepath)
+                except OSError:
+                    # removed by another run
+                    continue
+                if stat_info.st_nlink == 1 and stat_info.st_ctime < start_time:
+                    os.remove(filepath)
+                    removed += 1
+
+        return removed
+
+    def hashfunction(self):
+        if self.wrapper.hashfunction in self.weak_hashfunctions:
+            return 'md5'
+        else:
+            return self.wrapper.hashfunction
+
+    def blob_file(self, digest):
+        return os.path.join(self.blobs_dir(self.wrapper), digest[0:2], digest)
+
+    def link_blob(self, blob_file, filepath):
+        """
+        Puts the blob in place at filepath, replacing any existing file.
+        Returns False if the blob has been removed in the meantime by
+        another run's garbage collection.
+        """
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+        try:
+            if is_windows:
+                shutil.copyfile(blob_file, filepath)
+            else:
+                try:
+                    os.link(blob_file, filepath)
+                except OSError:
+                    shutil.copyfile(blob_file, filepath)
+        except IOError:
+            if os.path.exists(blob_file):
+                raise
+            return False
+        return True
+
+    def store_blob(self, tmp_file, digest):
+        """
+        Moves tmp_file into the blobs directory under its digest, unless an
+        identical blob is already stored. Returns path to blob.
+        """
+        blob_file = self.blob_file(digest)
+        if os.path.exists(blob_file):
+            os.remove(tmp_file)
+        else:
+            try:
+                os.makedirs(os.path.dirname(blob_file))
+            except OSError:
+                pass
+            os.rename(tmp_file, blob_file)
+        return blob_file
+
+    def tmp_blob_file(self):
+        blobs_dir = self.blobs_dir(self.wrapper)
+        try:
+            os.mkdir(blobs_dir)
+        except OSError:
+            pass
+        return os.path.join(blobs_dir, "tmp-%s" % uuid.uuid4())
+
+    def write_data(self, data, filepath=None):
+        if filepath and filepath != self.this_data_file():
+            return GenericStorage.write_data(self, data, filepath)
+
+        filepath = self.this_data_file()
+        self.assert_location_is_in_project_dir(filepath)
+
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+
+        digest = hash_text(data, self.hashfunction())
+
+        blob_file = self.blob_file(digest)
+        if not os.path.exists(blob_file):
+            tmp_file = self.tmp_blob_file()
+            with open(tmp_file, "wb") as f:
+                f.write(data)
+            blob_file = self.store_blob(tmp_file, digest)
+
+        if not self.link_blob(blob_file, filepath):
+            GenericStorage.write_data(self, data, filepath)
+
+    def copy_from_file(self, filename):
+        h = hash_lib(self.hashfunction())()
+        tmp_file = self.tmp_blob_file()
+
+        with open(filename, "rb") as src:
+            with open(tmp_file, "wb") as dest:
+                for chunk in iter(lambda: src.read(65536), ''):
+                    h.update(chunk)
+                    dest.write(chunk)
+
+        blob_file = self.store_blob(tmp_file, h.hexdigest())
+        if not self.link_blob(blob_file, self.data_file(read=False)):
+            shutil.copyfile(filename, self.data_file(read=False))
+
+    def finish(self):
+        """
+        Moves a data file a filter has written directly into the blobs
+        directory and links it back into place.
+        """
+        filepath = self.this_data_file()
+        if is_windows or not os.path.exists(filepath) or os.stat(filepath).st_nlink > 1:
+            return
+
+        h = hash_lib(self.hashfunction())()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                h.update(chunk)
+        blob_file = self.blob_file(h.hexdigest())
+
+        try:
+            if os.path.exists(blob_file):
+                # replace the file with a link to the identical blob
+                tmp_file = self.tmp_blob_file()
+                os.link(blob_file, tmp_file)
+                os.rename(tmp_file, filepath)
+            else:
+                try:
+                    os.makedirs(os.path.dirname(blob_file))
+                except OSError:
+                    pass
+                os.link(filepath, blob_file)
+        except OSError:
+            # The blob was removed or stored by another run meanwhile, the
+            # data file is kept as it is.
+            pass
+
+class CompressedStorage(GenericStorage):
+    """
+    Storage which keeps large text data files compressed, using zstd if the
+    zstandard package is installed and gzip otherwise. Files whose extension
+    is not in compressible_exts, or which are smaller than min_size bytes,
+    are stored as they are. When a real file is needed, the data is
+    decompressed into the work dir.
+    """
+    aliases = ['compressed']
+
+    compressible_exts = ['.c', '.css', '.csv', '.htm', '.html', '.ipynb',
+            '.js', '.json', '.latex', '.log', '.md', '.py', '.R', '.rb',
+            '.rst', '.sh', '.svg', '.tex', '.txt', '.xml', '.yaml']
+    min_size = 4096
+
+    # Compressed files of either codec are read, new files use the first
+    # codec available.
+    suffixes = [('zstd', '.zst'), ('gzip', '.gz')]
+
+    def codec(self):
+        if zstandard:
+            return 'zstd'
+        else:
+            return 'gzip'
+
+    def should_compress(self, size):
+        return self.ext in self.compressible_exts and size >= self.min_size
+
+    def compressed_data_file(self, codec=None):
+        """
+        Returns (codec, path) of the compressed data file, or (None, None)
+        if the data isn't stored compressed. If codec is given, returns the
+        path a file compressed with that codec is stored at.
+        """
+        for name, suffix in self.suffixes:
+            filepath = "%s%s" % (self.this_data_file(), suffix)
+            if codec == name:
+                return name, filepath
+            elif codec is None and os.path.exists(filepath):
+                return name, filepath
+        return None, None
+
+    def uncompressed_file(self):
+        """
+        Location in the work dir which compressed data is decompressed to.
+        """
+        sk = self.storage_key
+        return os.path.join(self.wrapper.work_cache_dir(), "uncompressed",
+                sk[0:2], "%s%s" % (sk, self.ext))
+
+    def remove_data_files(self):
+        filepaths = [self.this_data_file()]
+        filepaths.extend(self.compressed_data_file(name)[1] for name, _ in self.suffixes)
+        for filepath in filepaths:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def compress(self, src):
+        """
+        Stores the contents of file object src compressed.
+        """
+        codec, filepath = self.compressed_data_file(self.codec())
+        tmp_file = "%s.tmp" % filepath
+
+        with open(tmp_file, "wb") as f:
+            if codec == 'zstd':
+                zstandard.ZstdCompressor().copy_stream(src, f)
+            else:
+                gz = gzip.GzipFile(fileobj=f, mode="wb", mtime=0)
+                try:
+                    shutil.copyfileobj(src, gz)
+                finally:
+                    gz.close()
+
+        os.rename(tmp_file, filepath)
+
+    def decompress(self, codec, filepath, dest):
+        """
+        Writes the contents of the compressed file at filepath to file object
+        dest.
+        """
+        with open(filepath, "rb") as src:
+            if codec == 'zstd':
+                if not zstandard:
+                    msg = "The zstandard package is needed to read %s"
+                    raise UserFeedback(msg % filepath)
+                zstandard.ZstdDecompressor().copy_stream(src, dest)
+            else:
+                gz = gzip.GzipFile(fileobj=src, mode="rb")
+                try:
+                    shutil.copyfileobj(gz, dest)
+                finally:
+                    gz.close()
+
+    def decompress_to_file(self, codec, filepath, dest_filepath):
+        tmp_file = "%s-%s.tmp" % (dest_filepath, uuid.uuid4())
+        with open(tmp_file, "wb") as dest:
+            self.decompress(codec, filepath, dest)
+        os.rename(tmp_file, dest_filepath)
+
+    def data_file(self, read=True):
+        """
+        Location of data file. If the data is stored compressed, it is
+        decompressed into the work dir and the location of that file is
+        returned when reading.
+        """
+        if read and not os.path.exists(self.this_data_file()):
+            codec, filepath = self.compressed_data_file()
+            if codec:
+                uncompressed = self.uncompressed_file()
+                is_current = (os.path.exists(uncompressed) and
+                    os.path.getmtime(uncompressed) >= os.path.getmtime(filepath))
+                if not is_current:
+                    try:
+                        os.makedirs(os.path.dirname(uncompressed))
+                    except OSError:
+                        pass
+                    self.decompress_to_file(codec, filepath, uncompressed)
+                return uncompressed
+        return self.this_data_file()
+
+    def data_file_exists(self, this):
+        return os.path.exists(self.this_data_file()) or bool(self.compressed_data_file()[0])
+
+    def cached_data_digest(self):
+        """
+        Returns the digest of the uncompressed data, so it can be compared
+        with the digest of the live file. It is stored in the fingerprint
+        index under the compressed file, so the data is only decompressed
+        again if the compressed file changes.
+        """
+        codec, filepath = self.compressed_data_file()
+        if os.path.exists(self.this_data_file()) or not codec:
+            return GenericStorage.cached_data_digest(self)
+
+        def hash_uncompressed(filepath):
+            h = hash_lib(self.wrapper.hashfunction)()
+            hasher = HashWriter(h)
+            self.decompress(codec, filepath, hasher)
+            return h.hexdigest()
+
+        fingerprints = self.wrapper.fingerprints
+        return fingerprints.digest(os.path.basename(filepath), filepath, hash_fn=hash_uncompressed)
+
+    def data_file_size(self, this):
+        if os.path.exists(self.this_data_file()):
+            return os.path.getsize(self.this_data_file())
+
+        codec, filepath = self.compressed_data_file()
+        if codec == 'gzip':
+            # gzip stores the uncompressed size modulo 2**32 in its last 4 bytes
+            with open(filepath, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                return struct.unpack("<I", f.read(4))[0]
+        else:
+            return os.path.getsize(self.data_file())
+
+    def claim_cache_files(self, remove_stale=False):
+        GenericStorage.claim_cache_files(self, remove_stale)
+        for name, _ in self.suffixes:
+            filepath = self.compressed_data_file(name)[1]
+            self.wrapper.cache_manifest.claim(filepath, remove_stale)
+
+    def read_data(self):
+        if os.path.exists(self.this_data_file()):
+            return GenericStorage.read_data(self)
+
+        codec, filepath = self.compressed_data_file()
+        if not codec:
+            raise IOError("no data file for %s" % self.storage_key)
+
+        buf = StringIO()
+        self.decompress(codec, filepath, buf)
+        return buf.getvalue()
+
+    def write_data(self, data, filepath=None):
+        if filepath and filepath != self.this_data_file():
+            codec, compressed = self.compressed_data_file()
+            if codec and not os.path.exists(self.this_data_file()):
+                self.assert_location_is_in_project_dir(filepath)
+                self.decompress_to_file(codec, compressed, filepath)
+            else:
+                GenericStorage.write_data(self, data, filepath)
+            return
+
+        self.assert_location_is_in_project_dir(self.this_data_file())
+
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+
+        self.remove_data_files()
+        if self.should_compress(len(data)):
+            self.compress(StringIO(data))
+        else:
+            GenericStorage.write_data(self, data)
+
+    def copy_from_file(self, filename):
+        if os.path.abspath(filename) == os.path.abspath(self.this_data_file()):
+            self.finish()
+            return
+
+        self.remove_data_files()
+        if self.should_compress(os.path.getsize(filename)):
+            with open(filename, "rb") as f:
+                self.compress(f)
+        else:
+            shutil.copyfile(filename, self.this_data_file())
+
+    def copy_file(self, filepath):
+        try:
+            self.assert_location_is_in_project_dir(filepath)
+            codec, compressed = self.compressed_data_file()
+            if codec and not os.path.exists(self.this_data_file()):
+                self.decompress_to_file(codec, compressed, filepath)
+            else:
+                shutil.copyfile(self.this_data_file(), filepath)
+            return True
+        except:
+            return False
+
+    def finish(self):
+        """
+        Compresses a data file a filter has written directly.
+        """
+        raw_file = self.this_data_file()
+        if os.path.exists(raw_file) and self.should_compress(os.path.getsize(raw_file)):
+            with open(raw_file, "rb") as f:
+                self.compress(f)
+            os.remove(raw_file)
+
 # Sectioned Data
 import json
 class JsonSectionedStorage(GenericStorage):
     """
     Storage for sectional data using JSON.
+
+    The data file starts with a header line holding the metadata, the
+    section names, and the offset and length of each section's JSON in the
+    body which follows, so single sections can be read without parsing the
+    whole file. Files which are a single JSON array, as written by earlier
+    versions, can still be read.
     """
     aliases = ['jsonsectioned']
 
+    MAGIC = "dexy-sections 1\n"
+
+    _index = None
+
     def value(self, key):
         return self.data()[key]
 
     def __getitem__(self, key):
         return self.value(key)
 
+    def read_index(self):
+        """
+        Returns the header of the data file, which is cached until the data
+        is written again.
+        """
+        if self._index is None:
+            with open(self.data_file(), "rb") as f:
+                if f.readline() == self.MAGIC:
+                    index = json.loads(f.readline())
+                    index['body-start'] = f.tell()
+                else:
+                    f.seek(0)
+                    data = json.load(f)
+                    if hasattr(data, 'keys'):
+                        msg = "Data storage format has changed. Please clear your dexy cache by running dexy with '-r' option."
+                        raise UserFeedback(msg)
+                    index = {
+                            'metadata' : data[0],
+                            'names' : [section.get('name') for section in data[1:]],
+                            'sections' : data[1:]
+                            }
+            self._index = index
+        return self._index
+
+    def metadata(self):
+        return self.read_index()['metadata']
+
+    def section_names(self):
+        return self.read_index()['names']
+
+    def read_section(self, i):
+        """
+        Returns the dict for section number i, reading only that section.
+        """
+        index = self.read_index()
+        if 'sections' in index:
+            return index['sections'][i]
+
+        offset = index['offsets'][i]
+        length = index['lengths'][i]
+        with open(self.data_file(), "rb") as f:
+            f.seek(index['body-start'] + offset)
+            return json.loads(f.read(length))
+
     def read_data(self, this=True):
+        index = self.read_index()
+        if 'sections' in index:
+            return [index['metadata']] + index['sections']
+
         with open(self.data_file(this), "rb") as f:
-            data = json.load(f)
-            if hasattr(data, 'keys'):
-                msg = "Data storage format has changed. Please clear your dexy cache by running dexy with '-r' option."
-                raise UserFeedback(msg)
-            return data
+            f.seek(index['body-start'])
+            body = f.read()
+
+        sections = [json.loads(body[offset:offset+length])
+                for offset, length in zip(index['offsets'], index['lengths'])]
+        return [index['metadata']] + sections
 
     def write_data(self, data, filepath=None):
         if not filepath:
@@ -146,8 +665,35 @@ class JsonSectionedStorage(GenericStorage):
 
         self.assert_location_is_in_project_dir(filepath)
 
+        # ensure_ascii is on by default, so offsets in bytes and characters
+        # are the same
+        bodies = [json.dumps(section) for section in data[1:]]
+
+        offsets = []
+        offset = 0
+        for body in bodies:
+            offsets.append(offset)
+            offset += len(body)
+
+        index = {
+                'metadata' : data[0],
+                'names' : [section.get('name') for section in data[1:]],
+                'offsets' : offsets,
+                'lengths' : [len(body) for body in bodies]
+                }
+
         with open(filepath, "wb") as f:
-            json.dump(data, f)
+            f.write(self.MAGIC)
+            f.write(json.dumps(index))
+            f.write("\n")
+            for body in bodies:
+                f.write(body)
+
+        self._index = None
+
+    def copy_from_file(self, filename):
+        GenericStorage.copy_from_file(self, filename)
+        self._index = None
 
 # Key Value Data
 class JsonStorage(GenericStorage):
@@ -162,9 +708,20 @@ class JsonStorage(GenericStorage):
     def append(self, key, value):
         self._data[key] = value
 
+    def append_many(self, items):
+        self._data.update(items)
+
     def keys(self):
         return self.data().keys()
 
+    def glob(self, pattern):
+        return sorted((k, v) for k, v in self.data().iteritems()
+                if fnmatch.fnmatchcase(k, pattern))
+
+    def prefix(self, prefix):
+        return sorted((k, v) for k, v in self.data().iteritems()
+                if k.startswith(prefix))
+
     def value(self, key):
         return self.data()[key]
 
@@ -199,100 +756,143 @@ class JsonStorage(GenericStorage):
 
 class Sqlite3Storage(GenericStorage):
     """
-    Storage of key value storage in sqlite3 database files.
+    Storage of key value data in the project's shared sqlite3 database.
     """
     aliases = ['sqlite3']
 
+    def kvstore(self):
+        return self.wrapper.kvstore
+
     def working_file(self):
         sk = self.storage_key[0:2]
-        pathargs = (
-                self.wrapper.work_cache_dir(),
-                sk,
-                "%s.sqlite3" % self.storage_key,
-                )
-        return os.path.join(*pathargs)
+        work_dir = os.path.join(self.wrapper.work_cache_dir(), sk)
+        try:
+            os.mkdir(work_dir)
+        except OSError:
+            pass
+        return os.path.join(work_dir, "%s.sqlite3" % self.storage_key)
 
     def connect(self):
-        self._append_counter = 0
         if self.wrapper.state in ('walked', 'checked', 'running'):
-            if file_exists(self.this_data_file()):
+            if self.kvstore().has(self.storage_key):
                 self.connected_to = 'existing'
-                self._storage = sqlite3.connect(self.this_data_file())
-                self._cursor = self._storage.cursor()
-            elif file_exists(self.last_data_file()):
-                msg ="Should not only have last data file %s"
-                msgargs=(self.last_data_file())
-                raise dexy.exceptions.InternalDexyProblem(msg % msgargs)
+                self.kvstore().claim(self.storage_key)
             else:
-                assert not os.path.exists(self.working_file())
-                assert os.path.exists(os.path.dirname(self.working_file()))
                 self.connected_to = 'working'
-                self._storage = sqlite3.connect(self.working_file())
-                self._cursor = self._storage.cursor()
-                self._cursor.execute("CREATE TABLE kvstore (key TEXT, value TEXT)")
-        elif self.wrapper.state == 'walked':
-            raise dexy.exceptions.InternalDexyProblem("connect should not be called in 'walked' state")
+                # Remove any incomplete data left by an earlier run.
+                self.kvstore().delete(self.storage_key)
+        elif not self.kvstore().has(self.storage_key):
+            raise dexy.exceptions.InternalDexyProblem("no data for %s" % self.storage_key)
+
+    def claim_cache_files(self, remove_stale=False):
+        self.import_legacy_data_file()
+        self.kvstore().claim(self.storage_key, remove_stale)
+
+    def import_legacy_data_file(self):
+        """
+        Caches created before key value data was kept in the shared database
+        have a sqlite3 database file per storage key. Imports the data from
+        such a file, if there is one, so the cached data can be reused.
+        """
+        legacy_file = self.this_data_file()
+        if os.path.exists(legacy_file) and not self.kvstore().has(self.storage_key):
+            self.wrapper.log.debug("importing legacy key value data from %s" % legacy_file)
+            self.kvstore().delete(self.storage_key)
+            self.kvstore().import_file(self.storage_key, legacy_file)
+            self.kvstore().finish(self.storage_key)
+            os.remove(legacy_file)
+
+    def data_file_exists(self, this):
+        self.import_legacy_data_file()
+        return self.kvstore().has(self.storage_key)
+
+    def data_file_size(self, this):
+        rows = self.kvstore().execute(
+                "SELECT SUM(LENGTH(key) + LENGTH(value)) FROM kvstore WHERE storage_key = ?",
+                (self.storage_key,))
+        return rows[0][0] or 0
+
+    def data_file(self, read=True):
+        """
+        There is no data file for this storage, when reading a sqlite3
+        database file holding this data is written to the work dir. It is
+        only written again if the data has changed since.
+        """
+        if read:
+            filepath = self.working_file()
+            self.kvstore().export_if_stale(self.storage_key, filepath)
+            return filepath
         else:
-            if file_exists(self.last_data_file()):
-                self._storage = sqlite3.connect(self.last_data_file())
-                self._cursor = self._storage.cursor()
-            elif file_exists(self.this_data_file()):
-                self._storage = sqlite3.connect(self.this_data_file())
-                self._cursor = self._storage.cursor()
-            else:
-                raise dexy.exceptions.InternalDexyProblem("no data for %s" % self.storage_key)
+            return self.this_data_file()
+
+    def copy_from_file(self, filename):
+        self.kvstore().delete(self.storage_key)
+        self.kvstore().import_file(self.storage_key, filename)
+        self.kvstore().finish(self.storage_key)
+
+    def copy_file(self, filepath):
+        try:
+            self.assert_location_is_in_project_dir(filepath)
+            self.kvstore().export(self.storage_key, filepath)
+            return True
+        except:
+            return False
 
     def append(self, key, value):
-        self._cursor.execute("INSERT INTO kvstore VALUES (?, ?)", (key, value))
-        self._append_counter += 1
-        if self._append_counter > 1000:
-            self.wrapper.log.debug("intermediate commit to sqlite db, resetting append counter to 0")
-            self._storage.commit()
-            self._append_counter = 0
+        self.kvstore().append(self.storage_key, key, value)
+
+    def append_many(self, items):
+        self.kvstore().append_many(self.storage_key, items)
 
     def keys(self):
-        self._cursor.execute("SELECT key from kvstore")
-        return [str(k[0]) for k in self._cursor.fetchall()]
+        rows = self.kvstore().execute(
+                "SELECT key FROM kvstore WHERE storage_key = ? ORDER BY rowid",
+                (self.storage_key,))
+        return [str(k[0]) for k in rows]
 
     def value(self, key):
-        self._cursor.execute("SELECT value from kvstore where key = ?", (key,))
-        row = self._cursor.fetchone()
-        if not row:
+        rows = self.kvstore().execute(
+                "SELECT value FROM kvstore WHERE storage_key = ? AND key = ? ORDER BY rowid LIMIT 1",
+                (self.storage_key, key,))
+        if not rows:
             raise Exception("No value found for key '%s'" % key)
         else:
-            return row[0]
+            return rows[0][0]
 
     def like(self, key):
-        self._cursor.execute("SELECT value from kvstore where key LIKE ?", (key,))
-        row = self._cursor.fetchone()
-        if not row:
+        rows = self.kvstore().execute(
+                "SELECT value FROM kvstore WHERE storage_key = ? AND key LIKE ? ORDER BY rowid LIMIT 1",
+                (self.storage_key, key,))
+        if not rows:
             raise Exception("No value found for key '%s'" % key)
         else:
-            return row[0]
+            return rows[0][0]
+
+    def prefix(self, prefix):
+        return self.kvstore().prefix_rows(self.storage_key, prefix)
+
+    def glob(self, pattern):
+        return self.kvstore().glob_rows(self.storage_key, pattern)
 
     def query(self, query):
         if not '%' in query:
             query = "%%%s%%" % query
-        self._cursor.execute("SELECT * from kvstore where key like ?", (query,))
-        return self._cursor.fetchall()
+        return self.kvstore().execute(
+                "SELECT key, value FROM kvstore WHERE storage_key = ? AND key LIKE ? ORDER BY rowid",
+                (self.storage_key, query,))
 
     def __getitem__(self, key):
         return self.value(key)
 
     def __iter__(self):
-        self._cursor = self._storage.cursor()
-        self._cursor.execute("SELECT * from kvstore")
-        rows = self._cursor.fetchall()
-        for k, v in rows:
+        for k, v in self.kvstore().rows(self.storage_key):
             yield k, v
 
     def save(self):
         if self.connected_to == 'existing':
-            assert os.path.exists(self.data_file(read=False))
+            assert self.kvstore().has(self.storage_key)
         elif self.connected_to == 'working':
-            self.assert_location_is_in_project_dir(self.data_file(read=False))
-            self._storage.commit()
-            shutil.copyfile(self.working_file(), self.data_file(read=False))
+            self.kvstore().finish(self.storage_key)
         else:
             msg = "Unexpected 'connected_to' value %s"
             msgargs = self.connected_to
@@ -11,6 +11,7 @@ import shutil
 import tempfile
 import time
 import yaml
+import zlib
 
 is_windows = platform.system() in ('Windows',)
 
@@ -39,10 +40,12 @@ defaults = {
     'hashfunction' : 'md5',
     'ignore_nonzero_exit' : False,
     'include' : '',
+    'jobs' : 1,
     'log_dir' : '.dexy',
     'log_file' : 'dexy.log',
     'log_format' : "%(name)s - %(levelname)s - %(message)s",
     'log_level' : "INFO",
+    'max_processes' : 4,
     'output_root' : '.',
     'pickle' : 'c',
     'plugins': 'dexyplugins.py dexyplugin.py dexyplugins.yaml dexyplugin.yaml',
@@ -50,7 +53,9 @@ defaults = {
     'recurse' : True,
     'reports' : '',
     'safety_filename' : '.dexy-generated',
+    'scandir' : True,
     'siblings' : False,
+    'storage' : 'generic',
     'silent' : False,
     'strace' : False,
     'target' : False,
@@ -107,8 +112,71 @@ def logging_log_level(log_level):
         msg = "'%s' is not a valid log level, check python logging module docs"
         raise dexy.exceptions.UserFeedback(msg % log_level)
 
+class Checksum(object):
+    """
+    Wraps a zlib checksum function (crc32 or adler32) so it can be used like
+    a hashlib object.
+    """
+    def __init__(self, checksum_fn):
+        self.checksum_fn = checksum_fn
+        self.value = checksum_fn('')
+
+    def update(self, text):
+        self.value = self.checksum_fn(text, self.value)
+
+    def hexdigest(self):
+        return "%08x" % (self.value & 0xffffffff)
+
+hash_functions = {
+    'md5' : hashlib.md5,
+    'sha1' : hashlib.sha1,
+    'crc32' : lambda: Checksum(zlib.crc32),
+    'adler32' : lambda: Checksum(zlib.adler32)
+}
+
+if hasattr(hashlib, 'blake2b'):
+    hash_functions['blake2'] = hashlib.blake2b
+else:
+    try:
+        import pyblake2
+        hash_functions['blake2'] = pyblake2.blake2b
+    except ImportError:
+        pass
+
+try:
+    import xxhash
+    hash_functions['xxhash'] = xxhash.xxh64
+except ImportError:
+    pass
+
+def hash_lib(hashfunction):
+    """
+    Returns a constructor for hash objects for the named hash function.
+    """
+    try:
+        return hash_functions[hashfunction]
+    except KeyError:
+        msg = "'%s' is not a valid value for hashfunction, available hash functions are %s"
+        msgargs = (hashfunction, ", ".join(sorted(hash_functions)))
+        raise dexy.exceptions.UserFeedback(msg % msgargs)
+
+def hash_text(text, hashfunction='md5'):
+    h = hash_lib(hashfunction)()
+    h.update(text)
+    return h.hexdigest()
+
+def hash_file(filepath, hashfunction='md5', chunk_size=65536):
+    """
+    Returns hex digest of file contents, reading file in chunks.
+    """
+    h = hash_lib(hashfunction)()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
 def md5_hash(text):
-    return hashlib.md5(text).hexdigest()
+    return hash_text(text, 'md5')
 
 def dict_from_string(text):
     """
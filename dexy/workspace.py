@@ -0,0 +1,250 @@
+from dexy.utils import is_windows
+import dexy.data
+import errno
+import os
+import shutil
+
+# ioctl request number for FICLONE on linux, makes dest share src's extents.
+FICLONE = 0x40049409
+
+# Errors which mean a way of materializing files isn't available between
+# two filesystems, so it isn't tried again for other files.
+UNSUPPORTED_ERRNOS = set(getattr(errno, name) for name in
+        ('EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EINVAL', 'EXDEV', 'ENOSYS', 'EPERM')
+        if hasattr(errno, name))
+
+unsupported = set()
+
+def reflink(source, destination):
+    import fcntl
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def materialize(source, destination, allow_links=True):
+    """
+    Makes the file at source available at destination, which must not exist
+    yet. Tries a reflink, then a hard link and finally copies the file.
+    Symlinks are not used, since writes through them would change the cached
+    file. Links are not made if allow_links is False, since changes to the
+    destination would change the source. Returns the name of the method used.
+    """
+    if is_windows:
+        methods = []
+    elif allow_links:
+        methods = [('reflink', reflink), ('link', os.link)]
+    else:
+        methods = [('reflink', reflink)]
+
+    dest_dir = os.path.dirname(os.path.abspath(destination))
+    devices = (os.stat(source).st_dev, os.stat(dest_dir).st_dev)
+
+    for name, method in methods:
+        if (name, devices) in unsupported:
+            continue
+
+        try:
+            method(source, destination)
+            return name
+        except (IOError, OSError) as e:
+            if os.path.lexists(destination):
+                os.remove(destination)
+            if e.errno in UNSUPPORTED_ERRNOS:
+                unsupported.add((name, devices))
+
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+class Workspace(object):
+    """
+    Directory holding the inputs of a filter under their canonical names.
+
+    A manifest of the files the workspace was populated with is kept next to
+    it, so when the workspace is populated again only files whose source has
+    changed, or which were changed in the workspace, are replaced. Anything
+    else found in the workspace is removed.
+    """
+    def __init__(self, wrapper, path):
+        self.wrapper = wrapper
+        self.path = path
+        self.files = {}
+
+    def manifest_filepath(self):
+        return "%s.manifest" % self.path
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_filepath(), 'rb') as f:
+                pickle = self.wrapper.pickle_lib()
+                return pickle.load(f)
+        except (IOError, EOFError):
+            return {}
+
+    def save_manifest(self):
+        with open(self.manifest_filepath(), 'wb') as f:
+            pickle = self.wrapper.pickle_lib()
+            pickle.dump(self.files, f)
+
+    def source_file(self, data):
+        """
+        Returns the file holding the contents to populate the workspace with
+        for data, or None if the contents have to be written out.
+        """
+        if isinstance(data, dexy.data.Sectioned):
+            return None
+        else:
+            return data.storage.data_file()
+
+    def fingerprint(self, data):
+        """
+        Identifies the stored contents of data, or returns None if they
+        can't be identified without reading them.
+        """
+        try:
+            stat_info = os.stat(data.storage.this_data_file())
+        except (AttributeError, OSError):
+            return None
+        return (data.storage_key, stat_info.st_ino, stat_info.st_size, stat_info.st_mtime)
+
+    def file_stat(self, filepath):
+        stat_info = os.lstat(filepath)
+        return (stat_info.st_ino, stat_info.st_size, stat_info.st_mtime)
+
+    def wanted_dirs(self, relpaths):
+        dirs = set()
+        for relpath in relpaths:
+            parent = os.path.dirname(relpath)
+            while parent and not parent in dirs:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        return dirs
+
+    def prune(self, wanted, mkdirs):
+        """
+        Removes everything from the workspace which isn't a file previously
+        populated from an unchanged source. Returns the set of relative paths
+        of files which can be kept.
+        """
+        saved = self.load_manifest()
+        keep = set()
+
+        dirs = self.wanted_dirs(wanted)
+        for d in mkdirs:
+            d = os.path.normpath(d)
+            dirs.add(d)
+            dirs.update(self.wanted_dirs([os.path.join(d, 'x')]))
+
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            reldir = os.path.relpath(dirpath, self.path)
+            if reldir == '.':
+                reldir = ''
+
+            for dirname in list(dirnames):
+                relpath = os.path.join(reldir, dirname)
+                if not relpath in dirs:
+                    dirnames.remove(dirname)
+                    fullpath = os.path.join(dirpath, dirname)
+                    if os.path.islink(fullpath):
+                        os.remove(fullpath)
+                    else:
+                        shutil.rmtree(fullpath)
+
+            for filename in filenames:
+                relpath = os.path.join(reldir, filename)
+                filepath = os.path.join(dirpath, filename)
+
+                entry = saved.get(relpath)
+                is_unchanged = (entry is not None
+                        and relpath in wanted
+                        and entry[0] is not None
+                        and entry[0] == wanted[relpath][1]
+                        and entry[1] == self.file_stat(filepath))
+
+                if is_unchanged:
+                    keep.add(relpath)
+                    self.files[relpath] = entry
+                else:
+                    os.remove(filepath)
+
+        return keep
+
+    def populate(self, wanted, mkdirs=None):
+        """
+        Populates the workspace. wanted is a dict of relative paths to tuples
+        of (data, fingerprint, allow_links), mkdirs a list of relative paths
+        of directories to create. Returns a dict of how many files were
+        materialized by each method.
+        """
+        mkdirs = mkdirs or []
+        self.files = {}
+
+        if os.path.exists(self.path):
+            keep = self.prune(wanted, mkdirs)
+        else:
+            os.makedirs(self.path)
+            keep = set()
+
+        # Remove the manifest while files are being replaced, so an
+        # interrupted run doesn't leave a manifest describing other files.
+        if os.path.exists(self.manifest_filepath()):
+            os.remove(self.manifest_filepath())
+
+        self.makedirs(mkdirs)
+
+        methods = {'kept' : len(keep)}
+
+        for relpath in sorted(wanted):
+            if relpath in keep:
+                continue
+
+            data, fingerprint, allow_links = wanted[relpath]
+            method = self.add(relpath, data, allow_links)
+            if method:
+                methods[method] = methods.get(method, 0) + 1
+                filepath = os.path.join(self.path, relpath)
+                self.files[relpath] = (fingerprint, self.file_stat(filepath))
+
+        self.save_manifest()
+        return methods
+
+    def makedirs(self, mkdirs):
+        for d in mkdirs:
+            dirpath = os.path.join(self.path, d)
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+
+    def add(self, relpath, data, allow_links=True):
+        """
+        Puts the contents of data in the workspace at relpath, replacing any
+        existing file. Returns the method used, or None if this failed.
+        """
+        filepath = os.path.join(self.path, relpath)
+
+        parent_dir = os.path.dirname(filepath)
+        if not os.path.isdir(parent_dir):
+            os.makedirs(parent_dir)
+        elif os.path.lexists(filepath):
+            os.remove(filepath)
+
+        try:
+            source = self.source_file(data)
+            if source and os.path.exists(source):
+                return materialize(source, filepath, allow_links)
+            else:
+                data.output_to_file(filepath)
+                return 'write'
+        except Exception as e:
+            msg = "problem populating workspace with %s: %s"
+            self.wrapper.log.debug(msg % (data.key, e))
+
+    def relpaths(self):
+        """
+        Returns the set of paths, relative to the workspace, of all files in
+        the workspace.
+        """
+        relpaths = set()
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                relpaths.add(os.path.relpath(filepath, self.path))
+        return relpaths
@@ -2,22 +2,60 @@ from dexy.exceptions import DeprecatedException
 from dexy.exceptions import InternalDexyProblem
 from dexy.exceptions import UserFeedback
 from dexy.utils import file_exists
+from dexy.utils import is_windows
 from dexy.utils import s
 import dexy.batch
 import dexy.doc
+import dexy.fingerprints
+import dexy.kvstore
+import dexy.manifest
+import dexy.metadata
 import dexy.parser
 import dexy.reporter
+import dexy.scheduler
+import dexy.storage
 import dexy.utils
+import dexy.version
 import logging
 import logging.handlers
+import multiprocessing
 import os
 import posixpath
 import shutil
+import subprocess
 import sys
 import textwrap
+import threading
 import time
 import uuid
 
+# Run in a separate python process by empty_trash_in_background.
+REAP_TRASH = """
+import fcntl, os, shutil, sys, uuid
+# Fork again, so the process dexy started exits straight away and the
+# reaper isn't left as a child of dexy.
+if os.fork():
+    os._exit(0)
+trash_dir = sys.argv[1]
+reaping_dir = os.path.join(trash_dir, "reaping-%s" % uuid.uuid4())
+lock = open("%s.lock" % reaping_dir, "w")
+fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+os.mkdir(reaping_dir)
+for name in os.listdir(trash_dir):
+    if not name.startswith("reaping-"):
+        try:
+            os.rename(os.path.join(trash_dir, name), os.path.join(reaping_dir, name))
+        except OSError:
+            pass
+shutil.rmtree(reaping_dir, True)
+os.remove("%s.lock" % reaping_dir)
+"""
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
 class Wrapper(object):
     """
     Class that manages run configuration and state and provides utilities such
@@ -84,8 +122,27 @@ class Wrapper(object):
         self.current_task = None
         self.lookup_nodes = {} # map of shortcuts/keys to all nodes which can match
         self.lookup_sections = {} # map of section names to nodes
+        self.graph_version = 0 # incremented when nodes are added to the graph during a run
+        self.fingerprints = dexy.fingerprints.Fingerprints(self)
+        self.cache_manifest = dexy.manifest.CacheManifest(self)
+        self.kvstore = dexy.kvstore.KeyValueStore(self)
+        self.metadata = dexy.metadata.MetadataStore(self)
+        self.process_semaphore = threading.BoundedSemaphore(self.process_limit())
         self.transition('new')
 
+    def process_limit(self):
+        """
+        Most external processes filters may run at the same time, set by
+        max_processes or one per CPU if max_processes is 0.
+        """
+        if int(self.max_processes) > 0:
+            return int(self.max_processes)
+
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
     def state_message(self):
         """
         A message to print at end of dexy run depending on the final wrapper state.
@@ -121,19 +178,29 @@ class Wrapper(object):
         self.transition('walked')
 
     def check(self):
+        # Discard cache if it was created using a different hash function.
+        self.check_hashfunction()
+
         # Clean and reset working dirs.
         self.reset_work_cache_dir()
-        if not os.path.exists(self.this_cache_dir()):
-            self.create_cache_dir_with_sub_dirs(self.this_cache_dir())
+        self.setup_cache_dir()
+
+        # Start a new cache generation.
+        self.cache_manifest.load()
 
-        # Load information about arguments from previous batch.
+        # Load batch info, runtime args and arguments from previous batch.
+        self.metadata.load()
         self.load_node_argstrings()
 
+        # Load fingerprints of files from previous batch.
+        self.fingerprints.load()
+
         self.check_cache()
         self.consolidate_cache()
 
         # Save information about this batch's arguments for next time.
         self.save_node_argstrings()
+        self.fingerprints.save()
 
     def check_cache(self):
         """
@@ -144,27 +211,57 @@ class Wrapper(object):
 
     def consolidate_cache(self):
         """
-        Move all cache files from last/ cache to this/ cache
+        Claim all cache files from previous runs which are still in use for
+        the current cache generation.
         """
         for node in self.roots:
             node.consolidate_cache_files()
 
-        self.trash(self.last_cache_dir())
-
     def to_checked(self):
         self.check()
         self.transition('checked')
 
     # Cache dirs
+    def cache_dir(self):
+        return os.path.join(self.artifacts_dir, "cache")
+
     def this_cache_dir(self):
-        return os.path.join(self.artifacts_dir, "this")
+        """
+        Cache files stay in place between runs, so the this/ and last/ cache
+        dirs are the same directory. The cache manifest records which files
+        belong to the current run.
+        """
+        return self.cache_dir()
 
     def last_cache_dir(self):
-        return os.path.join(self.artifacts_dir, "last")
+        return self.cache_dir()
+
+    def setup_cache_dir(self):
+        """
+        Creates the cache dir if it doesn't exist, reusing a last/ dir from an
+        older version of dexy if there is one.
+        """
+        old_this_dir = os.path.join(self.artifacts_dir, "this")
+        old_last_dir = os.path.join(self.artifacts_dir, "last")
+
+        if not os.path.exists(self.cache_dir()):
+            if os.path.exists(old_last_dir):
+                shutil.move(old_last_dir, self.cache_dir())
+            else:
+                self.create_cache_dir_with_sub_dirs(self.cache_dir())
+
+        if os.path.exists(old_this_dir):
+            self.trash(old_this_dir)
 
     def work_cache_dir(self):
         return os.path.join(self.artifacts_dir, "work")
 
+    def workspaces_dir(self):
+        """
+        Filter workspaces are kept here between runs, so they can be reused.
+        """
+        return os.path.join(self.artifacts_dir, "workspaces")
+
     def trash_dir(self):
         return os.path.join(self.project_root, ".trash")
 
@@ -198,23 +295,141 @@ class Wrapper(object):
         except IOError:
             pass
 
+    def is_live_reaping_dir(self, name):
+        """
+        Background trash reapers claim trash by moving it into a 'reaping-ID'
+        dir, and hold a lock on 'reaping-ID.lock' while they run. Returns True
+        if name is such a dir or lock file and its reaper is still running,
+        so nobody else should touch it.
+        """
+        if is_windows or not name.startswith("reaping-"):
+            return False
+
+        import fcntl
+        lock_file = os.path.join(self.trash_dir(), name)
+        if not name.endswith(".lock"):
+            lock_file = "%s.lock" % lock_file
+
+        try:
+            f = open(lock_file, "r")
+        except IOError:
+            return False
+
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+        except IOError:
+            return True
+        finally:
+            f.close()
+
     def empty_trash(self):
+        """
+        Delete contents of the trash directory now. This also removes trash
+        left behind by background reapers which died before finishing.
+        """
+        trash_dir = self.trash_dir()
+
         try:
-            shutil.rmtree(self.trash_dir())
+            names = os.listdir(trash_dir)
         except OSError as e:
             if not "No such file or directory" in str(e):
                 raise
+            return
+
+        for name in names:
+            if self.is_live_reaping_dir(name):
+                continue
+
+            path = os.path.join(trash_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        try:
+            os.rmdir(trash_dir)
+        except OSError:
+            # a live reaper is still working in here
+            pass
+
+    def empty_trash_in_background(self):
+        """
+        Start a detached process to delete the current contents of the trash
+        directory, so we don't wait for large trees to be deleted. Each
+        reaper claims the trash it will delete by moving it into its own
+        'reaping-ID' dir, so concurrent runs never delete the same files.
+        The process started here forks the reaper and exits at once, and is
+        waited for so it doesn't linger as a zombie.
+        """
+        if not os.path.exists(self.trash_dir()):
+            return
+
+        if is_windows:
+            self.empty_trash()
+            return
+
+        with open(os.devnull, 'r+') as devnull:
+            proc = subprocess.Popen(
+                    [sys.executable, "-c", REAP_TRASH, self.trash_dir()],
+                    stdin=devnull,
+                    stdout=devnull,
+                    stderr=devnull,
+                    close_fds=True,
+                    preexec_fn=os.setsid
+                    )
+            proc.wait()
+
+    def collect_garbage(self):
+        """
+        Remove content-addressed blobs no longer used by any cached file.
+        """
+        removed = dexy.storage.ContentAddressedStorage.collect_garbage(self)
+        if removed:
+            self.log.debug("removed %s unused blobs" % removed)
+
+    def remove_unused_workspaces(self):
+        """
+        Trash workspaces of filters which are not part of this run.
+        """
+        used = set()
+        for node in self.nodes.values():
+            for f in getattr(node, 'filters', []):
+                used.add(os.path.basename(f.workspace()))
+
+        workspaces_dir = self.workspaces_dir()
+        if not os.path.exists(workspaces_dir):
+            return
+
+        for subdir in os.listdir(workspaces_dir):
+            subdir_path = os.path.join(workspaces_dir, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                storage_key = name.replace(".manifest", "")
+                if not storage_key in used:
+                    self.trash(os.path.join(subdir_path, name))
 
     def reset_work_cache_dir(self):
         # remove work/ dir leftover from previous run (if any) and create a new
         # work/ dir for this run
+        # subdirs are created as they are needed
         work_dir = self.work_cache_dir()
         self.trash(work_dir)
-        self.create_cache_dir_with_sub_dirs(work_dir)
+        os.mkdir(work_dir)
 
     def run(self):
         self.transition('running')
 
+        # Cache files written from here on are only known to the manifest in
+        # memory, so if this run dies before collecting garbage the next run
+        # has to scan the whole cache dir.
+        self.cache_manifest.full_scan = True
+        self.cache_manifest.save()
+
         self.batch.start_time = time.time()
 
         if self.target:
@@ -222,14 +437,25 @@ class Wrapper(object):
         else:
             matches = self.roots
 
+        scheduler = None
         try:
-            for node in matches:
-                for task in node:
-                    task()
+            if self.jobs > 1:
+                scheduler = dexy.scheduler.Scheduler(self, self.jobs)
+                scheduler.run(matches)
+            else:
+                for node in matches:
+                    for task in node:
+                        task()
 
         except Exception as e:
+            if scheduler:
+                self.current_task = scheduler.failed_node
             self.error = e
             self.transition('error')
+            # Keep runtime info and cache files of docs which did run, stale
+            # cache files are left for the next successful run to remove.
+            self.metadata.save()
+            self.cache_manifest.save()
             if self.debug:
                 raise
             else:
@@ -247,8 +473,16 @@ class Wrapper(object):
         self.transition('ran')
         self.batch.end_time = time.time()
         self.batch.save_to_file()
-        shutil.move(self.this_cache_dir(), self.last_cache_dir())
-        self.empty_trash()
+        self.metadata.save()
+        removed = self.cache_manifest.collect_garbage()
+        self.log.debug("removed %s unused cache files" % removed)
+        self.cache_manifest.save()
+        removed = self.kvstore.collect_garbage()
+        self.log.debug("removed %s unused key value stores" % removed)
+        self.kvstore.commit()
+        self.remove_unused_workspaces()
+        self.empty_trash_in_background()
+        self.collect_garbage()
 
         for node in self.nodes.values():
             node.add_to_lookup_sections()
@@ -323,13 +557,40 @@ class Wrapper(object):
                 raise InternalDexyProblem(msg % key)
             setattr(self, key, value)
 
+    # Hashing
+    def hash_text(self, text):
+        return dexy.utils.hash_text(text, self.hashfunction)
+
+    def hash_file(self, filepath):
+        return dexy.utils.hash_file(filepath, self.hashfunction)
+
+    def hashfunction_filename(self):
+        return os.path.join(self.artifacts_dir, 'hashfunction.txt')
+
+    def check_hashfunction(self):
+        """
+        Cache file names are made from hashes, so a cache created with one
+        hash function must not be reused with another.
+        """
+        try:
+            with open(self.hashfunction_filename(), 'r') as f:
+                saved_hashfunction = f.read().strip()
+        except IOError:
+            # caches created before hashfunction.txt was written used md5
+            saved_hashfunction = 'md5'
+
+        if saved_hashfunction != self.hashfunction:
+            msg = "hashfunction changed from '%s' to '%s', not using existing cache"
+            self.log.info(msg % (saved_hashfunction, self.hashfunction))
+            self.trash(self.cache_dir())
+
+        with open(self.hashfunction_filename(), 'w') as f:
+            f.write(self.hashfunction)
+
     # Store Args
     def pickle_lib(self):
         return dexy.utils.pickle_lib(self)
 
-    def node_argstrings_filename(self):
-        return os.path.join(self.artifacts_dir, 'batch.args.pickle')
-
     def save_node_argstrings(self):
         """
         Save string representation of node args to check if they have changed.
@@ -339,21 +600,15 @@ class Wrapper(object):
         for node in self.nodes.values():
             arg_info[node.key_with_class()] = node.sorted_arg_string()
 
-        with open(self.node_argstrings_filename(), 'wb') as f:
-            pickle = self.pickle_lib()
-            pickle.dump(arg_info, f)
+        self.metadata.save_node_args(arg_info)
+        self.metadata.save()
 
     def load_node_argstrings(self):
         """
         Load saved node arg strings into a hash so nodes can check if their
         args have changed.
         """
-        try:
-            with open(self.node_argstrings_filename(), 'rb') as f:
-                pickle = self.pickle_lib()
-                self.saved_args = pickle.load(f)
-        except IOError:
-            self.saved_args = {}
+        self.saved_args = self.metadata.node_args
 
     # Dexy Dirs
     def iter_dexy_dirs(self):
@@ -483,6 +738,8 @@ class Wrapper(object):
             self.trash(os.path.join(log_dir, "dexy.log"))
 
     def remove_dexy_dirs(self):
+        self.kvstore.close()
+        self.metadata.reset()
         for dirpath, safety_filepath, dirstat in self.iter_dexy_dirs():
             if dirstat:
                 self.trash(dirpath)
@@ -550,14 +807,89 @@ class Wrapper(object):
         dirs_and_nones = [i.setting('dir') for i in dexy.reporter.Reporter]
         return [d for d in dirs_and_nones if d]
 
+    def dir_snapshot_filename(self):
+        return os.path.join(self.artifacts_dir, 'dirsnapshot.pickle')
+
+    def load_dir_snapshot(self):
+        """
+        Load listings of project directories saved by a previous map_files.
+        """
+        try:
+            with open(self.dir_snapshot_filename(), 'rb') as f:
+                pickle = self.pickle_lib()
+                return pickle.load(f)
+        except (IOError, EOFError):
+            return {}
+
+    def save_dir_snapshot(self, snapshot):
+        try:
+            with open(self.dir_snapshot_filename(), 'wb') as f:
+                pickle = self.pickle_lib()
+                pickle.dump(snapshot, f)
+        except IOError as e:
+            self.log.debug("unable to save directory snapshot: %s" % e)
+
+    def list_dir(self, dirpath):
+        """
+        Returns lists of subdirectory names and file names in dirpath, and a
+        dict of any file stats which were obtained while listing. Symlinked
+        directories are not listed as subdirectories since, like os.walk, we
+        don't follow them.
+        """
+        dirnames = []
+        filenames = []
+        stats = {}
+
+        if self.scandir and scandir:
+            for entry in scandir(dirpath):
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirnames.append(entry.name)
+                else:
+                    filenames.append(entry.name)
+                    stats[entry.name] = entry.stat()
+        else:
+            for name in os.listdir(dirpath):
+                path = os.path.join(dirpath, name)
+                if os.path.isdir(path):
+                    if not os.path.islink(path):
+                        dirnames.append(name)
+                else:
+                    filenames.append(name)
+
+        return dirnames, filenames, stats
+
     def map_files(self):
         """
         Generates a map of files present in the project directory.
+
+        Directory listings are saved in a snapshot, a directory is only listed
+        again if its mtime has changed since the snapshot was taken.
         """
         exclude = self.exclude_dirs()
         filemap = {}
 
-        for dirpath, dirnames, filenames in os.walk('.'):
+        saved_snapshot = self.load_dir_snapshot()
+        snapshot = {}
+        scan_time = time.time()
+
+        dirpaths = ['.']
+        while dirpaths:
+            dirpath = dirpaths.pop()
+            dir_mtime = os.stat(dirpath).st_mtime
+
+            saved = saved_snapshot.get(dirpath)
+            if saved and saved[0] == dir_mtime:
+                dirnames, filenames = list(saved[1]), saved[2]
+                stats = {}
+            else:
+                dirnames, filenames, stats = self.list_dir(dirpath)
+
+            # Don't trust listings of directories modified just now, they
+            # may change again without their mtime changing.
+            if dir_mtime < scan_time - 1:
+                snapshot[dirpath] = (dir_mtime, list(dirnames), filenames)
+
             for x in exclude:
                 if x in dirnames and not x in self.include:
                     dirnames.remove(x)
@@ -571,11 +903,17 @@ class Wrapper(object):
             else:
                 for filename in filenames:
                     filepath = posixpath.normpath(posixpath.join(dirpath, filename))
+                    ospath = os.path.join(dirpath, filename)
                     filemap[filepath] = {}
-                    filemap[filepath]['stat'] = os.stat(os.path.join(dirpath, filename))
-                    filemap[filepath]['ospath'] = os.path.normpath(os.path.join(dirpath, filename))
+                    filemap[filepath]['stat'] = stats.get(filename) or os.stat(ospath)
+                    filemap[filepath]['ospath'] = os.path.normpath(ospath)
                     filemap[filepath]['dir'] = os.path.normpath(dirpath)
 
+            dirpaths.extend(os.path.join(dirpath, d) for d in reversed(dirnames))
+
+        if snapshot != saved_snapshot:
+            self.save_dir_snapshot(snapshot)
+
         return filemap
 
     def file_available(self, filepath):
@@ -680,29 +1018,42 @@ class Wrapper(object):
         processed.
         """
         parser_aliases = sorted(dexy.parser.Parser.plugins.keys())
+        alias_order = dict((alias, i) for i, alias in enumerate(parser_aliases))
 
         # collect all doc config files in project dir
         config_files = []
-        for alias in parser_aliases:
-            for filepath, fileinfo in self.filemap.iteritems():
+        for filepath, fileinfo in self.filemap.iteritems():
+            alias = os.path.split(filepath)[1]
+            if alias in alias_order:
                 if fileinfo['dir'] == '.' or self.recurse or self.is_explicit_config(filepath):
-                    if os.path.split(filepath)[1] == alias:
-                        self.log.info("using config file '%s'" % filepath)
-                        config_file_info = (fileinfo['ospath'], fileinfo['dir'], alias,)
-                        config_files.append(config_file_info)
+                    config_file_info = (fileinfo['ospath'], fileinfo['dir'], alias,)
+                    config_files.append(config_file_info)
+
+        # configs are parsed in order of parser alias
+        config_files.sort(key=lambda info: alias_order[info[2]])
+        for config_file, dirname, alias in config_files:
+            self.log.info("using config file '%s'" % config_file)
 
         # warn if we don't find any configs
         if len(config_files) == 0:
             msg = "didn't find any document config files (like %s)"
             self.printmsg(msg % (", ".join(parser_aliases)))
 
-        # parse each config file and add to ast
-        ast = dexy.parser.AbstractSyntaxTree(self)
-
+        config_texts = []
         for config_file, dirname, alias in config_files:
             with open(config_file, "r") as f:
-                config_text = f.read()
+                config_texts.append(f.read())
+
+        config_key = self.config_cache_key(config_files, config_texts)
+        ast = self.load_cached_ast(config_key)
+        if ast:
+            self.log.debug("using cached config")
+            return ast
+
+        # parse each config file and add to ast
+        ast = dexy.parser.AbstractSyntaxTree(self)
 
+        for (config_file, dirname, alias), config_text in zip(config_files, config_texts):
             try:
                 parser = dexy.parser.Parser.create_instance(alias, self, ast)
                 parser.parse(dirname, config_text)
@@ -710,8 +1061,53 @@ class Wrapper(object):
                 sys.stderr.write("Problem occurred while parsing %s\n" % config_file)
                 raise
 
+        self.save_cached_ast(config_key, ast)
         return ast
 
+    def config_cache_filename(self):
+        return os.path.join(self.artifacts_dir, 'config.pickle')
+
+    def config_cache_key(self, config_files, config_texts):
+        """
+        Returns a hash of everything which can affect the result of parsing
+        config files: the contents of the config files, the names of files
+        in the project (used to tell files from patterns) and the wrapper
+        options which parsers use.
+        """
+        key_parts = [
+                dexy.version.DEXY_VERSION,
+                repr(self.siblings),
+                ]
+        for (config_file, dirname, alias), config_text in zip(config_files, config_texts):
+            key_parts.extend((config_file, dirname, alias, self.hash_text(config_text)))
+        key_parts.extend(sorted(self.filemap))
+        return self.hash_text("\n".join(key_parts))
+
+    def load_cached_ast(self, config_key):
+        """
+        Returns the AbstractSyntaxTree saved by a previous run if it was
+        parsed from the same config, otherwise None.
+        """
+        try:
+            with open(self.config_cache_filename(), 'rb') as f:
+                pickle = self.pickle_lib()
+                info = pickle.load(f)
+        except (IOError, EOFError):
+            return None
+
+        if info.get('key') == config_key:
+            ast = info['ast']
+            ast.wrapper = self
+            return ast
+
+    def save_cached_ast(self, config_key, ast):
+        if not os.path.exists(self.artifacts_dir):
+            return
+
+        with open(self.config_cache_filename(), 'wb') as f:
+            pickle = self.pickle_lib()
+            pickle.dump({'key' : config_key, 'ast' : ast}, f)
+
     def report(self):
         if self.reports:
             self.log.debug("generating user-specified reports '%s'" % self.reports)
@@ -729,5 +1125,9 @@ class Wrapper(object):
                 self.log.debug("running reporter %s" % reporter.aliases[0])
                 reporter.run(self)
 
+        if self.state == 'ran':
+            # keep any text encodings detected while reporting
+            self.cache_manifest.save()
+
     def is_location_in_project_dir(self, filepath):
         return self.writeanywhere or (self.project_root_ts in os.path.abspath(filepath))
@@ -73,6 +73,13 @@ def test_archive_filter():
         assert "archive/hello.rb" in names
         assert "archive/hello.py-pyg.html" in names
         assert "archive/hello.rb-pyg.html" in names
+
+        # file metadata is taken from the cached file
+        member = tar.getmember("archive/hello.py")
+        data_file = doc.wrapper.nodes['doc:hello.py'].output_data().storage.data_file()
+        stat_info = os.stat(data_file)
+        assert member.mtime == int(stat_info.st_mtime)
+        assert member.mode == stat_info.st_mode & 07777
         tar.close()
 
 def test_archive_filter_with_short_names():
@@ -140,3 +147,19 @@ def test_unprocessed_directory_archive_filter():
         assert ("./abc.txt" in names) or ("abc.txt" in names)
         assert ("./def.txt" in names) or ("def.txt" in names)
         tar.close()
+
+def test_archive_filter_with_key_value_input():
+    with wrap() as wrapper:
+        doc = Doc("archive.tgz|archive",
+                wrapper,
+                [
+                    Doc("hello.txt|keyvalueexample", wrapper, [], contents="hello"),
+                ],
+                contents=" ")
+
+        wrapper.run_docs(doc)
+
+        tar = tarfile.open(doc.output_data().storage.data_file(), mode="r:gz")
+        member = tar.getmember("archive/hello.txt-keyvalueexample.sqlite3")
+        assert member.size > 0
+        tar.close()
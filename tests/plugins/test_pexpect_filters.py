@@ -1,7 +1,9 @@
 from dexy.doc import Doc
 from tests.utils import assert_in_output
+from tests.utils import make_wrapper
 from tests.utils import wrap
 from nose.exc import SkipTest
+import os
 
 def test_shint_filter():
     with wrap() as wrapper:
@@ -132,3 +134,75 @@ x*y
 >>> x*y
 42"""
 
+
+PYTHON_RESET_COMMAND = "__import__('os').chdir(%(wd)r); dexy__x = [globals().pop(dexy__k) for dexy__k in list(globals()) if not dexy__k.startswith('__')]; dexy__x = globals().pop('dexy__k', None); del dexy__x"
+
+def test_pycon_sessions_are_not_shared_by_default():
+    from dexy.filters.pexp import repl_pool
+    repl_pool.close_all()
+
+    with wrap() as wrapper:
+        first_helper = Doc("a/helper.py", wrapper, [], contents="VALUE = 'first'")
+        second_helper = Doc("b/helper.py", wrapper, [], contents="VALUE = 'second'")
+        first = Doc("a/script.py|pycon", wrapper, [first_helper],
+                contents="import helper\nhelper.VALUE")
+        second = Doc("b/script.py|pycon", wrapper, [second_helper],
+                contents="import helper\nhelper.VALUE")
+        wrapper.run_docs(first, second)
+
+        assert "'first'" in str(first.output_data())
+        assert "'second'" in str(second.output_data())
+        assert not repl_pool.idle
+
+def test_pycon_session_is_reused():
+    from dexy.filters.pexp import repl_pool
+    repl_pool.close_all()
+    settings = { 'reset-command' : PYTHON_RESET_COMMAND }
+
+    with wrap() as wrapper:
+        first = Doc("first.py|pycon", wrapper, [], contents="x = 6\nx", pycon=settings)
+        wrapper.run_docs(first)
+        first_output = str(first.output_data())
+
+        assert len(repl_pool.idle) == 1
+        pid = repl_pool.idle[0].proc.pid
+
+        wrapper = make_wrapper()
+        wrapper.to_valid()
+        second = Doc("second.py|pycon", wrapper, [], contents="x\nimport os\nos.getcwd()",
+                pycon=settings)
+        wrapper.run_docs(second)
+        second_output = str(second.output_data())
+
+        assert len(repl_pool.idle) == 1
+        assert repl_pool.idle[0].proc.pid == pid
+
+        # The second doc starts with a fresh namespace in its own directory.
+        assert second_output.split(">>> x")[0] == first_output.split(">>> x")[0]
+        assert "NameError" in second_output
+        wd = os.path.abspath(second.filters[-1].parent_work_dir())
+        assert wd.rstrip("/") in second_output
+
+    repl_pool.close_all()
+
+def test_pycon_batched_output_matches_line_by_line():
+    src = """
+### @export "loop"
+for i in range(3):
+    print i * 'x'
+
+### @export "long"
+"""
+    src += "\n".join("long_variable_name_%03d = %d" % (i, i) for i in range(60))
+    src += "\nprint 5000 * 'z'\nlong_variable_name_059\n"
+
+    with wrap() as wrapper:
+        batched = Doc("batched.py|idio|pycon", wrapper, [], contents=src)
+        by_line = Doc("by-line.py|idio|pycon", wrapper, [], contents=src,
+                pycon={'sentinel-command' : None})
+        wrapper.run_docs(batched, by_line)
+
+        assert batched.output_data().keys() == ['1', 'loop', 'long']
+        for key in batched.output_data().keys():
+            assert str(batched.output_data()[key]) == str(by_line.output_data()[key])
+        assert str(batched.output_data()['long']).endswith(">>> long_variable_name_059\n59")
@@ -3,6 +3,7 @@ from dexy.filters.process import SubprocessFilter
 from tests.utils import wrap
 import dexy.exceptions
 import os
+import time
 
 def test_add_new_files():
     with wrap() as wrapper:
@@ -111,3 +112,85 @@ def test_ignore_nonzero_exit():
                 )
         wrapper.run_docs(node)
         assert True # no NonzeroExit was raised...
+
+def test_command_timeout():
+    with wrap() as wrapper:
+        wrapper.debug = False
+        node = Doc("example.sh|sh",
+                wrapper,
+                [],
+                sh={"command-timeout" : 1},
+                contents="sleep 30 &\nwait"
+                )
+        start = time.time()
+        wrapper.run_docs(node)
+        assert wrapper.state == 'error'
+        assert time.time() - start < 10
+
+def test_memory_limit():
+    with wrap() as wrapper:
+        wrapper.debug = False
+        node = Doc("example.py|py",
+                wrapper,
+                [],
+                py={"memory-limit" : 256 * 1024 * 1024},
+                contents="x = ' ' * (512 * 1024 * 1024)"
+                )
+        wrapper.run_docs(node)
+        assert wrapper.state == 'error'
+
+def test_stdout_is_streamed_to_output():
+    with wrap() as wrapper:
+        node = Doc("example.py|py",
+                wrapper,
+                [],
+                contents="for i in range(100000):\n    print i"
+                )
+        wrapper.run_docs(node)
+
+        lines = str(node.output_data()).splitlines()
+        assert len(lines) == 100000
+        assert lines[-1] == "99999"
+        assert not os.path.exists(node.filters[-1].stdout_file())
+
+def test_command_args():
+    f = dexy.filter.Filter.create_instance('py')
+    assert f.command_args('python -B  "my script.py" --foo') == ['python', '-B', 'my script.py', '--foo']
+    assert f.command_args('ls | wc -l') is None
+    assert f.command_args('echo $HOME') is None
+    assert f.command_args('FOO=bar python "example.py"') is None
+    assert f.command_args('') is None
+
+def test_env_is_not_shared_between_docs():
+    with wrap() as wrapper:
+        with_env = Doc("with-env.py|py",
+                wrapper,
+                [],
+                py={"env" : {"DEXY_TEST_FOO" : "bar"}, "path-extensions" : ["/dexy-test"]},
+                contents="import os\nprint os.environ.get('DEXY_TEST_FOO')\nprint os.environ['PATH'].count('/dexy-test')"
+                )
+        without_env = Doc("without-env.py|py",
+                wrapper,
+                [with_env],
+                contents="import os\nprint os.environ.get('DEXY_TEST_FOO')"
+                )
+        wrapper.run_docs(without_env)
+
+        assert str(with_env.output_data()).split() == ["bar", "1"]
+        assert str(without_env.output_data()).strip() == "None"
+        assert not 'DEXY_TEST_FOO' in os.environ
+
+        f = with_env.filters[-1]
+        assert f.setup_env() == f.setup_env()
+        assert not f.setup_env() is f.setup_env()
+
+def test_shell_builtin_command():
+    with wrap() as wrapper:
+        node = Doc("example.sh|sh",
+                wrapper,
+                [],
+                sh={"command-string" : "type cd"},
+                contents="echo 'not run'"
+                )
+        wrapper.run_docs(node)
+        assert "builtin" in str(node.output_data())
@@ -1,5 +1,6 @@
 from tests.utils import wrap
 from dexy.doc import Doc
+from dexy.exceptions import UserFeedback
 
 def test_pytest_filter():
     with wrap() as wrapper:
@@ -18,3 +19,19 @@ def test_pytest_filter():
         assert data[testname + ':comments'] == "# comment before test\n"
         assert bool(data[testname + ':passed'])
         assert "def basic_test():" in data[testname + ':source']
+
+def test_pytest_filter_chdir_needs_one_job():
+    with wrap() as wrapper:
+        wrapper.jobs = 2
+        doc = Doc(
+                "modules.txt|pytest",
+                wrapper,
+                [],
+                contents="dexy_viewer",
+                pytest={'chdir' : '..'}
+                )
+        try:
+            wrapper.run_docs(doc)
+            assert False, "should raise UserFeedback"
+        except UserFeedback as e:
+            assert "-jobs 1" in e.message
@@ -117,3 +117,27 @@ def test_sed_filter_multiple_inputs():
         wrapper.run_docs(node)
         assert str(node.output_data()['foo.txt']) == 'hEllo'
         assert str(node.output_data()['bar.txt']) == 'tElEphonE'
+
+def test_sed_filter_sections_run_concurrently_in_order():
+    contents = [{}] + [{ "name" : "section-%s" % i, "contents" : "hello %s" % i }
+            for i in range(20)]
+
+    with wrap() as wrapper:
+        inpt = Doc("input.txt", wrapper, [], contents=contents, data_class='sectioned')
+        concurrent = Doc("example.sed|sed", wrapper, [inpt], contents="s/e/E/g")
+        serial = Doc("serial.sed|sed", wrapper, [inpt], contents="s/e/E/g",
+                sed={'concurrent' : False})
+        wrapper.run_docs(concurrent, serial)
+
+        expected = ["section-%s" % i for i in range(20)]
+        assert concurrent.output_data().keys() == expected
+        assert serial.output_data().keys() == expected
+        for key in expected:
+            assert str(concurrent.output_data()[key]) == str(serial.output_data()[key])
+        assert str(concurrent.output_data()['section-7']) == 'hEllo 7'
+
+def test_process_limit():
+    with wrap() as wrapper:
+        assert wrapper.process_limit() == 4
+        wrapper.max_processes = 0
+        assert wrapper.process_limit() >= 1
@@ -24,3 +24,30 @@ def test_ast():
         ast.walk()
         assert len(wrapper.roots) == 1
         assert len(wrapper.nodes) == 2
+
+def test_ast_root_order():
+    with wrap() as wrapper:
+        wrapper.filemap = wrapper.map_files()
+        ast = AbstractSyntaxTree(wrapper)
+
+        ast.add_node("c.txt")
+        ast.add_dependency("a.txt", "b.txt")
+        ast.add_node("d.txt")
+        ast.add_dependency("d.txt", "c.txt")
+        ast.add_node("b.txt", foo='bar')
+        ast.add_node("e.txt")
+
+        assert ast.tree == ['doc:a.txt', 'doc:d.txt', 'doc:e.txt']
+        assert ast.inputs_for_node('d.txt') == ['doc:c.txt']
+
+def test_ast_many_nodes():
+    with wrap() as wrapper:
+        wrapper.filemap = wrapper.map_files()
+        ast = AbstractSyntaxTree(wrapper)
+
+        for i in range(5000):
+            ast.add_dependency("doc%s.txt" % i, "input%s.txt" % i)
+
+        assert len(ast.tree) == 5000
+        assert ast.tree[0] == 'doc:doc0.txt'
+        assert ast.tree[-1] == 'doc:doc4999.txt'
@@ -10,13 +10,14 @@ def test_batch():
 
         wrapper = Wrapper()
         batch = dexy.batch.Batch(wrapper)
-        os.makedirs(batch.batch_dir())
 
         batch.save_to_file()
-        assert batch.filename() in os.listdir(".dexy/batches")
+        wrapper.metadata.save()
+        assert os.path.exists(wrapper.metadata.filepath())
 
         wrapper = Wrapper()
-        batch = dexy.batch.Batch.load_most_recent(wrapper)
+        loaded = dexy.batch.Batch.load_most_recent(wrapper)
+        assert loaded.uuid == batch.uuid
 
 def test_batch_with_docs():
     with tempdir():
@@ -38,3 +39,58 @@ def test_batch_with_docs():
         for doc_key in batch.docs:
             assert batch.input_data(doc_key)
             assert batch.output_data(doc_key)
+
+def test_batch_reuses_data_objects():
+    with tempdir():
+        wrapper = Wrapper()
+        wrapper.create_dexy_dirs()
+
+        with open("hello.txt", "w") as f:
+            f.write("hello")
+
+        with open("dexy.yaml", "w") as f:
+            f.write("hello.txt")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+
+        batch = dexy.batch.Batch.load_most_recent(wrapper)
+        batch.data_cache_size = 1
+        doc_key = 'doc:hello.txt'
+
+        data = batch.output_data(doc_key)
+        assert batch.output_data(doc_key) is data
+        assert str(data) == "hello"
+
+        # Least recently used data is dropped.
+        batch.input_data(doc_key)
+        assert not batch.output_data(doc_key) is data
+
+def test_batch_summaries():
+    with tempdir():
+        wrapper = Wrapper()
+        wrapper.create_dexy_dirs()
+
+        with open("index.md", "w") as f:
+            f.write("hello")
+
+        with open("dexy.yaml", "w") as f:
+            f.write("index.md|markdown")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+
+        batch = dexy.batch.Batch.load_most_recent(wrapper)
+        summaries = list(batch.summaries())
+        assert not batch.data_cache
+
+        assert len(summaries) == 1
+        summary = summaries[0]
+        assert summary.key == "index.md|markdown"
+        assert summary.output_name == "index.html"
+        assert summary.ext == ".html"
+        assert summary.is_index_page()
+
+        matches = batch.matching_output_data(lambda s: "markdown" in s.key)
+        assert [data.key for data in matches] == ["index.md|markdown"]
+        assert matches[0].title() == summary.title
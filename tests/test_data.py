@@ -1,8 +1,12 @@
 from dexy.doc import Doc
+from dexy.wrapper import Wrapper
 from tests.utils import wrap
 import dexy.data
 import dexy.exceptions
+import dexy.storage
 import os
+import sqlite3
+import time
 
 def test_canonical_name():
     with wrap() as wrapper:
@@ -72,6 +76,40 @@ def test_key_value_data_sqlite():
 
         data.as_text() == "foo: bar"
 
+def test_generic_data_streaming():
+    with wrap() as wrapper:
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : 'doc.txt'
+                }
+        data = dexy.data.Generic("doc.txt", ".txt", "abc000", settings, wrapper)
+        data.setup_storage()
+        data.set_data("abc" * 10000 + "<html>")
+
+        with data.open() as f:
+            assert f.read(3) == "abc"
+
+        chunks = list(data.iter_chunks(1000))
+        assert len(chunks) == 31
+        assert "".join(chunks) == data.data()
+
+        with data.mmap() as view:
+            assert len(view) == 30006
+            assert view[0:3] == "abc"
+            assert view.find("<html") == 30000
+
+        data.set_data("")
+        with data.mmap() as view:
+            assert view.find("<html") == -1
+
+        data.set_data("xyz")
+        data.clear_data()
+        data.output_to_file("copy.txt")
+        with open("copy.txt", "r") as f:
+            assert f.read() == "xyz"
+
 def test_generic_data():
     with wrap() as wrapper:
         wrapper.to_walked()
@@ -121,3 +159,322 @@ def test_init_data():
 
         assert not data.has_data()
         assert not data.is_cached()
+
+def test_content_addressed_storage():
+    with wrap() as wrapper:
+        wrapper.storage = 'cas'
+        doc1 = Doc("abc.txt", wrapper, [], contents="same contents")
+        doc2 = Doc("def.txt", wrapper, [], contents="same contents")
+        doc3 = Doc("ghi.txt|dexy", wrapper, [], contents="other contents")
+        wrapper.run_docs(doc1, doc2, doc3)
+
+        data1 = doc1.output_data()
+        data2 = doc2.output_data()
+        assert data1.storage.__class__.__name__ == 'ContentAddressedStorage'
+        assert unicode(data1) == u"same contents"
+        assert unicode(doc3.output_data()) == u"other contents"
+
+        stat1 = os.stat(data1.storage.data_file())
+        stat2 = os.stat(data2.storage.data_file())
+        assert stat1.st_ino == stat2.st_ino
+
+        blobs_dir = dexy.storage.ContentAddressedStorage.blobs_dir(wrapper)
+        blobs = [f for d, _, files in os.walk(blobs_dir) for f in files]
+        assert len(blobs) == 2
+
+        # Blobs no longer linked from any data file are removed by later
+        # runs, but not while they may still be in use by a run which
+        # started before they were unlinked.
+        os.remove(data1.storage.data_file())
+        os.remove(data2.storage.data_file())
+        assert dexy.storage.ContentAddressedStorage.collect_garbage(wrapper) == 0
+        wrapper.batch.start_time = time.time() + 1
+        assert dexy.storage.ContentAddressedStorage.collect_garbage(wrapper) == 1
+
+def test_content_addressed_storage_of_files_written_by_filters():
+    with wrap() as wrapper:
+        wrapper.storage = 'cas'
+        doc = Doc("archive.tgz|archive", wrapper,
+                [Doc("hello.txt", wrapper, [], contents="hello")],
+                contents=" ")
+        wrapper.run_docs(doc)
+
+        data_file = doc.output_data().storage.data_file()
+        assert os.stat(data_file).st_nlink == 2
+
+def test_compressed_storage():
+    with wrap() as wrapper:
+        wrapper.storage = 'compressed'
+        big = "hello world\n" * 1000
+        doc1 = Doc("big.txt|dexy", wrapper, [], contents=big)
+        doc2 = Doc("small.txt", wrapper, [], contents="small")
+        wrapper.run_docs(doc1, doc2)
+
+        data1 = doc1.output_data()
+        storage = data1.storage
+        assert storage.__class__.__name__ == 'CompressedStorage'
+        assert not os.path.exists(storage.this_data_file())
+        codec, compressed = storage.compressed_data_file()
+        assert os.path.getsize(compressed) < len(big)
+
+        assert storage.read_data() == big
+        assert data1.filesize() == len(big)
+        assert data1.is_cached()
+
+        # A real file is decompressed into the work dir when needed.
+        filepath = storage.data_file()
+        assert filepath.startswith(wrapper.work_cache_dir())
+        with open(filepath, "rb") as f:
+            assert f.read() == big
+
+        data1.output_to_file("out.txt")
+        with open("out.txt", "rb") as f:
+            assert f.read() == big
+
+        # Small files are stored as they are.
+        data2 = doc2.output_data()
+        assert os.path.exists(data2.storage.this_data_file())
+        assert not data2.storage.compressed_data_file()[0]
+
+        # Data files written directly by filters are compressed by finish().
+        storage.remove_data_files()
+        with open(storage.data_file(read=False), "wb") as f:
+            f.write(big)
+        storage.finish()
+        assert not os.path.exists(storage.this_data_file())
+        assert storage.read_data() == big
+
+def test_compressed_storage_unchanged_file_is_not_rerun():
+    with wrap():
+        with open("big.txt", "w") as f:
+            f.write("hello world\n" * 1000)
+
+        with open("dexy.yaml", "w") as f:
+            f.write("big.txt|head")
+
+        wrapper = Wrapper(storage='compressed')
+        wrapper.run_from_new()
+        doc = wrapper.nodes['doc:big.txt|head']
+        codec, compressed = doc.initial_data.storage.compressed_data_file()
+        assert codec
+
+        wrapper = Wrapper(storage='compressed')
+        wrapper.run_from_new()
+        doc = wrapper.nodes['doc:big.txt|head']
+        assert not doc.doc_changed
+        assert doc.state == 'consolidated'
+
+def test_key_value_data_shared_sqlite():
+    with wrap():
+        with open("hello.txt", "w") as f:
+            f.write("hello")
+
+        with open("dexy.yaml", "w") as f:
+            f.write("hello.txt|keyvalueexample")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        doc = wrapper.nodes['doc:hello.txt|keyvalueexample']
+        assert doc.state == 'ran'
+        assert doc.output_data().value('foo') == 'bar'
+
+        # no per-document database files in the cache
+        for dirpath, dirnames, filenames in os.walk(wrapper.cache_dir()):
+            assert not any(f.endswith(".sqlite3") for f in filenames)
+
+        # output is written as a standalone database
+        doc.output_data().output_to_file("out.sqlite3")
+        conn = sqlite3.connect("out.sqlite3")
+        assert conn.execute("SELECT key, value FROM kvstore").fetchall() == [('foo', 'bar')]
+        conn.close()
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        doc = wrapper.nodes['doc:hello.txt|keyvalueexample']
+        assert doc.state == 'consolidated'
+        assert doc.output_data().value('foo') == 'bar'
+
+def test_key_value_data_sqlite_export_is_reused():
+    with wrap() as wrapper:
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : 'doc.sqlite3'
+                }
+
+        data = dexy.data.KeyValue("doc.sqlite3", ".sqlite3", "abc000", settings, wrapper)
+        data.setup_storage()
+        data.storage.connect()
+        data.append(u'foo', u'bar')
+
+        exports = []
+        export = wrapper.kvstore.export
+        def counting_export(storage_key, filepath):
+            exports.append(filepath)
+            export(storage_key, filepath)
+        wrapper.kvstore.export = counting_export
+
+        filepath = data.storage.data_file()
+        assert data.storage.data_file() == filepath
+        assert exports == [filepath]
+
+        # exported again once the data changes
+        data.append(u'baz', u'qux')
+        data.storage.data_file()
+        assert exports == [filepath, filepath]
+        conn = sqlite3.connect(filepath)
+        assert len(conn.execute("SELECT key FROM kvstore").fetchall()) == 2
+        conn.close()
+
+def test_key_value_data_sqlite_rejects_bytestrings():
+    with wrap() as wrapper:
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : 'doc.sqlite3'
+                }
+
+        data = dexy.data.KeyValue("doc.sqlite3", ".sqlite3", "abc000", settings, wrapper)
+        data.setup_storage()
+        data.storage.connect()
+
+        data.append('foo', 'bar')
+        try:
+            data.append('baz', '\xe2\x9c\x93')
+            assert False, "should raise ProgrammingError"
+        except sqlite3.ProgrammingError:
+            pass
+
+        data.append('baz', u'\u2713')
+        assert data.keys() == ['foo', 'baz']
+
+def test_key_value_data_sqlite_queries():
+    with wrap() as wrapper:
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : 'doc.sqlite3'
+                }
+
+        data = dexy.data.KeyValue("doc.sqlite3", ".sqlite3", "abc000", settings, wrapper)
+        data.setup_storage()
+        data.storage.connect()
+
+        data.append_many([
+            ('foo:source', 'a'),
+            ('foo:doc', 'b'),
+            ('foobar:doc', 'c'),
+            ('bar:doc', 'd'),
+            ('f*o:doc', 'e'),
+            ])
+
+        assert data.value('foo:doc') == 'b'
+        assert data.prefix('foo:') == [('foo:doc', 'b'), ('foo:source', 'a')]
+        assert data.prefix('f*') == [('f*o:doc', 'e')]
+        assert data.glob('*:doc') == [('bar:doc', 'd'), ('f*o:doc', 'e'),
+                ('foo:doc', 'b'), ('foobar:doc', 'c')]
+        assert data.glob('foo*:doc') == [('foo:doc', 'b'), ('foobar:doc', 'c')]
+        assert data.glob('foo:doc') == [('foo:doc', 'b')]
+
+        plan = wrapper.kvstore.execute(
+                "EXPLAIN QUERY PLAN SELECT key FROM kvstore WHERE storage_key = ? AND key >= ? AND key < ?",
+                ("abc000", "foo:", "foo;"))
+        # plan wording varies between sqlite versions, but the index is named
+        assert "kvstore_storage_key_key" in str(plan)
+
+def test_key_value_data_json_queries():
+    with wrap() as wrapper:
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : 'doc.json'
+                }
+
+        data = dexy.data.KeyValue("doc.json", ".json", "abc000", settings, wrapper)
+        data.setup_storage()
+
+        data.append_many([('foo:source', 'a'), ('foo:doc', 'b'), ('bar:doc', 'd')])
+        assert data.prefix('foo:') == [('foo:doc', 'b'), ('foo:source', 'a')]
+        assert data.glob('*:doc') == [('bar:doc', 'd'), ('foo:doc', 'b')]
+
+def test_key_value_data_imports_legacy_database():
+    with wrap() as wrapper:
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : 'doc.sqlite3'
+                }
+
+        data = dexy.data.KeyValue("doc.sqlite3", ".sqlite3", "abc000", settings, wrapper)
+        data.setup_storage()
+
+        legacy_file = data.storage.this_data_file()
+        conn = sqlite3.connect(legacy_file)
+        conn.execute("CREATE TABLE kvstore (key TEXT, value TEXT)")
+        conn.execute("INSERT INTO kvstore VALUES ('foo', 'bar')")
+        conn.commit()
+        conn.close()
+
+        assert data.is_cached()
+        assert not os.path.exists(legacy_file)
+
+        data.storage.connect()
+        assert data.value('foo') == 'bar'
+
+def test_decoded_text_is_cached():
+    with wrap() as wrapper:
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : 'doc.txt'
+                }
+        data = dexy.data.Generic("doc.txt", ".txt", "abc000", settings, wrapper)
+        data.setup_storage()
+        data.set_data("caf\xc3\xa9")
+
+        text = unicode(data)
+        assert text == u"caf\xe9"
+        assert unicode(data) is text
+
+        data.set_data("abc")
+        assert unicode(data) == u"abc"
+
+        data.clear_data()
+        assert unicode(data) == u"abc"
+
+def test_detected_encoding_is_remembered():
+    with wrap() as wrapper:
+        wrapper.encoding = 'chardet'
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : 'doc.txt'
+                }
+        data = dexy.data.Generic("doc.txt", ".txt", "abc000", settings, wrapper)
+        data.setup_storage()
+        data.set_data("caf\xe9 " * 100)
+
+        detected = []
+        detect = dexy.data.chardet.detect
+        def counting_detect(text):
+            detected.append(text)
+            return detect(text)
+
+        dexy.data.chardet.detect = counting_detect
+        try:
+            assert unicode(data) == u"caf\xe9 " * 100
+
+            data = dexy.data.Generic("doc.txt", ".txt", "abc000", settings, wrapper)
+            data.setup_storage()
+            assert unicode(data) == u"caf\xe9 " * 100
+        finally:
+            dexy.data.chardet.detect = detect
+
+        assert len(detected) == 1
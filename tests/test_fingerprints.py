@@ -0,0 +1,28 @@
+from dexy.fingerprints import Fingerprints
+from dexy.utils import hash_file
+from tests.utils import wrap
+import os
+
+def test_fingerprints():
+    with wrap() as wrapper:
+        with open("hello.txt", "w") as f:
+            f.write("hello")
+
+        fingerprints = Fingerprints(wrapper)
+        fingerprints.load()
+        digest = fingerprints.digest("hello.txt", "hello.txt")
+        assert digest == hash_file("hello.txt")
+        fingerprints.save()
+
+        fingerprints = Fingerprints(wrapper)
+        fingerprints.load()
+        assert fingerprints.saved["hello.txt"][2] == digest
+
+        # Digest is reused while size and mtime are unchanged.
+        stat = os.stat("hello.txt")
+        fingerprints.saved["hello.txt"] = (stat.st_size, stat.st_mtime, "abc")
+        assert fingerprints.digest("hello.txt", "hello.txt") == "abc"
+
+        with open("hello.txt", "w") as f:
+            f.write("hello world")
+        assert fingerprints.digest("hello.txt", "hello.txt") == hash_file("hello.txt")
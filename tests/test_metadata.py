@@ -0,0 +1,99 @@
+from dexy.metadata import MetadataStore
+from dexy.wrapper import Wrapper
+from tests.utils import wrap
+import os
+
+def test_metadata_store():
+    with wrap() as wrapper:
+        store = MetadataStore(wrapper)
+        store.load()
+        store.save_batch("abc", {'docs' : {}})
+        store.save_node_args({'doc:hello.txt' : '[]'})
+        store.save_runtime_info('doc:hello.txt', 'hash1', {'runtime-args' : {}})
+        store.save()
+
+        store = MetadataStore(wrapper)
+        store.load()
+        assert store.records == 3
+        assert store.batch_info() == {'docs' : {}}
+        assert store.node_args == {'doc:hello.txt' : '[]'}
+        assert store.runtime_info('doc:hello.txt', 'hash1') == {'runtime-args' : {}}
+        assert store.runtime_info('doc:hello.txt', 'hash2') is None
+
+        # Unchanged node args aren't appended again.
+        store.save_node_args({'doc:hello.txt' : '[]'})
+        assert not store.pending
+
+def test_metadata_store_ignores_incomplete_record():
+    with wrap() as wrapper:
+        store = MetadataStore(wrapper)
+        store.save_batch("abc", {})
+        store.save_batch("def", {})
+        store.save()
+
+        with open(store.filepath(), "ab") as f:
+            f.write("\x00\x00\x01")
+
+        store = MetadataStore(wrapper)
+        store.load()
+        assert store.most_recent_batch == "def"
+
+        # Log is rewritten without the incomplete record.
+        store.save_batch("ghi", {})
+        store.save()
+        assert os.path.getsize(store.filepath()) == store.valid_size
+
+        store.load()
+        assert store.records == 3
+        assert store.most_recent_batch == "ghi"
+
+def test_metadata_store_keeps_records_saved_by_other_processes():
+    with wrap() as wrapper:
+        store1 = MetadataStore(wrapper)
+        store1.load()
+        store2 = MetadataStore(wrapper)
+        store2.load()
+
+        store1.save_runtime_info('doc:one.txt', 'hash1', {'one' : 1})
+        store1.save()
+        store2.save_runtime_info('doc:two.txt', 'hash2', {'two' : 2})
+        store2.save()
+
+        assert store2.runtime_info('doc:one.txt', 'hash1') == {'one' : 1}
+        assert ('runtime', 'doc:one.txt', ('hash1', {'one' : 1})) in store2.live_records()
+
+        store = MetadataStore(wrapper)
+        store.load()
+        assert store.runtime_info('doc:one.txt', 'hash1') == {'one' : 1}
+        assert store.runtime_info('doc:two.txt', 'hash2') == {'two' : 2}
+
+def test_metadata_store_compacts_log():
+    with wrap() as wrapper:
+        store = MetadataStore(wrapper)
+        for i in range(store.min_records_to_compact + 1):
+            store.save_runtime_info('doc:hello.txt', 'hash%s' % i, {})
+            store.save()
+
+        store.load()
+        assert store.records == 1
+        assert store.runtime_info('doc:hello.txt', 'hash100') == {}
+
+def test_runtime_info_is_reapplied_from_metadata():
+    with wrap():
+        with open("hello.py", "w") as f:
+            f.write("print 'hello'")
+
+        with open("dexy.yaml", "w") as f:
+            f.write("hello.py|pyg|h")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+
+        for dirpath, dirnames, filenames in os.walk(".dexy"):
+            assert not [f for f in filenames if f.endswith(".runtimeargs.pickle")]
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        doc = wrapper.nodes['doc:hello.py|pyg|h']
+        assert doc.state == 'consolidated'
+        assert wrapper.metadata.runtime_info(doc.key_with_class(), doc.hashid) is not None
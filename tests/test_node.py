@@ -3,6 +3,7 @@ from dexy.node import Node
 from dexy.node import PatternNode
 from tests.utils import wrap
 from dexy.wrapper import Wrapper
+import dexy.batch
 import dexy.doc
 import dexy.node
 import os
@@ -38,9 +39,9 @@ def test_node_arg_caching():
         assert node.sorted_arg_string() == '[["baz", 123], ["foo", "bar"]]'
 
         assert os.path.exists(wrapper.artifacts_dir)
-        assert not os.path.exists(wrapper.node_argstrings_filename())
+        assert not os.path.exists(wrapper.metadata.filepath())
         wrapper.save_node_argstrings()
-        assert os.path.exists(wrapper.node_argstrings_filename())
+        assert os.path.exists(wrapper.metadata.filepath())
         wrapper.load_node_argstrings()
         assert not node.check_args_changed()
 
@@ -257,3 +258,63 @@ def test_pattern_node_one_filter():
         assert doc.key == "foo.txt|dexy"
         assert doc.filter_aliases == ['dexy']
         assert doc.parent == node
+
+def test_node_cached_after_touch():
+    with wrap():
+        with open("hello.txt", "w") as f:
+            f.write("hello")
+
+        with open("dexy.yaml", "w") as f:
+            f.write("hello.txt|dexy")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        assert wrapper.nodes['doc:hello.txt|dexy'].state == 'ran'
+
+        # Same contents, newer mtime.
+        stat = os.stat("hello.txt")
+        os.utime("hello.txt", (stat.st_atime + 10, stat.st_mtime + 10))
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        assert wrapper.nodes['doc:hello.txt|dexy'].state == 'consolidated'
+        assert 'hello.txt' in wrapper.fingerprints.current
+
+        with open("hello.txt", "w") as f:
+            f.write("hello!")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        assert wrapper.nodes['doc:hello.txt|dexy'].state == 'ran'
+
+def test_node_hashfunction():
+    with wrap() as wrapper:
+        wrapper.hashfunction = 'crc32'
+        node = Node("foo", wrapper)
+        assert node.hashid == '8c736521'
+
+        wrapper.hashfunction = 'sha1'
+        node = Node("foo", wrapper)
+        assert len(node.hashid) == 40
+
+def test_walk_inputs_diamond():
+    with wrap() as wrapper:
+        base = Node("base.txt", wrapper)
+        left = Node("left.txt", wrapper, [base])
+        right = Node("right.txt", wrapper, [base])
+        top = Node("top.txt", wrapper, [left, right])
+
+        keys = [n.key for n in top.walk_inputs()]
+        assert keys == ["left.txt", "base.txt", "right.txt"]
+
+def test_walk_inputs_invalidated_by_additional_doc():
+    with wrap() as wrapper:
+        base = Doc("base.txt", wrapper, [], contents="base")
+        top = Node("top.txt", wrapper, [base])
+        assert [n.key for n in top.walk_inputs()] == ["base.txt"]
+
+        wrapper.nodes = {}
+        wrapper.batch = dexy.batch.Batch(wrapper)
+        extra = Doc("extra.txt", wrapper, [], contents="extra")
+        base.add_additional_doc(extra)
+        assert [n.key for n in top.walk_inputs()] == ["base.txt", "extra.txt"]
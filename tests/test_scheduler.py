@@ -0,0 +1,130 @@
+from dexy.doc import Doc
+from dexy.exceptions import CircularDependency
+from dexy.node import Node
+from dexy.scheduler import Scheduler
+from dexy.wrapper import Wrapper
+from tests.utils import wrap
+import thread
+import threading
+import time
+
+PARALLEL_YAML = """
+doc.txt|jinja:
+    - one.txt
+    - two.txt
+    - three.txt
+
+script:scriptnode:
+    - start.sh|sh
+    - end.sh|sh
+"""
+
+def test_parallel_run():
+    with wrap():
+        for name in ('one', 'two', 'three'):
+            with open("%s.txt" % name, "w") as f:
+                f.write(name)
+
+        with open("doc.txt", "w") as f:
+            f.write("{{ d['one.txt'] }} {{ d['two.txt'] }} {{ d['three.txt'] }}")
+
+        with open("start.sh", "w") as f:
+            f.write("echo 'start'")
+
+        with open("end.sh", "w") as f:
+            f.write("echo 'end'")
+
+        with open("dexy.yaml", "w") as f:
+            f.write(PARALLEL_YAML)
+
+        wrapper = Wrapper(jobs=4)
+        wrapper.run_from_new()
+
+        assert wrapper.state == 'ran'
+        for node in wrapper.nodes.values():
+            assert node.state == 'ran'
+
+        doc = wrapper.nodes['doc:doc.txt|jinja']
+        assert str(doc.output_data()) == "one two three"
+
+        wrapper = Wrapper(jobs=4)
+        wrapper.run_from_new()
+        for node in wrapper.nodes.values():
+            assert node.state == 'consolidated'
+
+def test_scheduler_orders_dependencies():
+    with wrap() as wrapper:
+        a = Node("a", wrapper)
+        b = Node("b", wrapper, [a])
+        c = Node("c", wrapper, [a, b])
+
+        scheduler = Scheduler(wrapper, 2)
+        nodes = scheduler.collect_nodes([c])
+        assert nodes == [c, a, b]
+
+        waiting_on, dependents = scheduler.build_graph(nodes)
+        assert waiting_on[id(a)] == 0
+        assert waiting_on[id(c)] == 2
+        assert sorted(dependents[id(a)]) == [b, c]
+
+def test_scheduler_circular_dependency():
+    with wrap() as wrapper:
+        a = Node("a", wrapper)
+        b = Node("b", wrapper, [a])
+        a.inputs.append(b)
+
+        scheduler = Scheduler(wrapper, 2)
+        try:
+            scheduler.build_graph(scheduler.collect_nodes([b]))
+            assert False, "should raise CircularDependency"
+        except CircularDependency:
+            pass
+
+def test_parallel_run_error_reports_task():
+    with wrap() as wrapper:
+        doc = Doc("broken.py|py", wrapper, [], contents="raise Exception('oops')")
+        other = Doc("fine.txt", wrapper, [], contents="fine")
+        wrapper.jobs = 2
+        wrapper.debug = False
+        wrapper.run_docs(doc, other)
+
+        assert wrapper.state == 'error'
+        assert wrapper.current_task == doc
+
+def test_scheduler_reraises_keyboard_interrupt():
+    with wrap() as wrapper:
+        a = Node("a", wrapper)
+        b = Node("b", wrapper)
+
+        def interrupt():
+            raise KeyboardInterrupt()
+        a.run = interrupt
+
+        for node in (a, b):
+            node.state = 'uncached'
+
+        scheduler = Scheduler(wrapper, 2)
+        try:
+            scheduler.run([a, b])
+            assert False, "should raise KeyboardInterrupt"
+        except KeyboardInterrupt:
+            pass
+        assert scheduler.failed_node == a
+
+def test_scheduler_stops_on_keyboard_interrupt_while_nodes_run():
+    with wrap() as wrapper:
+        a = Node("a", wrapper)
+        a.run = lambda: time.sleep(5)
+        a.state = 'uncached'
+
+        # Ctrl-C arrives while the node is running.
+        threading.Timer(0.2, thread.interrupt_main).start()
+
+        scheduler = Scheduler(wrapper, 2)
+        start = time.time()
+        try:
+            scheduler.run([a])
+            assert False, "should raise KeyboardInterrupt"
+        except KeyboardInterrupt:
+            pass
+        assert time.time() - start < 2
@@ -29,8 +29,8 @@ def test_create_new_sectioned_dat():
 
 def test_load_json():
     with wrap() as wrapper:
-        os.makedirs(".dexy/this/de")
-        with open(".dexy/this/de/def123.txt", "w") as f:
+        os.makedirs(".dexy/cache/de")
+        with open(".dexy/cache/de/def123.txt", "w") as f:
             f.write("""
             [
                 { "foo" : "bar" },
@@ -67,3 +67,46 @@ def test_load_json():
             assert False, "should raise error"
         except UserFeedback as e:
             assert "No value for zxx" in str(e)
+
+def test_indexed_storage_reads_sections_lazily():
+    with wrap() as wrapper:
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        settings = {
+                'canonical-name' : "doc.txt"
+                }
+        data = Sectioned("doc.txt", ".txt", "def123", settings, wrapper)
+        data.setup()
+        data._data[0]['foo'] = 'bar'
+        for i in range(1000):
+            data["section-%s" % i] = u"contents of section %s \u2713" % i
+        data['section-1']['abc'] = 123
+        data.save()
+
+        with open(data.storage.data_file(), "rb") as f:
+            assert f.readline() == data.storage.MAGIC
+
+        loaded = Sectioned("doc.txt", ".txt", "def123", settings, wrapper)
+        loaded.setup_storage()
+
+        sections_read = []
+        read_section = loaded.storage.read_section
+        def counting_read_section(i):
+            sections_read.append(i)
+            return read_section(i)
+        loaded.storage.read_section = counting_read_section
+
+        assert len(loaded) == 1000
+        assert loaded.keyindex("section-999") == 999
+        assert loaded.keyindex("missing") == -1
+        assert loaded["foo"] == "bar"
+        assert unicode(loaded["section-500"]) == u"contents of section 500 \u2713"
+        assert loaded["section-1"]["abc"] == 123
+        assert sections_read == [500, 1]
+
+        names = [name for name, value in loaded.iteritems()]
+        assert names[0:2] == ["section-0", "section-1"]
+        assert sections_read == [500, 1]
+
+        assert loaded.data() == data.data()
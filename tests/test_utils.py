@@ -4,6 +4,9 @@ from nose.exc import SkipTest
 from nose.tools import raises
 from dexy.utils import s
 from dexy.utils import split_path
+from dexy.exceptions import UserFeedback
+from dexy.utils import hash_functions
+from dexy.utils import hash_text
 from dexy.utils import iter_paths
 
 def test_iter_path():
@@ -48,3 +51,15 @@ class InactiveDexyFilter(Filter):
 def test_inactive_filters_skip():
     with runfilter("inactive", "hello"):
         pass
+
+def test_hash_functions():
+    for hashfunction in hash_functions:
+        assert hash_text("foo", hashfunction) == hash_text("foo", hashfunction)
+        assert hash_text("foo", hashfunction) != hash_text("bar", hashfunction)
+
+    assert hash_text("foo") == 'acbd18db4cc2f85cedef654fccc4a4d8'
+    assert hash_text("foo", 'adler32') == '02820145'
+
+@raises(UserFeedback)
+def test_invalid_hash_function():
+    hash_text("foo", "invalid")
@@ -0,0 +1,73 @@
+from dexy.doc import Doc
+from dexy.workspace import materialize
+from tests.utils import wrap
+import os
+
+def test_materialize():
+    with wrap():
+        with open("source.txt", "w") as f:
+            f.write("hello")
+
+        method = materialize("source.txt", "linked.txt")
+        assert method in ('reflink', 'link', 'copy')
+        with open("linked.txt", "r") as f:
+            assert f.read() == "hello"
+
+        method = materialize("source.txt", "copied.txt", allow_links=False)
+        assert method in ('reflink', 'copy')
+        assert not os.path.islink("copied.txt")
+        assert os.stat("copied.txt").st_ino != os.stat("source.txt").st_ino
+
+def test_workspace_is_reused():
+    with wrap() as wrapper:
+        inpt = Doc("input.txt", wrapper, [], contents="input")
+        doc = Doc("script.sh|sh", wrapper, [inpt], contents="cat input.txt")
+        wrapper.run_docs(doc)
+        assert str(doc.output_data()) == "input"
+
+        f = doc.filters[-1]
+        ws = f.workspace()
+        input_inode = os.stat(os.path.join(ws, "input.txt")).st_ino
+        with open(os.path.join(ws, "stale.txt"), "w") as stale:
+            stale.write("left over")
+        os.makedirs(os.path.join(ws, "stale-dir"))
+
+        f.populate_workspace()
+        assert sorted(os.listdir(ws)) == ["input.txt", "script.sh"]
+        assert os.stat(os.path.join(ws, "input.txt")).st_ino == input_inode
+
+        # A file replaced in the workspace is populated again.
+        os.remove(os.path.join(ws, "input.txt"))
+        with open(os.path.join(ws, "input.txt"), "w") as changed:
+            changed.write("changed")
+        f.populate_workspace()
+        with open(os.path.join(ws, "input.txt"), "r") as repopulated:
+            assert repopulated.read() == "input"
+
+def test_workspace_inputs_setting():
+    with wrap() as wrapper:
+        needed = Doc("needed.txt", wrapper, [], contents="needed")
+        other = Doc("other.txt", wrapper, [], contents="other")
+        doc = Doc("script.sh|sh", wrapper, [needed, other],
+                contents="ls", sh={'workspace-inputs' : ["need*"]})
+        wrapper.run_docs(doc)
+
+        assert sorted(os.listdir(doc.filters[-1].workspace())) == ["needed.txt", "script.sh"]
+
+def test_shared_workspace():
+    with wrap() as wrapper:
+        inpt = Doc("input.txt", wrapper, [], contents="input")
+        doc = Doc("script.sh|sh|sh", wrapper, [inpt],
+                contents="touch created.txt\necho 'ls'",
+                sh={'shared-workspace' : True})
+        wrapper.run_docs(doc)
+
+        first, second = doc.filters
+        assert first.workspace() == second.workspace()
+        assert second.shared_workspace_filter() == first
+
+        # The second filter runs in the tree left by the first one.
+        listed = str(doc.output_data()).split()
+        assert "created.txt" in listed
+        assert "input.txt" in listed
+        assert "created.txt" in second._files_workspace_populated_with
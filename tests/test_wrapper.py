@@ -9,6 +9,8 @@ from tests.utils import wrap
 from dexy.wrapper import Wrapper
 import dexy.batch
 import os
+import shutil
+import time
 
 def test_deprecated_dot_dexy_file():
     with tempdir():
@@ -191,6 +193,46 @@ def test_parse_doc_configs_no_configs():
             value = stdout.getvalue()
         assert "didn't find any document config files" in value
 
+def test_parse_configs_uses_cached_ast():
+    with wrap() as wrapper:
+        with open("dexy.yaml", "w") as f:
+            f.write("foo.txt")
+
+        with open("foo.txt", "w") as f:
+            f.write("foo")
+
+        wrapper.filemap = wrapper.map_files()
+        ast = wrapper.parse_configs()
+        assert ast.tree == ['doc:foo.txt']
+        assert os.path.exists(wrapper.config_cache_filename())
+
+        def fail_to_parse(*args, **kwargs):
+            raise Exception("should use cached ast")
+
+        parse = Yaml.parse
+        Yaml.parse = fail_to_parse
+        try:
+            cached_ast = wrapper.parse_configs()
+        finally:
+            Yaml.parse = parse
+
+        assert cached_ast.tree == ['doc:foo.txt']
+        assert cached_ast.wrapper == wrapper
+
+        # changing the config or the files in the project invalidates the cache
+        with open("dexy.yaml", "w") as f:
+            f.write("foo.txt\nbar.txt")
+        assert wrapper.parse_configs().tree != ['doc:foo.txt']
+
+        with open("dexy.yaml", "w") as f:
+            f.write("bar")
+        assert wrapper.parse_configs().tree == ['bundle:bar']
+
+        with open("bar", "w") as f:
+            f.write("bar")
+        wrapper.filemap = wrapper.map_files()
+        assert wrapper.parse_configs().tree == ['doc:bar']
+
 def test_assert_dexy_dirs():
     with tempdir():
         wrapper = Wrapper()
@@ -225,6 +267,43 @@ def test_init_wrapper_if_dexy_dirs_exist():
         assert 'dexy.log' in os.listdir('.dexy')
         assert not '.dexy/dexy.log' in wrapper.filemap
 
+def test_map_files_uses_dir_snapshot():
+    with tempdir():
+        wrapper = Wrapper()
+        wrapper.create_dexy_dirs()
+
+        os.makedirs("s1/s2")
+        with open("s1/hello.txt", "w") as f:
+            f.write("hello")
+
+        # Make directory mtimes old enough to be saved in the snapshot.
+        for d in ("s1", "s1/s2"):
+            os.utime(d, (1000000000, 1000000000))
+
+        for use_scandir in (True, False):
+            wrapper = Wrapper(scandir=use_scandir)
+            wrapper.to_valid()
+            filemap = wrapper.map_files()
+            assert 's1/hello.txt' in filemap
+            assert filemap['s1/hello.txt']['dir'] == 's1'
+            assert filemap['s1/hello.txt']['ospath'] == os.path.join('s1', 'hello.txt')
+            assert filemap['s1/hello.txt']['stat'].st_size == 5
+            assert './s1' in wrapper.load_dir_snapshot()
+
+        # A new file whose directory mtime is unchanged is not seen because
+        # the snapshot listing is used.
+        with open("s1/new.txt", "w") as f:
+            f.write("new")
+        os.utime("s1", (1000000000, 1000000000))
+
+        wrapper = Wrapper()
+        wrapper.to_valid()
+        assert not 's1/new.txt' in wrapper.map_files()
+
+        # Once the directory mtime changes, the directory is listed again.
+        os.utime("s1", (1000000100, 1000000100))
+        assert 's1/new.txt' in wrapper.map_files()
+
 def test_nodexy_files():
     with tempdir():
         wrapper = Wrapper()
@@ -399,3 +478,202 @@ def test_run_target_ba():
         assert wrapper.nodes['bundle:baz'].state == 'ran'
         assert wrapper.nodes['bundle:foob'].state == 'uncached'
         assert wrapper.nodes['bundle:foobar'].state == 'uncached'
+
+def test_hashfunction_change_discards_cache():
+    with tempdir():
+        with open("dexy.yaml", "w") as f:
+            f.write("foo.txt")
+
+        with open("foo.txt", "w") as f:
+            f.write("foo")
+
+        wrapper = Wrapper()
+        wrapper.create_dexy_dirs()
+        wrapper.run_from_new()
+
+        wrapper = Wrapper(hashfunction='crc32')
+        wrapper.run_from_new()
+        for node in wrapper.roots:
+            assert node.state == 'ran'
+            assert len(node.hashid) == 8
+
+        wrapper = Wrapper(hashfunction='crc32')
+        wrapper.run_from_new()
+        for node in wrapper.roots:
+            assert node.state == 'consolidated'
+
+def test_cache_generations():
+    with tempdir():
+        with open("dexy.txt", "w") as f:
+            f.write("foo.txt\nbar.txt\n")
+
+        for name in ("foo", "bar"):
+            with open("%s.txt" % name, "w") as f:
+                f.write(name)
+
+        wrapper = Wrapper()
+        wrapper.create_dexy_dirs()
+        wrapper.run_from_new()
+        foo_file = wrapper.nodes['doc:foo.txt'].output_data().storage.data_file()
+        bar_file = wrapper.nodes['doc:bar.txt'].output_data().storage.data_file()
+        assert wrapper.cache_manifest.generation == 1
+        foo_inode = os.stat(foo_file).st_ino
+
+        # Cached files stay where they are.
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        assert wrapper.cache_manifest.generation == 2
+        assert os.stat(foo_file).st_ino == foo_inode
+        assert os.path.exists(bar_file)
+
+        # Files of docs which are no longer in the project are removed.
+        with open("dexy.txt", "w") as f:
+            f.write("foo.txt\n")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        assert os.path.exists(foo_file)
+        assert not os.path.exists(bar_file)
+
+def test_cache_manifest_saved_after_error():
+    with tempdir():
+        with open("dexy.txt", "w") as f:
+            f.write("foo.txt\nbroken.py|py\n")
+
+        with open("foo.txt", "w") as f:
+            f.write("foo")
+
+        with open("broken.py", "w") as f:
+            f.write("raise Exception('oops')")
+
+        wrapper = Wrapper(debug=False)
+        wrapper.create_dexy_dirs()
+        wrapper.run_from_new()
+        assert wrapper.state == 'error'
+        foo_file = wrapper.nodes['doc:foo.txt'].output_data().storage.data_file()
+        assert os.path.exists(wrapper.cache_manifest.filepath())
+
+        wrapper = Wrapper()
+        wrapper.to_valid()
+        wrapper.cache_manifest.load()
+        assert wrapper.cache_manifest.generation == 2
+        assert wrapper.cache_manifest.full_scan
+        assert os.path.normpath(foo_file) in wrapper.cache_manifest.files
+
+def test_cache_files_of_interrupted_run_are_removed():
+    with tempdir():
+        for name in ("foo", "bar"):
+            with open("%s.txt" % name, "w") as f:
+                f.write(name)
+
+        with open("dexy.txt", "w") as f:
+            f.write("bar.txt\n")
+
+        wrapper = Wrapper()
+        wrapper.create_dexy_dirs()
+        wrapper.run_from_new()
+
+        # foo.txt is cached, then the run is interrupted.
+        with open("dexy.txt", "w") as f:
+            f.write("foo.txt\nbar.txt\n")
+
+        wrapper = Wrapper()
+        wrapper.to_valid()
+        wrapper.to_walked()
+        wrapper.to_checked()
+
+        def interrupt():
+            raise KeyboardInterrupt()
+        wrapper.nodes['doc:bar.txt'].run = interrupt
+
+        try:
+            wrapper.run()
+            assert False, "should raise KeyboardInterrupt"
+        except KeyboardInterrupt:
+            pass
+
+        foo_file = wrapper.nodes['doc:foo.txt'].output_data().storage.data_file()
+        assert os.path.exists(foo_file)
+
+        # foo.txt is dropped, its cache file is removed by the next run.
+        with open("dexy.txt", "w") as f:
+            f.write("bar.txt\n")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        assert wrapper.state == 'ran'
+        assert not os.path.exists(foo_file)
+
+def test_cache_migrated_from_last_dir():
+    with tempdir():
+        with open("dexy.yaml", "w") as f:
+            f.write("foo.txt")
+
+        with open("foo.txt", "w") as f:
+            f.write("foo")
+
+        wrapper = Wrapper()
+        wrapper.create_dexy_dirs()
+        wrapper.run_from_new()
+
+        # Recreate the layout used by older versions of dexy.
+        os.remove(wrapper.cache_manifest.filepath())
+        shutil.move(wrapper.cache_dir(), ".dexy/last")
+        with open(".dexy/last/unused.txt", "w") as f:
+            f.write("unused")
+
+        wrapper = Wrapper()
+        wrapper.run_from_new()
+        for node in wrapper.roots:
+            assert node.state == 'consolidated'
+        assert not os.path.exists(".dexy/last")
+        assert not os.path.exists(os.path.join(wrapper.cache_dir(), "unused.txt"))
+
+def test_remove_unused_workspaces_skips_files():
+    with tempdir():
+        with open("dexy.yaml", "w") as f:
+            f.write("foo.txt")
+
+        with open("foo.txt", "w") as f:
+            f.write("foo")
+
+        wrapper = Wrapper()
+        wrapper.create_dexy_dirs()
+        os.makedirs(wrapper.workspaces_dir())
+        stray_file = os.path.join(wrapper.workspaces_dir(), "stray.txt")
+        with open(stray_file, "w") as f:
+            f.write("stray")
+
+        wrapper.run_from_new()
+        assert os.path.exists(stray_file)
+
+def test_empty_trash_in_background():
+    with tempdir():
+        wrapper = Wrapper()
+        os.makedirs(".trash/abc/def")
+        wrapper.empty_trash_in_background()
+
+        for i in range(50):
+            if not os.listdir(".trash"):
+                break
+            time.sleep(0.1)
+
+        assert os.listdir(".trash") == []
+
+def test_empty_trash_removes_stale_reaping_dirs():
+    import fcntl
+    with tempdir():
+        wrapper = Wrapper()
+        os.makedirs(".trash/reaping-live/abc")
+        os.makedirs(".trash/reaping-dead/abc")
+        os.makedirs(".trash/reaping-nolock/abc")
+        os.makedirs(".trash/xyz")
+
+        with open(".trash/reaping-dead.lock", "w") as f:
+            f.write("")
+
+        with open(".trash/reaping-live.lock", "w") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            wrapper.empty_trash()
+
+        assert sorted(os.listdir(".trash")) == ["reaping-live", "reaping-live.lock"]